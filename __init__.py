@@ -34,6 +34,10 @@ Logs each channel to its own individual logfile.
 import supybot
 import supybot.world as world
 
+# reload() is defined below as Owner's reload hook.  This file is run again
+# when the plugin is reloaded, so the modules are reloaded with the builtin.
+from __builtin__ import reload
+
 # Use this for the version of this plugin.  You may wish to put a CVS keyword
 # in here if you're keeping the plugin in CVS or some similar system.
 __version__ = "%%VERSION%%"
@@ -45,6 +49,40 @@ __author__ = supybot.authors.jemfinch
 __contributors__ = {}
 
 import config
+import archive
+reload(archive)
+import collector
+reload(collector)
+import linkify
+reload(linkify)
+import ircformat
+reload(ircformat)
+import events
+reload(events)
+import export
+reload(export)
+import handoff
+reload(handoff)
+import lineindex
+reload(lineindex)
+import logfiles
+reload(logfiles)
+import membership
+reload(membership)
+import netsplit
+reload(netsplit)
+import retention
+reload(retention)
+import rotation
+reload(rotation)
+import search
+reload(search)
+import stats
+reload(stats)
+import timestamps
+reload(timestamps)
+import writer
+reload(writer)
 import plugin
 reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
@@ -56,5 +94,10 @@ if world.testing:
 Class = plugin.Class
 configure = config.configure
 
+def reload(x=None):
+    """Called by Owner's reload command once this package is reloaded, with
+    what the old plugin module's reload() returned."""
+    handoff.expect(x)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
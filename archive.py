@@ -0,0 +1,185 @@
+"""
+Static index pages linking each channel's day logs together.
+
+Each channel gets an index page listing its months, and a page per month
+listing its days with how many lines were logged and when the first and last
+of them were.  The month pages are named index-YYYY-MM.html, so they can't
+be mistaken for a log named after its month.  The pages are written from a
+small JSON file of per-day counts kept next to them, which is updated from
+counters kept while the day is logged, so the logs themselves are never read
+back.
+"""
+
+import os
+import cgi
+import json
+import time
+import urllib
+
+def monthName(prefix, month):
+    """Returns the name of the page for month of the channel whose files
+    start with prefix."""
+    return '%sindex-%s.html' % (prefix, month)
+
+# The header and footer of every page.
+PAGE_START = """<!DOCTYPE html>
+<html>
+<head>
+<title>%(title)s</title>
+<link rel="stylesheet" href="%(css)s" type="text/css" />
+<meta http-equiv="content-type" content="text/html; charset=utf-8" />
+</head>
+<body>
+<h1>%(title)s</h1>
+<p>Timestamps are in UTC.</p>
+<table class="archive">
+"""
+
+PAGE_END = """</table>
+</body>
+</html>
+"""
+
+class Day(object):
+    """What's been logged on one day since the counts were last saved."""
+    __slots__ = ('directory', 'prefix', 'path', 'lines', 'first', 'last')
+    def __init__(self, directory, prefix, path, now):
+        self.directory = directory
+        self.prefix = prefix
+        self.path = path
+        self.lines = 0
+        self.first = now
+        self.last = now
+
+def writeFile(path, s):
+    """Replaces the file at path with s, all at once."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        fd.write(s)
+    os.rename(tmp, path)
+
+def utf8(obj):
+    """A json.load() object_hook turning its unicode back into strs, like
+    the rest of the plugin uses."""
+    d = {}
+    for (key, value) in obj.iteritems():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        d[key.encode('utf-8')] = value
+    return d
+
+def link(path):
+    return urllib.quote(path.replace(os.sep, '/'))
+
+def clock(t):
+    return time.strftime('%H:%M:%S', time.gmtime(t))
+
+class Archive(object):
+    """Counts the lines logged each day, and writes them into the archive
+    pages of their channel when save() is called.
+
+    The pages of a channel are written in directory, the one holding its
+    logs (without any directories.timestamp part).  If that's shared with
+    other channels, prefix (the channel's name followed by a dot) keeps the
+    files of each apart.
+    """
+    def __init__(self):
+        self.days = {}
+
+    def count(self, network, channel, date, directory, prefix, path, now):
+        """Counts a line logged to the log at path, which is channel's log
+        for date."""
+        days = self.days.setdefault((network, channel), {})
+        try:
+            day = days[date]
+        except KeyError:
+            day = Day(directory, prefix, path, now)
+            days[date] = day
+        day.lines += 1
+        day.last = now
+
+    def rename(self, network, channel, path, newPath):
+        """Makes the days counted as logged to path link to newPath instead,
+        as when the log is being compressed."""
+        for day in self.days.get((network, channel), {}).itervalues():
+            if day.path == path:
+                day.path = newPath
+
+    def save(self, network, channel, css):
+        """Adds what's been counted for channel to its archive pages."""
+        days = self.days.pop((network, channel), None)
+        if not days:
+            return
+        byDirectory = {}
+        for (date, day) in days.iteritems():
+            key = (day.directory, day.prefix)
+            byDirectory.setdefault(key, []).append((date, day))
+        for ((directory, prefix), days) in byDirectory.iteritems():
+            self.update(directory, prefix, channel, days, css)
+
+    def saveAll(self, css):
+        for (network, channel) in self.days.keys():
+            self.save(network, channel, css)
+
+    def update(self, directory, prefix, channel, days, css):
+        stateFile = os.path.join(directory, prefix + 'archive.json')
+        try:
+            with open(stateFile) as fd:
+                state = json.load(fd, object_hook=utf8)
+        except (IOError, ValueError):
+            state = {}
+        months = set()
+        for (date, day) in days:
+            path = os.path.relpath(day.path, directory)
+            entry = state.get(date)
+            if entry is None:
+                entry = {'lines': 0, 'first': day.first, 'last': day.last,
+                         'month': time.strftime('%Y-%m',
+                                                time.gmtime(day.first))}
+                state[date] = entry
+            entry['lines'] += day.lines
+            entry['first'] = min(entry['first'], day.first)
+            entry['last'] = max(entry['last'], day.last)
+            entry['path'] = path
+            months.add(entry['month'])
+        writeFile(stateFile, json.dumps(state, sort_keys=True))
+        for month in months:
+            writeFile(os.path.join(directory, monthName(prefix, month)),
+                      self.monthPage(channel, month, state, css))
+        writeFile(os.path.join(directory, prefix + 'index.html'),
+                  self.indexPage(channel, prefix, state, css))
+
+    def monthPage(self, channel, month, state, css):
+        title = cgi.escape('IRC logs of %s in %s' % (channel, month))
+        L = [PAGE_START % {'title': title, 'css': css},
+             '<tr><th>Day</th><th>Lines</th><th>First</th><th>Last</th>'
+             '</tr>\n']
+        for date in sorted(state):
+            entry = state[date]
+            if entry['month'] != month:
+                continue
+            L.append('<tr><td><a href="%s">%s</a></td><td>%s</td><td>%s</td>'
+                     '<td>%s</td></tr>\n' % (link(entry['path']),
+                                             cgi.escape(date), entry['lines'],
+                                             clock(entry['first']),
+                                             clock(entry['last'])))
+        L.append(PAGE_END)
+        return ''.join(L)
+
+    def indexPage(self, channel, prefix, state, css):
+        months = {}
+        for entry in state.itervalues():
+            (days, lines) = months.get(entry['month'], (0, 0))
+            months[entry['month']] = (days + 1, lines + entry['lines'])
+        title = cgi.escape('IRC logs of %s' % channel)
+        L = [PAGE_START % {'title': title, 'css': css},
+             '<tr><th>Month</th><th>Days</th><th>Lines</th></tr>\n']
+        for month in sorted(months, reverse=True):
+            (days, lines) = months[month]
+            L.append('<tr><td><a href="%s">%s</a></td><td>%s</td><td>%s</td>'
+                     '</tr>\n' % (link(monthName(prefix, month)),
+                                  cgi.escape(month), days, lines))
+        L.append(PAGE_END)
+        return ''.join(L)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,66 @@
+"""
+Micro-benchmark for rendering the text of HTML log lines.
+
+Compares the old chain of cgi.escape(), linkify.replaceurls() and
+ircutils.stripFormatting(), each a pass over the text, with the single scan
+of ircformat.toHtml(), on the chat lines of bench_linkify with some bold and
+colour codes mixed in.  Run it from the plugin directory:
+
+    python benchmarks/bench_ircformat.py [-n LINES] [-r REPEAT]
+"""
+
+import os
+import sys
+import cgi
+import random
+import timeit
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import supybot.ircutils as ircutils
+
+import linkify
+import ircformat
+from bench_linkify import CHAT
+
+FORMATTED = [
+    '\x02important:\x02 the server is going down at 20:00 UTC',
+    '\x0304,01red on black\x03 and back',
+    'build \x0303passed\x0f: http://ci.musicbrainz.org/job/1234/',
+    '\x1ditalic\x1d and \x1funderlined\x1f',
+]
+
+def oldToHtml(text):
+    return ircutils.stripFormatting(linkify.replaceurls(cgi.escape(text)))
+
+def makeLines(count, seed=0):
+    rand = random.Random(seed)
+    return [rand.choice(CHAT + FORMATTED) for _ in xrange(count)]
+
+def run(func, lines, repeat):
+    def loop():
+        for line in lines:
+            func(line)
+    best = min(timeit.repeat(loop, number=1, repeat=repeat))
+    return len(lines) / best
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n LINES] [-r REPEAT]')
+    parser.add_option('-n', '--lines', type='int', default=20000)
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    (options, args) = parser.parse_args()
+    lines = makeLines(options.lines)
+    for line in CHAT:
+        assert oldToHtml(line) == ircformat.toHtml(line), line
+    before = run(oldToHtml, lines, options.repeat)
+    after = run(ircformat.toHtml, lines, options.repeat)
+    print 'before: %10.0f lines/s' % before
+    print 'after:  %10.0f lines/s' % after
+    print 'speedup: %.2fx' % (after / before)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for the HTML linkifier.
+
+Compares the old replaceurls(), which compiled the URL pattern on every call
+and always ran it, with linkify.replaceurls() on a mix of chat lines roughly
+like a day in #musicbrainz.  Run it from the plugin directory:
+
+    python benchmarks/bench_linkify.py [-n LINES] [-r REPEAT]
+"""
+
+import os
+import re
+import sys
+import cgi
+import random
+import timeit
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import linkify
+
+def oldReplaceurls(text):
+    url_re = re.compile(linkify.URL, re.VERBOSE | re.MULTILINE)
+    return re.sub(url_re, '<a href="\g<0>">\g<0></a>', text)
+
+CHAT = [
+    'hi all',
+    'anyone around?',
+    'I think the release group is wrong, it should be an EP',
+    'nikki: can you have a look at the edit I just made',
+    'yes, that was merged last week',
+    'lol',
+    'the ISRCs on that release are all duplicated',
+    'ok, thanks!',
+    'I\'ll fix the tracklist later tonight',
+    'ruaok: ping',
+    'is the server down again? search is timing out for me',
+    'that artist has like 40 aliases',
+    'see http://musicbrainz.org/release/0b9b5e84-8b39-4bd6-9a4c-b5c3c3c1f0b1',
+    'https://tickets.metabrainz.org/browse/MBS-1234 is the ticket for it',
+    'www.discogs.com has a different catalogue number',
+    'the docs are at wiki.musicbrainz.org/Style/Release',
+    'dump is at ftp://ftp.musicbrainz.org/pub/musicbrainz/data/fullexport/',
+    '<script>alert("nope")</script> & friends',
+]
+
+def makeLines(count, seed=0):
+    rand = random.Random(seed)
+    return [cgi.escape(rand.choice(CHAT)) for _ in xrange(count)]
+
+def run(func, lines, repeat):
+    def loop():
+        for line in lines:
+            func(line)
+    best = min(timeit.repeat(loop, number=1, repeat=repeat))
+    return len(lines) / best
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n LINES] [-r REPEAT]')
+    parser.add_option('-n', '--lines', type='int', default=20000)
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    (options, args) = parser.parse_args()
+    lines = makeLines(options.lines)
+    for line in lines:
+        assert oldReplaceurls(line) == linkify.replaceurls(line), line
+    before = run(oldReplaceurls, lines, options.repeat)
+    after = run(linkify.replaceurls, lines, options.repeat)
+    print 'before: %10.0f lines/s' % before
+    print 'after:  %10.0f lines/s' % after
+    print 'speedup: %.2fx' % (after / before)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
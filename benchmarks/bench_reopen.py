@@ -0,0 +1,87 @@
+"""
+Benchmark for detecting html_start() when reopening existing HTML logs.
+
+Writes a number of large HTML day logs to a temporary directory and times how
+long deciding whether each one needs a header takes, first by scanning every
+line for <head> as getLog() used to, then with logfiles.hasHtmlStart().  Run
+it from the plugin directory:
+
+    python benchmarks/bench_reopen.py [-n LOGS] [-s MEGABYTES]
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import logfiles
+
+HEADER = """<!DOCTYPE html>
+<html>
+<head>
+<title>IRC log of #musicbrainz on 2012-03-01</title>
+<link rel="stylesheet" href="style.css" type="text/css" />
+<meta http-equiv="content-type" content="text/html; charset=utf-8" />
+</head>
+<body>
+<h1>IRC log of #musicbrainz on 2012-03-01</h1>
+<p>Timestamps are in UTC.</p>
+"""
+
+LINE = ('<p class="privmsg"><a id="12-00-00-0" href="#12-00-00-0" '
+        'class="timestamp" title="2012-03-01T12:00:00">12:00:00</a> '
+        '<span><span class="nick">&lt;someone&gt;</span> just chatting about '
+        'releases and recordings</span></p>\n')
+
+def oldHasHtmlStart(path):
+    with file(path, 'r') as log:
+        found = False
+        for line in log.readlines():
+            if re.search('<head>', line):
+                found = True
+        return found
+
+def makeLogs(directory, count, size):
+    body = LINE * (size // len(LINE) + 1)
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(directory, '#chan%d.2012-03-01.html' % i)
+        with open(path, 'wb') as fd:
+            fd.write(HEADER)
+            fd.write(body)
+        paths.append(path)
+    return paths
+
+def run(func, paths):
+    start = time.time()
+    for path in paths:
+        assert func(path)
+    return time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n LOGS] [-s MEGABYTES]')
+    parser.add_option('-n', '--logs', type='int', default=500)
+    parser.add_option('-s', '--size', type='float', default=2,
+                      help='size of each log in megabytes')
+    (options, args) = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='mbchannellogger-bench-')
+    try:
+        paths = makeLogs(directory, options.logs,
+                         int(options.size * 1024 * 1024))
+        before = run(oldHasHtmlStart, paths)
+        after = run(logfiles.hasHtmlStart, paths)
+    finally:
+        shutil.rmtree(directory)
+    print 'reopening %d logs of %.1f MB' % (options.logs, options.size)
+    print 'before: %8.3f s' % before
+    print 'after:  %8.3f s' % after
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
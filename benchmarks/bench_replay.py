@@ -0,0 +1,229 @@
+"""
+Benchmark replaying IRC traffic through the whole plugin.
+
+Feeds a stream of messages to MBChannelLogger.__call__ (and the bot's own
+replies to outFilter) with a fake irc object and a temporary log directory,
+once for each combination of settings, and reports messages per second, the
+median and 99th percentile time spent handling a message, and the number of
+write system calls made (from /proc/self/io, so only on Linux).
+
+The stream is synthetic by default: chatter with actions and URL-heavy lines
+across a number of channels, join/part storms and a netsplit with its
+rejoins.  A recorded stream can be replayed instead, as a file of raw IRC
+lines as the server sent them.  Run it from the plugin directory:
+
+    python benchmarks/bench_replay.py [-n MESSAGES] [-f FILE]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+
+# supybot reads its directories from the registry as it's imported, so they
+# have to point somewhere harmless first.
+confDir = tempfile.mkdtemp(prefix='mbchannellogger-bench-')
+registryFilename = os.path.join(confDir, 'bench.conf')
+with open(registryFilename, 'w') as fd:
+    fd.write("""
+supybot.directories.data: %(dir)s/data
+supybot.directories.conf: %(dir)s/conf
+supybot.directories.log: %(dir)s/logs
+supybot.log.stdout: False
+""" % {'dir': confDir})
+
+import supybot.registry as registry
+registry.open(registryFilename)
+
+import supybot.log
+import supybot.conf as conf
+import supybot.irclib as irclib
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import config
+import plugin
+
+# Each is run in turn; anything not given is left at its default.
+COMBINATIONS = [
+    ('default', {}),
+    ('flushImmediately off', {'flushImmediately': False}),
+    ('rotateLogs off', {'rotateLogs': False}),
+    ('both off', {'flushImmediately': False, 'rotateLogs': False}),
+    ('groupCommit', {'groupCommit': True}),
+    ('asyncWriter', {'asyncWriter': True}),
+    ('netsplit', {'netsplit': True}),
+    ('log only', {'formats': ['log']}),
+]
+
+URLS = ['http://musicbrainz.org/release/%d' % i for i in xrange(20)] + \
+       ['https://tickets.metabrainz.org/browse/MBS-%d' % i for i in xrange(20)]
+
+class FakeIrc(object):
+    """Just enough of an irclib.Irc for the plugin."""
+    network = 'bench'
+    nick = 'bot'
+    prefix = 'bot!bot@bench.example.org'
+    def __init__(self):
+        self.state = irclib.IrcState()
+
+    def isChannel(self, s):
+        return ircutils.isChannel(s)
+
+    def getRealIrc(self):
+        return self
+
+    def queueMsg(self, msg):
+        pass
+
+    def sendMsg(self, msg):
+        pass
+
+def synthetic(count, channels=20, nicks=500, seed=0):
+    """Returns a list of (outgoing, msg) for a stream of count messages."""
+    rand = random.Random(seed)
+    channels = ['#channel%d' % i for i in xrange(channels)]
+    nicks = ['user%d' % i for i in xrange(nicks)]
+    members = dict([(nick, rand.sample(channels, 3)) for nick in nicks])
+    stream = []
+    for channel in channels:
+        names = [nick for nick in nicks if channel in members[nick]]
+        stream.append((False, ircmsgs.IrcMsg(prefix='server.example.org',
+            command='353', args=('bot', '=', channel, ' '.join(names)))))
+    def prefix(nick):
+        return '%s!%s@example.org' % (nick, nick)
+    def chatter(n):
+        for _ in xrange(n):
+            nick = rand.choice(nicks)
+            channel = rand.choice(members[nick])
+            r = rand.random()
+            if r < 0.05:
+                msg = ircmsgs.action(channel, 'waves at everyone')
+            elif r < 0.15:
+                msg = ircmsgs.privmsg(channel, 'see %s and %s (or %s)' %
+                                      tuple(rand.sample(URLS, 3)))
+            elif r < 0.20:
+                stream.append((True, ircmsgs.privmsg(channel,
+                    '%s: The operation succeeded.' % nick)))
+                continue
+            else:
+                msg = ircmsgs.privmsg(channel, 'just chatting about releases, '
+                                      'recordings and the release editor')
+            stream.append((False, ircmsgs.IrcMsg(msg=msg,
+                                                 prefix=prefix(nick))))
+    def storm(n):
+        channel = rand.choice(channels)
+        for i in xrange(n):
+            nick = 'guest%d' % i
+            stream.append((False, ircmsgs.join(channel, prefix=prefix(nick))))
+            stream.append((False, ircmsgs.part(channel, 'flood',
+                                               prefix=prefix(nick))))
+    def netsplit(n):
+        split = rand.sample(nicks, n)
+        for nick in split:
+            stream.append((False, ircmsgs.IrcMsg(prefix=prefix(nick),
+                command='QUIT', args=('hub.example.org leaf.example.org',))))
+        for nick in split:
+            for channel in members[nick]:
+                stream.append((False, ircmsgs.join(channel,
+                                                   prefix=prefix(nick))))
+    while len(stream) < count:
+        chatter(2000)
+        storm(200)
+        chatter(2000)
+        netsplit(100)
+    return stream[:count]
+
+def recorded(path):
+    """Returns a list of (outgoing, msg) for the raw IRC lines in path."""
+    stream = []
+    with open(path) as fd:
+        for line in fd:
+            line = line.strip()
+            if line:
+                stream.append((False, ircmsgs.IrcMsg(line)))
+    return stream
+
+def writeSyscalls():
+    try:
+        with open('/proc/self/io') as fd:
+            for line in fd:
+                if line.startswith('syscw:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def percentile(sorted, p):
+    return sorted[min(len(sorted) - 1, int(len(sorted) * p))]
+
+def replay(stream, settings):
+    """Replays stream with settings, and returns (messages per second, p50,
+    p99, write syscalls)."""
+    group = conf.supybot.plugins.MBChannelLogger
+    logDir = tempfile.mkdtemp(prefix='mbchannellogger-bench-logs-')
+    conf.supybot.directories.log.setValue(logDir)
+    for (name, value) in settings.iteritems():
+        group.get(name).setValue(value)
+    irc = FakeIrc()
+    try:
+        cb = plugin.Class(irc)
+        latencies = []
+        writes = writeSyscalls()
+        start = time.time()
+        for (outgoing, msg) in stream:
+            before = time.time()
+            if outgoing:
+                cb.outFilter(irc, msg)
+            else:
+                cb(irc, msg)
+            latencies.append(time.time() - before)
+        # Everything written so far has to reach the files too.  The plugin
+        # isn't being reloaded, so die() closes the logs rather than leaving
+        # them for the next combination to take over.
+        cb.die()
+        elapsed = time.time() - start
+        if writes is not None:
+            writes = writeSyscalls() - writes
+    finally:
+        for name in settings:
+            node = group.get(name)
+            node.setValue(node._default)
+        shutil.rmtree(logDir)
+    latencies.sort()
+    return (len(stream) / elapsed, percentile(latencies, 0.5),
+            percentile(latencies, 0.99), writes)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n MESSAGES] [-f FILE]')
+    parser.add_option('-n', '--messages', type='int', default=50000,
+                      help='length of the synthetic stream')
+    parser.add_option('-f', '--file',
+                      help='replay the raw IRC lines in FILE instead')
+    (options, args) = parser.parse_args()
+    if options.file:
+        stream = recorded(options.file)
+    else:
+        stream = synthetic(options.messages)
+    try:
+        print 'replaying %d messages' % len(stream)
+        print '%-34s %10s %9s %9s %9s' % ('settings', 'msgs/s', 'p50 us',
+                                          'p99 us', 'writes')
+        for (name, settings) in COMBINATIONS:
+            (rate, p50, p99, writes) = replay(stream, settings)
+            if writes is None:
+                writes = 'n/a'
+            print '%-34s %10.0f %9.1f %9.1f %9s' % (name, rate, p50 * 1e6,
+                                                    p99 * 1e6, writes)
+    finally:
+        shutil.rmtree(confDir)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
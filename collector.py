@@ -0,0 +1,354 @@
+"""
+A log collector shared by several bots on the same machine.
+
+With supybot.plugins.MBChannelLogger.collector set to the path of its Unix
+socket, the plugin sends each event it logs to the collector as a JSON
+datagram instead of writing it itself.  The collector owns the logs of every
+network: it rotates them, keeps their files open in a pool, and reads every
+datagram waiting before writing, so each log gets one write per batch.  An
+event seen by more than one bot, because they share a channel, is only
+logged once.
+
+The logs are laid out as the plugin lays them out by default, under
+LOGDIR/network/channel/, in a directory per --directory-timestamp period,
+one file per channel, day (--filename-timestamp) and format:
+
+    python collector.py [--socket PATH] --timestamp-format FORMAT \\
+                        [--filename-timestamp FORMAT] \\
+                        [--directory-timestamp FORMAT] [--css URL] LOGDIR
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import optparse
+import traceback
+import collections
+
+import events
+import archive
+import logfiles
+import rotation
+import timestamps
+
+# How far apart in time two bots' copies of an event can be.
+DEDUP_WINDOW = 10
+
+# The most datagrams read before the logs they went to are written.
+MAX_BATCH = 1024
+
+# IRC lines are at most 512 bytes, so this is plenty for any event.
+MAX_DATAGRAM = 65536
+
+# How long the collector waits for datagrams before checking whether it's
+# been told to stop.
+POLL_TIMEOUT = 1.0
+
+FIELDS = ('type', 'nick', 'channel', 'text', 'target', 'time', 'network')
+
+def encode(bot, log, event, settings):
+    """Returns the datagram for event, logged to channel log by bot (any
+    string that tells it from other bots), with the ChannelSettings of the
+    channel.
+
+    IRC doesn't say what encoding text is in; anything that isn't valid UTF-8
+    is taken to be Latin-1, as with the jsonl format.
+    """
+    d = {
+        'bot': bot,
+        'log': log,
+        'formats': list(settings['formats']),
+        'timestamp': settings['timestamp'],
+        'stripFormatting': settings['stripFormatting'],
+    }
+    for field in FIELDS:
+        d[field] = getattr(event, field)
+    try:
+        return json.dumps(d)
+    except UnicodeDecodeError:
+        return json.dumps(d, encoding='latin-1')
+
+def decode(data):
+    """Returns (bot, log, event, settings) for a datagram from encode()."""
+    d = json.loads(data, object_hook=archive.utf8)
+    event = events.LogEvent(**dict([(field, d[field]) for field in FIELDS]))
+    settings = {
+        'formats': [str(fmt) for fmt in d['formats']],
+        'timestamp': d['timestamp'],
+        'stripFormatting': d['stripFormatting'],
+    }
+    return (d['bot'], d['log'], event, settings)
+
+class Client(object):
+    """Sends events to the collector listening on the socket at path.
+
+    The socket never blocks: send() raises socket.error if the collector
+    isn't there or has fallen too far behind to take any more, so the caller
+    can log the event itself instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, data):
+        self.sock.sendto(data, self.path)
+
+    def close(self):
+        self.sock.close()
+
+class Dedup(object):
+    """Recognizes events another bot has already sent.
+
+    Each bot's copies of an event are counted separately, so a line that
+    really was said twice is still logged twice: a copy is only a duplicate
+    if another bot has sent more copies of it than its own bot has.  Copies
+    are forgotten window seconds after the first of them.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.seen = collections.OrderedDict()
+
+    def isDuplicate(self, bot, key, now):
+        self.expire(now)
+        try:
+            (first, copies) = self.seen[key]
+        except KeyError:
+            self.seen[key] = (now, {bot: 1})
+            return False
+        most = max(copies.itervalues())
+        mine = copies.get(bot, 0)
+        copies[bot] = mine + 1
+        return mine < most
+
+    def expire(self, now):
+        while self.seen:
+            (key, (first, _)) = next(self.seen.iteritems())
+            if first >= now - self.window:
+                break
+            del self.seen[key]
+
+    def __len__(self):
+        return len(self.seen)
+
+def listen(path):
+    """Returns a non-blocking datagram socket bound to path, replacing any
+    socket left there by a collector that didn't stop cleanly."""
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.setblocking(False)
+    return sock
+
+class Collector(object):
+    """Writes the events sent to it into the logs under root."""
+    def __init__(self, root, timestampFormat, filenameTimestamp,
+                 directoryTimestamp, css, maxOpen=100):
+        self.root = root
+        self.timestampFormat = timestampFormat
+        self.filenameTimestamp = filenameTimestamp
+        self.directoryTimestamp = directoryTimestamp
+        self.css = css
+        self.pool = logfiles.LogPool(maxOpen)
+        self.directories = logfiles.DirectoryResolver()
+        self.stamp = timestamps.Timestamps()
+        self.dedup = Dedup(DEDUP_WINDOW)
+        self.logs = {}
+        self.rotations = {}
+        self.written = set()
+        self.events = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.failures = 0
+        self.stopped = False
+
+    def poll(self, sock, timeout=POLL_TIMEOUT):
+        """Waits up to timeout seconds for datagrams on sock, then logs every
+        one waiting (up to MAX_BATCH) and writes the logs they went to.
+        Returns how many there were."""
+        try:
+            (readable, _, _) = select.select([sock], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return 0
+            raise
+        if not readable:
+            return 0
+        n = 0
+        while n < MAX_BATCH:
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            try:
+                self.handle(data)
+            except Exception:
+                self.report('logging an event')
+            n += 1
+        self.flush()
+        return n
+
+    def serve(self, path):
+        """Logs what's sent to the socket at path until stop() is called."""
+        sock = listen(path)
+        try:
+            while not self.stopped:
+                self.poll(sock)
+        finally:
+            sock.close()
+            os.remove(path)
+            self.close()
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def handle(self, data):
+        try:
+            (bot, log, event, settings) = decode(data)
+        except (ValueError, KeyError, TypeError):
+            self.errors += 1
+            return
+        key = (event.network, log, event.type, event.nick, event.text,
+               event.target)
+        if self.dedup.isDuplicate(bot, key, event.time):
+            self.duplicates += 1
+            return
+        self.events += 1
+        stamp = None
+        if settings['timestamp'] and self.timestampFormat:
+            stamp = self.stamp
+            stamp.update(event.time, self.timestampFormat)
+        for formatter in events.formatters:
+            if formatter.fmt in settings['formats']:
+                f = self.getLog(event.network, log, formatter.fmt, event.time)
+                if stamp is not None and f.lineIds is not None:
+                    stamp.nextLine(f.lineIds)
+                f.write(formatter.render(event, log, stamp, settings))
+                self.written.add(f)
+
+    def getLog(self, network, channel, fmt, now):
+        key = (network, channel)
+        (start, deadline) = self.rotations.get(key, (0, 0))
+        if now >= deadline:
+            self.rotate(key, now)
+        else:
+            # A late event goes in the current logs, not rotated ones.
+            now = max(now, start)
+        logs = self.logs.setdefault(key, {})
+        try:
+            return logs[fmt]
+        except KeyError:
+            pass
+        directory = self.directories.resolve(
+            os.path.join(self.root, network, channel),
+            self.directoryTimestamp, now)
+        date = time.strftime(self.filenameTimestamp, time.gmtime(now))
+        path = os.path.join(directory, '%s.%s.%s' % (channel, date, fmt))
+        writeHtml = False
+        if fmt == 'html':
+            try:
+                writeHtml = not logfiles.hasHtmlStart(path)
+            except IOError:
+                writeHtml = True
+        log = logfiles.LogFile(path, self.pool)
+        if fmt == 'html':
+            log.lineIds = timestamps.LineIds(path)
+        if writeHtml:
+            log.write(events.htmlStart(channel, date, self.css))
+        logs[fmt] = log
+        return log
+
+    def rotate(self, key, now):
+        """Closes the logs of the channel key is for, if their period is
+        over."""
+        date = time.strftime(self.filenameTimestamp, time.gmtime(now))
+        logs = self.logs.get(key, {})
+        for (fmt, log) in logs.items():
+            if not os.path.basename(log.name).endswith('.%s.%s' % (date, fmt)):
+                if fmt == 'html':
+                    log.write(events.htmlEnd())
+                log.close()
+                self.written.discard(log)
+                del logs[fmt]
+        deadline = rotation.nextBoundary(self.filenameTimestamp, now)
+        self.rotations[key] = (
+            deadline - rotation.granularity(self.filenameTimestamp), deadline)
+
+    def flush(self):
+        for log in self.written:
+            try:
+                log.flush()
+            except Exception:
+                self.report('writing %s' % log.name)
+        self.written.clear()
+
+    def report(self, what):
+        """Prints the exception being handled, which happened while doing
+        what, so the collector carries on logging for the other bots."""
+        self.failures += 1
+        print >>sys.stderr, 'Error %s:' % what
+        traceback.print_exc()
+
+    def close(self):
+        for logs in self.logs.itervalues():
+            for log in logs.itervalues():
+                log.close()
+        self.logs.clear()
+        self.written.clear()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] LOGDIR')
+    parser.add_option('--socket', default='MBChannelLogger.sock',
+                      help='the Unix socket to listen on, which the bots\' '
+                      'collector setting names (default: %default)')
+    parser.add_option('--timestamp-format',
+                      help='timestamp format of the lines, as the bots\' '
+                      'supybot.log.timestampFormat, which is '
+                      '%Y-%m-%dT%H:%M:%S unless it\'s been changed '
+                      '(required)')
+    parser.add_option('--filename-timestamp', default='%Y-%m-%d',
+                      help='timestamp in the log names, as filenameTimestamp '
+                      '(default: %default)')
+    parser.add_option('--directory-timestamp', default='%Y-%m',
+                      help='timestamp of the directories the logs are in, '
+                      'as directories.timestamp.format, or \'\' for none '
+                      '(default: %default)')
+    parser.add_option('--css',
+                      default='../../../../../plugins/MBChannelLogger/misc/'
+                      'style.css',
+                      help='cssLocation for the HTML (default: %default)')
+    parser.add_option('--max-open', type='int', default=100,
+                      help='the most log files to keep open (default: '
+                      '%default)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('wrong number of arguments')
+    if options.timestamp_format is None:
+        parser.error('--timestamp-format is required')
+    collector = Collector(args[0], options.timestamp_format,
+                          options.filename_timestamp,
+                          options.directory_timestamp or None, options.css,
+                          options.max_open)
+    signal.signal(signal.SIGTERM, collector.stop)
+    signal.signal(signal.SIGINT, collector.stop)
+    collector.serve(options.socket)
+    print >>sys.stderr, ('Logged %s events (%s duplicates, %s unreadable, '
+                         '%s errors).' %
+                         (collector.events, collector.duplicates,
+                          collector.errors, collector.failures))
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -43,14 +43,79 @@ def configure(advanced):
 
 MBChannelLogger = conf.registerPlugin('MBChannelLogger')
 conf.registerChannelValue(MBChannelLogger, 'enable',
-    registry.Boolean(True, """Determines whether logging is enabled."""))
+    registry.Boolean(True, """Determines whether logging is enabled.  Like the
+    plugin's other settings, it's read once and checked for changes every ten
+    seconds, so a change can take that long to apply.  The off command stops
+    logging straight away."""))
+conf.registerChannelValue(MBChannelLogger, 'formats',
+    registry.SpaceSeparatedListOfStrings(['log', 'html'], """Determines which
+    formats the channel is logged in.  'log' is plain text, 'html' is HTML and
+    'jsonl' is one JSON object per line, for other programs to read.  Each
+    format is written to its own logfile, with the format as its
+    extension."""))
 conf.registerGlobalValue(MBChannelLogger, 'flushImmediately',
     registry.Boolean(True, """Determines whether channel logfiles will be
     flushed anytime they're written to, rather than being buffered by the
     operating system."""))
+conf.registerGlobalValue(MBChannelLogger, 'groupCommit',
+    registry.Boolean(False, """Determines whether writes to all channel
+    logfiles are collected in memory and flushed together, once
+    supybot.plugins.MBChannelLogger.groupCommit.maxBytes have been written or
+    supybot.plugins.MBChannelLogger.groupCommit.maxDelay has passed, whichever
+    comes first.  If this is enabled, flushImmediately is ignored."""))
+conf.registerGlobalValue(MBChannelLogger.groupCommit, 'maxBytes',
+    registry.PositiveInteger(65536, """Determines how many bytes may be
+    waiting to be written before the logfiles are flushed."""))
+conf.registerGlobalValue(MBChannelLogger.groupCommit, 'maxDelay',
+    registry.PositiveInteger(500, """Determines how many milliseconds a
+    write may wait before the logfiles are flushed.  Unless
+    supybot.plugins.MBChannelLogger.asyncWriter is enabled, the flush is
+    left to supybot's scheduler, which only runs as often as
+    supybot.drivers.poll (1 second by default), so a write may wait up to
+    that long."""))
+conf.registerGlobalValue(MBChannelLogger.groupCommit, 'fsync',
+    registry.Boolean(False, """Determines whether each flush of the logfiles
+    is followed by an fsync, so that the batch is on disk rather than just
+    handed to the operating system."""))
+conf.registerGlobalValue(MBChannelLogger, 'asyncWriter',
+    registry.Boolean(False, """Determines whether channel logfiles are
+    written by a separate thread, so that a slow disk never holds up the rest
+    of the bot.  Messages are queued for the writer in the meantime."""))
+conf.registerGlobalValue(MBChannelLogger.asyncWriter, 'queueSize',
+    registry.PositiveInteger(10000, """Determines how many messages may be
+    waiting for the writer thread before
+    supybot.plugins.MBChannelLogger.asyncWriter.backpressure applies."""))
+class Backpressure(registry.OnlySomeStrings):
+    validStrings = ('block', 'dropOldest', 'spill')
+conf.registerGlobalValue(MBChannelLogger.asyncWriter, 'backpressure',
+    Backpressure('block', """Determines what happens to a message when the
+    writer thread's queue is full: 'block' waits for the writer to catch up,
+    'dropOldest' throws away the oldest queued message, and 'spill' queues it
+    anyway, letting the queue grow in memory."""))
+conf.registerGlobalValue(MBChannelLogger, 'collector',
+    registry.String('', """Determines the Unix socket of the log collector
+    (collector.py) that the bot sends what it logs to, instead of writing the
+    logs itself.  The collector writes the logs of every bot using it, and
+    logs events more than one of them saw only once.  If this is empty, or
+    the collector isn't running, the bot writes its own logs.  The search
+    index, archive pages and line indexes are only kept for logs the bot
+    writes itself."""))
+conf.registerGlobalValue(MBChannelLogger, 'maxOpenLogs',
+    registry.PositiveInteger(500, """Determines how many channel logfiles the
+    bot will keep open at once.  When more are needed, the one written least
+    recently is closed, and it's reopened the next time it's written to."""))
+conf.registerGlobalValue(MBChannelLogger, 'netsplit',
+    registry.Boolean(False, """Determines whether the quits and rejoins of
+    a netsplit are logged as a single line per channel, saying how many
+    users quit or rejoined, rather than a line for each user."""))
+conf.registerGlobalValue(MBChannelLogger.netsplit, 'window',
+    registry.PositiveInteger(10, """Determines how many seconds of quits or
+    rejoins are collected into each netsplit line."""))
 conf.registerChannelValue(MBChannelLogger, 'stripFormatting',
     registry.Boolean(True, """Determines whether formatting characters (such
-    as bolding, color, etc.) are removed when writing the logs to disk."""))
+    as bolding, color, etc.) are removed when writing the text logs to disk.
+    HTML logs always show the formatting, and jsonl logs always keep it as
+    it was sent."""))
 conf.registerChannelValue(MBChannelLogger, 'timestamp',
     registry.Boolean(True, """Determines whether the logs for this channel are
     timestamped with the timestamp in supybot.log.timestampFormat."""))
@@ -70,6 +135,28 @@ conf.registerChannelValue(MBChannelLogger, 'filenameTimestamp',
     for the timestamp are in the time.strftime docs at python.org.  In order
     for your logs to be rotated, you'll also have to enable
     supybot.plugins.MBChannelLogger.rotateLogs."""))
+class Compression(registry.OnlySomeStrings):
+    validStrings = ('none', 'gzip', 'zstd')
+conf.registerGlobalValue(MBChannelLogger, 'compression',
+    Compression('none', """Determines how logfiles are compressed once they
+    have been rotated: 'none' leaves them as they are, and 'gzip' and 'zstd'
+    compress them in the background.  zstd needs the zstandard module; gzip
+    is used instead if it isn't installed."""))
+conf.registerGlobalValue(MBChannelLogger.compression, 'formats',
+    registry.SpaceSeparatedListOfStrings(['log'], """Determines which
+    formats of logfile are compressed when they are rotated."""))
+conf.registerGlobalValue(MBChannelLogger, 'lineIndex',
+    registry.Boolean(False, """Determines whether the bot keeps an index of
+    where every so many lines start next to each logfile, in a file named
+    after it with '.idx' on the end.  The last and around commands need one
+    for the 'log' format."""))
+conf.registerGlobalValue(MBChannelLogger.lineIndex, 'every',
+    registry.PositiveInteger(16, """Determines how many lines apart the lines
+    recorded in line indexes are.  Fewer makes the around command more
+    precise and the last command read less, for a larger index."""))
+conf.registerGlobalValue(MBChannelLogger.lineIndex, 'formats',
+    registry.SpaceSeparatedListOfStrings(['log'], """Determines which
+    formats of logfile have a line index."""))
 
 conf.registerGlobalValue(MBChannelLogger, 'directories',
     registry.Boolean(True, """Determines whether the bot will partition its
@@ -88,6 +175,63 @@ conf.registerGlobalValue(MBChannelLogger.directories.timestamp, 'format',
     registry.String('%Y-%m', """Determines what timestamp format will be used in
     the directory structure for channel logs if
     supybot.plugins.MBChannelLogger.directories.timestamp is True."""))
+conf.registerChannelValue(MBChannelLogger.directories, 'retention',
+    registry.NonNegativeInteger(0, """Determines how many days the channel's
+    logs are kept after they're rotated before they're deleted, along with
+    their line indexes.  0 keeps them forever."""))
+conf.registerGlobalValue(MBChannelLogger.directories, 'quota',
+    registry.NonNegativeInteger(0, """Determines how many megabytes the
+    rotated logs of every channel may take up in all.  When they take up
+    more, the oldest are compressed (see
+    supybot.plugins.MBChannelLogger.directories.quota.compress), then
+    deleted, until they fit.  0 means there's no quota."""))
+conf.registerGlobalValue(MBChannelLogger.directories.quota, 'compress',
+    registry.Boolean(True, """Determines whether the oldest rotated logs that
+    aren't compressed yet are compressed, with
+    supybot.plugins.MBChannelLogger.compression (or gzip if that's 'none'),
+    before any are deleted to keep to the quota."""))
+conf.registerGlobalValue(MBChannelLogger.directories, 'ledger',
+    registry.String('MBChannelLogger.ledger', """Determines the filename, in
+    the bot's data directory, of the ledger of rotated logs, their sizes and
+    when they were rotated, which retention and the quota are enforced from
+    without walking the log directory.  If empty, neither is enforced."""))
+conf.registerChannelValue(MBChannelLogger, 'archive',
+    registry.Boolean(False, """Determines whether the bot keeps archive pages
+    for the channel next to its logs: an index.html listing the months it
+    has been logged in, and a page for each month listing its days with how
+    many lines were logged and when.  The pages are updated when the logs
+    are rotated, so this needs rotateLogs."""))
+conf.registerChannelValue(MBChannelLogger, 'search',
+    registry.Boolean(False, """Determines whether lines logged in the channel
+    are added to the full-text index used by the search command."""))
+conf.registerGlobalValue(MBChannelLogger.search, 'database',
+    registry.String('MBChannelLogger.search.db', """Determines the filename of
+    the SQLite database holding the search index, in the bot's data
+    directory."""))
+conf.registerChannelValue(MBChannelLogger.search, 'maxResults',
+    registry.PositiveInteger(5, """Determines how many lines the search
+    command returns at most."""))
+conf.registerChannelValue(MBChannelLogger.search, 'urlBase',
+    registry.String('', """Determines the URL the bot's log directory is
+    published at, e.g. 'https://example.org/logs/'.  If set, search results
+    link to the matching line in the HTML logs."""))
+conf.registerGlobalValue(MBChannelLogger, 'statsFile',
+    registry.String('MBChannelLogger.stats.json', """Determines the filename,
+    in the bot's data directory, that the plugin's counters and timings are
+    written to as JSON every
+    supybot.plugins.MBChannelLogger.statsFile.interval seconds.  If empty,
+    they're only available through the stats command."""))
+conf.registerGlobalValue(MBChannelLogger.statsFile, 'interval',
+    registry.PositiveInteger(60, """Determines how often, in seconds, the
+    stats file is written."""))
+conf.registerGlobalValue(MBChannelLogger, 'exports',
+    registry.String('MBChannelLogger.exports', """Determines the directory, in
+    the bot's data directory, that the export command writes its files
+    to."""))
+conf.registerGlobalValue(MBChannelLogger.exports, 'urlBase',
+    registry.String('', """Determines the URL the exports directory is served
+    at, which the export command replies with followed by the file's name.
+    If empty, it replies with the file's path instead."""))
 conf.registerGlobalValue(MBChannelLogger, 'cssLocation',
     registry.String('../../../../../plugins/MBChannelLogger/misc/style.css',
         """Defines the location for the log CSS file."""))
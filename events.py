@@ -0,0 +1,312 @@
+"""
+The things the plugin logs, and the formatters that turn them into lines.
+
+Each handler builds a single LogEvent for what happened, and every
+registered formatter renders it into a line for its own logfile.
+"""
+
+import re
+import cgi
+import time
+import json.encoder
+
+import supybot.ircutils as ircutils
+
+import ircformat
+
+class LogEvent(object):
+    """Something that happened in a channel.
+
+    type is one of the keys of Formatter.templates.  nick is who did it, and
+    text is what they said, or their reason (for parts, quits and kicks; None
+    if they didn't give one) or mode arguments.  target is the new nick for
+    nick changes, the nick kicked for kicks and the modes set for mode
+    changes.  time is when the bot saw the message, in seconds since the
+    epoch, and network is the network it came from.
+
+    The 'netsplit' and 'netjoin' summaries have no nick; their text is the
+    two servers that split and their target the nicks that quit or rejoined,
+    separated by spaces.  A summary read back from a text log, which only
+    says how many nicks there were, has that as its count and no target.
+    """
+    __slots__ = ('type', 'nick', 'channel', 'text', 'target', 'time',
+                 'network', 'count')
+    def __init__(self, type, nick, channel=None, text=None, target=None,
+                 time=None, network=None, count=None):
+        self.type = type
+        self.nick = nick
+        self.channel = channel
+        self.text = text
+        self.target = target
+        self.time = time
+        self.network = network
+        self.count = count
+
+    def __repr__(self):
+        return '%s(%r, %r, %r, %r, %r, %r, %r)' % (self.__class__.__name__,
+                                                   self.type, self.nick,
+                                                   self.channel, self.text,
+                                                   self.target, self.time,
+                                                   self.network)
+
+def htmlStart(channel, date, css):
+    """HTML to write at the start of individual log files."""
+    title = 'IRC log of {channel} on {date}'.format(**{
+        'channel': channel,
+        'date': date,
+    })
+    html = """<!DOCTYPE html>
+    <html>
+    <head>
+     <title>{title}</title>
+     <!-- TODO: Fix the path to the stylesheet (in case the below doesn't work. -->
+     <link rel="stylesheet" href="{css}" type="text/css" />
+     <meta http-equiv="content-type" content="text/html; charset=utf-8" />
+    </head>
+    <body>
+    <h1>{title}</h1>
+    <p>Timestamps are in UTC.</p>
+    """.format(title = title, css=css)
+    return '\n'.join([line.strip() for line in html.split('\n')])
+
+def htmlEnd():
+    """HTML to write at the end of individual log files."""
+    html = """
+    </body>
+    </html>
+    """
+    return '\n'.join([line.strip() for line in html.split('\n')])
+
+def users(event):
+    """Returns how many nicks a netsplit or netjoin summary is about, as
+    '1 user' or 'n users'."""
+    if event.target is None:
+        n = event.count
+    else:
+        n = event.target.count(' ') + 1
+    if n == 1:
+        return '1 user'
+    return '%s users' % n
+
+def reason(text):
+    """Returns the parenthesised reason for text, or '' if there's none."""
+    if text is None:
+        return ''
+    return ' (%s)' % text
+
+class Formatter(object):
+    """Renders LogEvents into the lines of one kind of logfile.
+
+    fmt is both the name of the format and the extension of its logfiles.
+    render() is given the event, the channel whose log it's for, the
+    plugin's Timestamps already updated for the event's time and line (or
+    None if lines aren't timestamped) and the ChannelSettings of the
+    channel, and returns the whole line.
+    """
+    fmt = None
+    templates = {}
+    def render(self, event, channel, stamp, settings):
+        raise NotImplementedError
+
+class TextFormatter(Formatter):
+    fmt = 'log'
+    templates = {
+        'privmsg': '<%(nick)s> %(text)s',
+        'action': '* %(nick)s %(text)s',
+        'notice': '-%(nick)s- %(text)s',
+        'nick': '*** %(nick)s is now known as %(target)s',
+        'join': '*** %(nick)s has joined %(channel)s',
+        'kick': '*** %(target)s was kicked by %(nick)s%(reason)s',
+        'part': '*** %(nick)s has left %(channel)s%(reason)s',
+        'mode': '*** %(nick)s sets mode: %(target)s %(text)s',
+        'topic': '*** %(nick)s changes topic to "%(text)s"',
+        'quit': '*** %(nick)s has quit IRC%(reason)s',
+        'netsplit': '*** %(users)s quit (netsplit: %(text)s)',
+        'netjoin': '*** %(users)s rejoined (netjoin: %(text)s)',
+    }
+    # The summaries of netsplits, which need the number of nicks.
+    summaries = ('netsplit', 'netjoin')
+
+    # The templates, read backwards.  The ones starting with *** come before
+    # actions so they aren't mistaken for a nick starting with **.
+    parsers = [(type, re.compile(regexp)) for (type, regexp) in [
+        ('privmsg', r'^<(?P<nick>[^>]*)> (?P<text>.*)$'),
+        ('notice', r'^-(?P<nick>\S+?)- (?P<text>.*)$'),
+        ('nick', r'^\*\*\* (?P<nick>\S+) is now known as (?P<target>\S+)$'),
+        ('join', r'^\*\*\* (?P<nick>\S+) has joined (?P<channel>\S+)$'),
+        ('kick', r'^\*\*\* (?P<target>\S+) was kicked by (?P<nick>\S+)'
+                 r'(?: \((?P<text>.*)\))?$'),
+        ('part', r'^\*\*\* (?P<nick>\S+) has left (?P<channel>\S+)'
+                 r'(?: \((?P<text>.*)\))?$'),
+        ('mode', r'^\*\*\* (?P<nick>\S+) sets mode: (?P<target>\S+) '
+                 r'(?P<text>.*)$'),
+        ('topic', r'^\*\*\* (?P<nick>\S+) changes topic to "(?P<text>.*)"$'),
+        ('quit', r'^\*\*\* (?P<nick>\S+) has quit IRC(?: \((?P<text>.*)\))?$'),
+        ('netsplit', r'^\*\*\* (?P<count>\d+) users? quit '
+                     r'\(netsplit: (?P<text>.*)\)$'),
+        ('netjoin', r'^\*\*\* (?P<count>\d+) users? rejoined '
+                    r'\(netjoin: (?P<text>.*)\)$'),
+        ('action', r'^\* (?P<nick>\S+) (?P<text>.*)$'),
+    ]]
+
+    def parse(self, s, when=None):
+        """Returns the LogEvent a line rendered without a timestamp came
+        from, or None if it doesn't look like any of the templates."""
+        for (type, regexp) in self.parsers:
+            m = regexp.match(s)
+            if m is not None:
+                fields = m.groupdict()
+                if 'count' in fields:
+                    fields['count'] = int(fields['count'])
+                return LogEvent(type, fields.pop('nick', None), time=when,
+                                **fields)
+        return None
+
+    def render(self, event, channel, stamp, settings):
+        fields = {
+            'nick': event.nick,
+            'channel': event.channel,
+            'text': event.text,
+            'target': event.target,
+            'reason': reason(event.text),
+        }
+        if event.type in self.summaries:
+            fields['users'] = users(event)
+        s = self.templates[event.type] % fields
+        if settings['stripFormatting']:
+            s = ircutils.stripFormatting(s)
+        if stamp is not None:
+            s = '%s  %s' % (stamp.text, s)
+        return s + '\n'
+
+class HtmlFormatter(Formatter):
+    fmt = 'html'
+    templates = {
+        'privmsg': '<span><span class="nick">&lt;%(nick)s&gt;</span> '
+                   '%(text)s</span>',
+        'action': '<span>&bull; <span class="nick">%(nick)s</span> '
+                  '%(text)s</span>',
+        'notice': '<span><span class="nick">-%(nick)s-</span> %(text)s</span>',
+        'nick': '<span>&bull;&bull;&bull; <span class="nick">%(nick)s</span> '
+                'is now known as <span class="nick">%(target)s</span></span>',
+        'join': '<span>&rarr; <span class="nick">%(nick)s</span> has joined '
+                '<span class="channel">%(channel)s</span></span>',
+        'kick': '<span>&larr; <span class="nick">%(target)s</span> was kicked '
+                'by <span class="nick">%(nick)s</span>%(kickmessage)s</span>',
+        'part': '<span>&larr; <span class="nick">%(nick)s</span> has left '
+                '<span class="channel">%(channel)s</span>'
+                '<span class="reason">%(reason)s</span></span>',
+        'mode': '<span>&bull;&bull;&bull; <span class="nick">%(nick)s</span> '
+                'sets mode: <span class="channel">%(target)s</span> '
+                '<span class="modes">%(text)s</span></span>',
+        'topic': '<span>&bull;&bull;&bull; <span class="nick">%(nick)s</span> '
+                 'changes topic to <span class="topic">"%(text)s"</span>'
+                 '</span>',
+        'quit': '<span>&larr; <span class="nick">%(nick)s</span> has quit IRC'
+                '<span class="reason">%(reason)s</span></span>',
+        'netsplit': '<span>&larr; <span class="nick" title="%(target)s">'
+                    '%(users)s</span> quit <span class="reason">'
+                    '(netsplit: %(text)s)</span></span>',
+        'netjoin': '<span>&rarr; <span class="nick" title="%(target)s">'
+                   '%(users)s</span> rejoined <span class="reason">'
+                   '(netjoin: %(text)s)</span></span>',
+    }
+    classes = {
+        'privmsg': 'privmsg',
+        'action': 'action privmsg',
+        'notice': 'notice',
+        'nick': 'nickchange',
+        'join': 'join',
+        'kick': 'kick',
+        'part': 'part',
+        'mode': 'modechange',
+        'topic': 'topicchange',
+        'quit': 'quit',
+        'netsplit': 'quit netsplit',
+        'netjoin': 'join netjoin',
+    }
+    # Events whose text is never linkified.
+    plain = ('mode', 'netsplit', 'netjoin')
+
+    def text(self, event, s):
+        return ircformat.toHtml(s, event.type not in self.plain)
+
+    def render(self, event, channel, stamp, settings):
+        fields = {
+            'nick': cgi.escape(event.nick or ''),
+            'channel': cgi.escape(event.channel or ''),
+            'target': cgi.escape(event.target or ''),
+            'text': '',
+            'reason': '',
+            'kickmessage': '',
+        }
+        if event.type in TextFormatter.summaries:
+            fields['users'] = users(event)
+        if event.text is not None:
+            if event.type == 'kick':
+                fields['kickmessage'] = (' <span class="kickmessage">(%s)'
+                                         '</span>' % self.text(event,
+                                                               event.text))
+            elif event.type in ('part', 'quit'):
+                fields['reason'] = self.text(event, reason(event.text))
+            else:
+                fields['text'] = self.text(event, event.text)
+        # Formatting is always kept in HTML, as spans; stripFormatting is
+        # only for the logs it can't be shown in.
+        s = self.templates[event.type] % fields
+        if stamp is not None:
+            s = ('<a id="%s" href="#%s" class="timestamp" title="%s">%s</a> %s'
+                 % (stamp.lineid, stamp.lineid, stamp.text, stamp.clock, s))
+        return '<p class="%s">%s</p>\n' % (self.classes[event.type], s)
+
+def jsonString(s):
+    """Returns s as a JSON string, or null if it's None.
+
+    IRC doesn't say what encoding text is in; anything that isn't valid UTF-8
+    is taken to be Latin-1, as most clients do.
+    """
+    if s is None:
+        return 'null'
+    try:
+        return json.encoder.encode_basestring_ascii(s)
+    except UnicodeDecodeError:
+        return json.encoder.encode_basestring_ascii(s.decode('latin-1'))
+
+class JsonFormatter(Formatter):
+    """Writes each event as a JSON object on a line of its own.
+
+    The text is the raw text of the message, formatting and all, and time is
+    in UTC, in ISO 8601 format.
+    """
+    fmt = 'jsonl'
+    template = ('{"type":%s,"time":"%s","network":%s,"channel":%s,'
+                '"nick":%s,"text":%s,"target":%s}\n')
+    def __init__(self):
+        self.second = None
+        self.isotime = None
+
+    def render(self, event, channel, stamp, settings):
+        second = int(event.time)
+        if second != self.second:
+            self.isotime = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                         time.gmtime(second))
+            self.second = second
+        return self.template % (jsonString(event.type), self.isotime,
+                                jsonString(event.network),
+                                jsonString(channel), jsonString(event.nick),
+                                jsonString(event.text),
+                                jsonString(event.target))
+
+formatters = []
+
+def registerFormatter(formatter):
+    """Adds formatter to those every event is rendered with."""
+    formatters[:] = [f for f in formatters if f.fmt != formatter.fmt]
+    formatters.append(formatter)
+
+text = TextFormatter()
+registerFormatter(text)
+registerFormatter(HtmlFormatter())
+registerFormatter(JsonFormatter())
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,236 @@
+"""
+Exports what was logged in a channel between two times.
+
+The logs covering the range are worked out from the channel's layout (its
+filenameTimestamp and directories.timestamp.format), so only those files are
+opened, and their lines go through a pipeline of generators: each log is
+read a line at a time, compressed or not, lines are kept from the first one
+logged at or after the start, and reading stops at the first one logged at
+or after the end.  Nothing more than a line is ever held in memory.  Lines
+without a timestamp are left out.
+
+The plugin's export command writes the result to a file; the same can be
+done from the command line, given the directory holding the channel's logs:
+
+    python export.py --timestamp-format FORMAT \\
+                     [--filename-timestamp FORMAT] \\
+                     [--directory-timestamp FORMAT] [--format FORMAT] \\
+                     [--css URL] [--output FILE] CHANNELDIR CHANNEL FROM TO
+
+FROM and TO are in UTC, as YYYY-MM-DD, YYYY-MM-DDTHH:MM or
+YYYY-MM-DDTHH:MM:SS (or with a space instead of the T).
+"""
+
+import os
+import sys
+import time
+import calendar
+import optparse
+
+import events
+import search
+import logfiles
+import rotation
+
+def parseTime(s, now=None):
+    """Returns the time s names, in UTC, or None if it doesn't name one.
+
+    s is YYYY-MM-DD, or that followed by a T or a space and HH:MM[:SS]; if
+    now is given, s can also be just HH:MM[:SS] on the day of now.
+    """
+    s = s.strip().replace(' ', 'T')
+    if now is not None and ':' in s and 'T' not in s:
+        s = time.strftime('%Y-%m-%dT', time.gmtime(now)) + s
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(s, format))
+        except ValueError:
+            continue
+    return None
+
+def findLogs(layout, start, end, step):
+    """Yields the files holding the logs from start to end, in order.
+
+    layout(t) returns the path a log for the time t was written as, and
+    step is how often that can change.  Logs that were never written are
+    skipped, and compressed ones found under their compressed names.
+    """
+    last = None
+    t = int(start) // step * step
+    while t < end:
+        path = layout(max(t, start))
+        if path != last:
+            last = path
+            found = logfiles.findLog(path)
+            if found is not None:
+                yield found
+        t += step
+
+def readLines(paths):
+    """Yields the lines of each file in paths in turn."""
+    for path in paths:
+        with logfiles.openLog(path) as fd:
+            for line in fd:
+                yield line
+
+def between(lines, start, end, timeOf):
+    """Yields the lines logged from start up to (but not including) end.
+
+    timeOf(line) returns when a line was logged, or None if it can't tell.
+    Logs are in time order, so the first line at or after end is the last
+    one read.
+    """
+    for line in lines:
+        when = timeOf(line)
+        if when is None:
+            continue
+        if when >= end:
+            break
+        if when >= start:
+            yield line
+
+class StampParser(object):
+    """Parses timestamps, remembering the last one, as consecutive lines
+    often share a second."""
+    def __init__(self, format):
+        self.format = format
+        self.stamp = None
+        self.when = None
+
+    def parse(self, stamp):
+        if stamp != self.stamp:
+            try:
+                self.when = calendar.timegm(time.strptime(stamp, self.format))
+            except ValueError:
+                self.when = None
+            self.stamp = stamp
+        return self.when
+
+def textTimes(timestampFormat):
+    """Returns timeOf() for text logs."""
+    parser = StampParser(timestampFormat)
+    def timeOf(line):
+        (stamp, sep, _) = line.partition('  ')
+        if not sep:
+            return None
+        return parser.parse(stamp)
+    return timeOf
+
+def jsonTimes(timestampFormat):
+    """Returns timeOf() for jsonl logs, which always have ISO 8601 times."""
+    parser = StampParser('%Y-%m-%dT%H:%M:%SZ')
+    def timeOf(line):
+        i = line.find('"time":"')
+        if i == -1:
+            return None
+        i += len('"time":"')
+        return parser.parse(line[i:line.find('"', i)])
+    return timeOf
+
+def htmlTimes(timestampFormat):
+    """Returns timeOf() for HTML logs, which is None for their headers."""
+    parser = StampParser(timestampFormat)
+    def timeOf(line):
+        m = search.line_re.match(line.rstrip('\r\n'))
+        if m is None:
+            return None
+        return parser.parse(search.unescape(m.group(2)))
+    return timeOf
+
+# What reads the times of the lines of each format.
+formats = {
+    'log': textTimes,
+    'jsonl': jsonTimes,
+    'html': htmlTimes,
+}
+
+def export(layout, step, start, end, fmt, timestampFormat):
+    """Yields the lines of the logs of format fmt from start up to end.
+
+    layout and step are as for findLogs(); timestampFormat is the format of
+    the lines' timestamps.
+    """
+    timeOf = formats[fmt](timestampFormat)
+    return between(readLines(findLogs(layout, start, end, step)), start, end,
+                   timeOf)
+
+def write(path, lines, header='', footer=''):
+    """Writes lines to the file at path, all at once when they're done.
+    Returns how many there were."""
+    count = 0
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        fd.write(header)
+        for line in lines:
+            fd.write(line)
+            count += 1
+        fd.write(footer)
+    os.rename(tmp, path)
+    return count
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] CHANNELDIR CHANNEL '
+                                         'FROM TO')
+    parser.add_option('--timestamp-format',
+                      help='supybot.log.timestampFormat of the logs, which '
+                      'is %Y-%m-%dT%H:%M:%S unless it\'s been changed '
+                      '(required)')
+    parser.add_option('--filename-timestamp', default='%Y-%m-%d',
+                      help='filenameTimestamp of the logs, or \'\' if they '
+                      'aren\'t rotated (default: %default)')
+    parser.add_option('--directory-timestamp', default='%Y-%m',
+                      help='directories.timestamp.format of the logs, or '
+                      '\'\' for none (default: %default)')
+    parser.add_option('--format', default='log', choices=sorted(formats),
+                      help='which logs to export: log, html or jsonl '
+                      '(default: %default)')
+    parser.add_option('--css',
+                      default='../../../../../plugins/MBChannelLogger/misc/'
+                      'style.css',
+                      help='cssLocation for HTML (default: %default)')
+    parser.add_option('-o', '--output',
+                      help='the file to write (default: standard output)')
+    (options, args) = parser.parse_args()
+    if len(args) != 4:
+        parser.error('wrong number of arguments')
+    if options.timestamp_format is None:
+        parser.error('--timestamp-format is required')
+    (directory, channel, fromTime, toTime) = args
+    (start, end) = (parseTime(fromTime), parseTime(toTime))
+    if start is None or end is None:
+        parser.error('FROM and TO must be YYYY-MM-DD[THH:MM[:SS]]')
+    nameFormat = options.filename_timestamp
+    dirFormat = options.directory_timestamp
+    def layout(t):
+        when = time.gmtime(t)
+        path = directory
+        if dirFormat:
+            path = os.path.join(path, time.strftime(dirFormat, when))
+        if nameFormat:
+            name = '%s.%s.%s' % (channel, time.strftime(nameFormat, when),
+                                 options.format)
+        else:
+            name = '%s.%s' % (channel, options.format)
+        return os.path.join(path, name)
+    step = min(rotation.granularity(nameFormat or ''),
+               rotation.granularity(dirFormat or ''))
+    lines = export(layout, step, start, end, options.format,
+                   options.timestamp_format)
+    (header, footer) = ('', '')
+    if options.format == 'html':
+        header = events.htmlStart(channel, '%s to %s' % (fromTime, toTime),
+                                  options.css)
+        footer = events.htmlEnd()
+    if options.output:
+        count = write(options.output, lines, header, footer)
+        print >>sys.stderr, 'Exported %s lines.' % count
+    else:
+        sys.stdout.write(header)
+        for line in lines:
+            sys.stdout.write(line)
+        sys.stdout.write(footer)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,79 @@
+"""
+Hands the plugin's open logs and state over to itself across a reload.
+
+Owner's reload command calls the reload() function of the plugin's module,
+plugin.reload(), before reloading it, and passes what that returns to the
+reload() of the reloaded package.  Only then does it call the old
+instance's die() and create the new instance.  plugin.reload() returns an
+empty Handoff, which the package's reload() passes to expect().  Rather
+than close every logfile only for the new instance to reopen them, with the
+header checks and directory creation that costs, die() sees the Handoff is
+expected and leaves what it has in it, and the new instance takes it over:
+open files and their unwritten buffers, who's in which channel, netsplits
+being collected, archive counts and the ledger of rotated logs.  When the
+plugin is unloaded, or the bot quits, nothing is expected, so die() closes
+everything itself.
+"""
+
+# Changed whenever the shape of what's handed over changes, so state is only
+# ever taken over by code that understands it.
+VERSION = 5
+
+class Handoff(object):
+    """What an instance being reloaded leaves for the next one, and the
+    function closing it if the next one can't take it.
+
+    It's created by the code being reloaded, so version is the VERSION of
+    the code that leaves the state, whatever has been reloaded since.
+    """
+    def __init__(self):
+        self.version = VERSION
+        self.state = None
+        self.close = None
+
+# The Handoff the instance being reloaded leaves its state in.
+expected = None
+
+def expect(handoff):
+    """Makes die() leave the instance's state in handoff."""
+    global expected
+    expected = handoff
+
+def isExpected():
+    """Returns whether the instance dying is being reloaded."""
+    return expected is not None and expected.state is None
+
+def leave(state, close):
+    """Leaves state for the next instance of the plugin, to be closed with
+    close() if it can't take it."""
+    expected.state = state
+    expected.close = close
+
+def take():
+    """Returns the state left by the previous instance, or None if there
+    isn't any.  State left by a different version is closed instead."""
+    global expected
+    handoff = expected
+    expected = None
+    if handoff is None or handoff.state is None:
+        return None
+    if getattr(handoff, 'version', None) != VERSION:
+        handoff.close()
+        return None
+    return handoff.state
+
+def reclass(obj, cls):
+    """Makes obj, created before the reload, an instance of cls, its class
+    as reloaded, so that it runs the new code.  Returns obj.
+
+    If the class's layout changed so that can't be done, obj keeps its old
+    class, and the old code, until it's replaced.
+    """
+    if obj.__class__ is not cls:
+        try:
+            obj.__class__ = cls
+        except TypeError:
+            pass
+    return obj
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,134 @@
+"""
+Renders IRC text, formatting codes and all, as HTML.
+
+toHtml() makes a single scan over the text with one regular expression,
+escaping HTML, turning bold, italic, underline, strikethrough, monospace,
+reverse and colour codes into <span>s with the classes in misc/style.css,
+and linking URLs as it goes.  Text without anything to change is returned as
+it is, and text which can't contain a URL is scanned without the URL pattern.
+"""
+
+import re
+
+from linkify import URL, mightContainUrl
+
+# The codes which turn a style on or off, and its class.
+TOGGLES = {
+    '\x02': 'bold',
+    '\x1d': 'italic',
+    '\x1f': 'underline',
+    '\x1e': 'strike',
+    '\x11': 'mono',
+    '\x16': 'reverse',
+}
+# The order the classes of a span are in.
+STYLES = ('bold', 'italic', 'underline', 'strike', 'mono', 'reverse')
+RESET = '\x0f'
+COLOR = '\x03'
+HEX_COLOR = '\x04'
+ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+# mIRC colours 16 to 98 have no classes, and 99 is the default colour.
+COLORS = 16
+
+FORMATTING = r"""
+    [\x02\x0f\x11\x16\x1d\x1e\x1f&<>]
+    |
+    \x03(?:(?P<fg>\d{1,2})(?:,(?P<bg>\d{1,2}))?)?   # a background needs a fg
+    |
+    \x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?     # no classes; dropped
+"""
+
+format_re = re.compile(FORMATTING, re.VERBOSE)
+token_re = re.compile(FORMATTING + '|' + URL, re.VERBOSE | re.MULTILINE)
+
+def color(digits):
+    if digits is None:
+        return None
+    n = int(digits)
+    if n < COLORS:
+        return n
+    return None
+
+def spanClasses(styles, fg, bg):
+    classes = [style for style in STYLES if style in styles]
+    if fg is not None:
+        classes.append('fg%s' % fg)
+    if bg is not None:
+        classes.append('bg%s' % bg)
+    return ' '.join(classes)
+
+def switchSpan(L, span, classes):
+    """Closes the span with the classes span, if any, and opens one with
+    classes, if any.  Returns classes."""
+    if span:
+        L.append('</span>')
+    if classes:
+        L.append('<span class="%s">' % classes)
+    return classes
+
+def toHtml(s, links=True):
+    """Returns the IRC text s as HTML, with its URLs linked if links is
+    true.
+
+    Spans are only opened when there's text for them, so codes with nothing
+    between them don't leave empty spans behind.
+    """
+    if links and mightContainUrl(s):
+        regexp = token_re
+    else:
+        regexp = format_re
+    L = []
+    pos = 0
+    styles = set()
+    fg = None
+    bg = None
+    span = ''
+    classes = ''
+    for m in regexp.finditer(s):
+        start = m.start()
+        if start > pos:
+            if classes != span:
+                span = switchSpan(L, span, classes)
+            L.append(s[pos:start])
+        pos = m.end()
+        token = m.group()
+        c = token[0]
+        text = None
+        if c in ESCAPES:
+            text = ESCAPES[c]
+        elif c in TOGGLES:
+            styles ^= set([TOGGLES[c]])
+        elif c == COLOR:
+            if len(token) == 1:
+                fg = bg = None
+            else:
+                if m.group('fg') is not None:
+                    fg = color(m.group('fg'))
+                if m.group('bg') is not None:
+                    bg = color(m.group('bg'))
+        elif c == RESET:
+            styles.clear()
+            fg = bg = None
+        elif c == HEX_COLOR:
+            continue
+        else:
+            url = token.replace('&', '&amp;').replace('<', '&lt;')
+            text = '<a href="%s">%s</a>' % (url.replace('"', '&quot;'), url)
+        if text is None:
+            classes = spanClasses(styles, fg, bg)
+            continue
+        if classes != span:
+            span = switchSpan(L, span, classes)
+        L.append(text)
+    if not pos:
+        return s
+    if pos < len(s):
+        if classes != span:
+            span = switchSpan(L, span, classes)
+        L.append(s[pos:])
+    if span:
+        L.append('</span>')
+    return ''.join(L)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
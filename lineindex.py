@@ -0,0 +1,170 @@
+"""
+Sidecar indexes of where the lines of a log start.
+
+Every so many lines, a LogFile with a line index appends a record of the time
+the line was logged, the byte offset it starts at and its line number to a
+file next to the log, named after it with '.idx' on the end.  The records
+are fixed-size, so finding the one for a time or line is a binary search
+through the mmap()ed index, after which the log only has to be read from
+that offset on: going to any point in a day's log takes the same time
+however large it is.
+"""
+
+import os
+import mmap
+import struct
+
+# (time, offset, line) of one line of a log.
+RECORD = struct.Struct('<dQQ')
+TIME = 0
+OFFSET = 1
+LINE = 2
+
+def indexPath(path):
+    """Returns the path of the index of the log written as path."""
+    return path + '.idx'
+
+def append(path, records):
+    """Appends records, already packed, to the index of the log at path."""
+    with open(indexPath(path), 'ab') as fd:
+        fd.write(''.join(records))
+
+def countLines(path, offset, size):
+    """Returns how many lines end between offset and size in the file at
+    path."""
+    lines = 0
+    with open(path, 'rb') as fd:
+        fd.seek(offset)
+        left = size - offset
+        while left > 0:
+            chunk = fd.read(min(left, 65536))
+            if not chunk:
+                break
+            lines += chunk.count('\n')
+            left -= len(chunk)
+    return lines
+
+def resume(path, size):
+    """Returns (lines, marked) for a log that's being appended to: how many
+    lines its first size bytes hold, and the line number of the last record
+    in its index, or None if it has none.
+
+    Only the lines after the last record are counted, so this only reads the
+    whole log if it was written without an index.  An index which doesn't
+    match the log, because it was replaced, is removed, and a record only half
+    written is cut off so the ones appended after it line up.
+    """
+    try:
+        index = LineIndex(path)
+    except EnvironmentError:
+        index = None
+    if index is not None:
+        count = len(index)
+        try:
+            if count:
+                (_, offset, line) = index[-1]
+        finally:
+            index.close()
+        if count and offset <= size:
+            with open(indexPath(path), 'r+b') as fd:
+                fd.truncate(count * RECORD.size)
+            return (line + countLines(path, offset, size), line)
+        os.remove(indexPath(path))
+    return (countLines(path, 0, size), None)
+
+def skipTo(fd, offset):
+    """Moves fd, a log opened for reading from its start, to offset."""
+    try:
+        fd.seek(offset)
+    except (IOError, ValueError):
+        # Some decompressors can't seek, even forwards.
+        while offset > 0:
+            chunk = fd.read(min(offset, 65536))
+            if not chunk:
+                break
+            offset -= len(chunk)
+
+class LineIndex(object):
+    """The records of the index of the log written as path.
+
+    Indexing it returns (time, offset, line) tuples.  A record only half
+    written when the bot stopped is ignored.
+    """
+    def __init__(self, path):
+        self.fd = open(indexPath(path), 'rb')
+        size = os.fstat(self.fd.fileno()).st_size
+        self.count = size // RECORD.size
+        self.map = None
+        if self.count:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return RECORD.unpack_from(self.map, i * RECORD.size)
+
+    def find(self, field, value):
+        """Returns the index of the last record whose field (TIME or LINE)
+        is at most value, or 0 if there's none."""
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][field] <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fd.close()
+
+def readLines(fd, index, line, n):
+    """Returns up to n lines of the log open as fd, starting from line
+    number line (or the first line indexed, if that's after it)."""
+    (_, offset, first) = index[index.find(LINE, line)]
+    skipTo(fd, offset)
+    skip = line - first
+    lines = []
+    for s in fd:
+        if skip > 0:
+            skip -= 1
+            continue
+        lines.append(s.rstrip('\r\n'))
+        if len(lines) >= n:
+            break
+    return lines
+
+def lastLines(fd, index, n):
+    """Returns the last n lines of the log open as fd.
+
+    The line before the first one returned is up to one index interval after
+    the record read from, and the log may have up to one interval of lines
+    after its last record, so this reads at most two intervals more lines
+    than it returns.
+    """
+    if not len(index):
+        return []
+    line = index[-1][LINE]
+    skipTo(fd, index[index.find(LINE, line - n)][OFFSET])
+    lines = []
+    for s in fd:
+        lines.append(s.rstrip('\r\n'))
+    return lines[-n:]
+
+def linesAround(fd, index, when, n):
+    """Returns n lines of the log open as fd from around the time when,
+    which is to within one index interval of the middle of them."""
+    if not len(index):
+        return []
+    line = index[index.find(TIME, when)][LINE]
+    return readLines(fd, index, max(line - n // 2, 0), n)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
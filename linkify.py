@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Finds URLs in log text, to turn them into HTML links.
+
+replaceurls() links the URLs in text that's already been escaped; ircformat
+uses the pattern on text that hasn't.  URLs never contain control characters,
+so they stop at IRC formatting codes.
+
+The pattern is compiled once at import time, and lines which can't possibly
+contain a URL never reach the regular expression at all.
+"""
+
+import re
+
+URL = r"""
+    \b
+    (                           # Capture 1: entire matched URL
+      (?:
+        [a-z][\w-]+:                # URL protocol and colon
+        (?:
+          /{1,3}                        # 1-3 slashes
+          |                             #   or
+          [a-z0-9%]                     # Single letter or digit or '%'
+                                        # (Trying not to match e.g. "URI::Escape")
+        )
+        |                           #   or
+        www\d{0,3}[.]               # "www.", "www1.", "www2." ... "www999."
+        |                           #   or
+        [a-z0-9.\-]+[.][a-z]{2,4}/  # looks like domain name followed by a slash
+      )
+      (?:                           # One or more:
+        [^\s()<>\x00-\x1f]+             # Run of non-space, non-()<>, non-control
+        |                               #   or
+        \(([^\s()<>\x00-\x1f]+|(\([^\s()<>\x00-\x1f]+\)))*\)  # balanced parens, up to 2 levels
+      )+
+      (?:                           # End with:
+        \(([^\s()<>\x00-\x1f]+|(\([^\s()<>\x00-\x1f]+\)))*\)  # balanced parens, up to 2 levels
+        |                                   #   or
+        [^\s`!()\[\]{};:'".,<>?«»“”‘’\x00-\x1f]   # not a space, a control
+                                                  # or one of these punct chars
+      )
+    )"""
+
+url_re = re.compile(URL, re.VERBOSE | re.MULTILINE)
+
+LINK = r'<a href="\g<0>">\g<0></a>'
+
+def mightContainUrl(text):
+    """Cheap test for whether url_re could match anywhere in text.
+
+    Every branch of the pattern needs either a colon (a protocol), 'www' or a
+    slash (a bare domain followed by a path), so text with none of those can
+    be passed through untouched.
+    """
+    return ':' in text or '/' in text or 'www' in text
+
+def replaceurls(text):
+    if not mightContainUrl(text):
+        return text
+    return url_re.sub(LINK, text)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,396 @@
+"""
+Helpers for the log files the plugin writes.
+"""
+
+import io
+import os
+import gzip
+import time
+import errno
+import calendar
+import shutil
+import threading
+import collections
+
+import rotation
+import lineindex
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# How much a LogFile holds in memory before writing it to its file anyway.
+BUFFER_SIZE = 65536
+
+# html_start() always puts <head> within its first few lines, so this is
+# plenty even with a long title and stylesheet location.
+HEADER_BYTES = 4096
+
+# Held while a rotated log is compressed or deleted, so the threads doing
+# that never work on the same log at once.
+rotatedLock = threading.Lock()
+
+# The extension a log gets when it's compressed, by compression method.
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+def hasHtmlStart(path):
+    """Returns whether the HTML log at path already starts with html_start().
+
+    Only the beginning of the file is read, so reopening a log costs the same
+    however much has already been written to it that day.  Raises IOError if
+    the file can't be read.
+    """
+    with open(path, 'rb') as fd:
+        return '<head>' in fd.read(HEADER_BYTES)
+
+def splitCompressed(path):
+    """Returns (name, method): the name path was written under, and how it's
+    been compressed since, or None if it hasn't."""
+    for (method, ext) in EXTENSIONS.iteritems():
+        if path.endswith(ext):
+            return (path[:-len(ext)], method)
+    return (path, None)
+
+def findLog(path):
+    """Returns the file now holding the log written as path: path itself if
+    it's still there, otherwise its compressed copy, or None if there's
+    neither."""
+    if os.path.exists(path):
+        return path
+    for ext in EXTENSIONS.itervalues():
+        if os.path.exists(path + ext):
+            return path + ext
+    return None
+
+def openLog(path):
+    """Opens a log for reading, whether or not it's been compressed.
+
+    path may be the name the log was written under or the name of its
+    compressed copy.  The file returned is read as it's iterated over, a line
+    at a time, so even a large log is never held in memory all at once.
+    Raises IOError if the log can't be found or read.
+    """
+    found = findLog(path)
+    if found is None:
+        raise IOError('No such log: %r' % path)
+    (_, method) = splitCompressed(found)
+    if method == 'gzip':
+        return gzip.open(found, 'rb')
+    elif method == 'zstd':
+        if zstandard is None:
+            raise IOError('Reading %r needs the zstandard module.' % found)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(found, 'rb'))
+        return io.BufferedReader(reader, BUFFER_SIZE)
+    else:
+        return open(found, 'rb')
+
+def splitName(filename, filenameTimestamp):
+    """Returns (channel, date) for the filename of a log, without any
+    compression extension.
+
+    date is the timestamp in the name of a rotated log, or None if the log
+    isn't rotated (or it's some other file, like an archive page).
+    Channels may have dots in their names, and so may filenameTimestamp, so
+    the date is the part after as many dots as filenameTimestamp gives.
+    """
+    (stem, _) = os.path.splitext(filename)
+    dots = time.strftime(filenameTimestamp, time.gmtime(0)).count('.')
+    parts = stem.rsplit('.', dots + 1)
+    if len(parts) == dots + 2:
+        date = '.'.join(parts[1:])
+        try:
+            time.strptime(date, filenameTimestamp)
+            return (parts[0], date)
+        except ValueError:
+            pass
+    return (stem, None)
+
+def splitLine(line, timestampFormat):
+    """Returns (time, rest) for a line of a text log, or (None, line) if it
+    doesn't start with a timestamp in timestampFormat."""
+    # The timestamp is separated from the line by two spaces.
+    (stamp, sep, rest) = line.partition('  ')
+    if sep:
+        try:
+            when = calendar.timegm(time.strptime(stamp, timestampFormat))
+            return (when, rest)
+        except ValueError:
+            pass
+    return (None, line)
+
+def compress(path, method):
+    """Replaces the log at path with a copy compressed with method, one of
+    the keys of EXTENSIONS, and returns the copy's name, or None if
+    there's no log at path any more.
+
+    The copy is written under a temporary name and renamed into place, so
+    readers see either the whole log or the original, never half of it.
+    """
+    target = path + EXTENSIONS[method]
+    tmp = target + '.tmp'
+    with rotatedLock:
+        if not os.path.exists(path):
+            # Another thread compressed or deleted it first.
+            return None
+        with open(path, 'rb') as src:
+            if method == 'zstd':
+                with open(tmp, 'wb') as dst:
+                    zstandard.ZstdCompressor().copy_stream(src, dst)
+            else:
+                dst = gzip.open(tmp, 'wb')
+                try:
+                    shutil.copyfileobj(src, dst, BUFFER_SIZE)
+                finally:
+                    dst.close()
+        shutil.copystat(path, tmp)
+        os.rename(tmp, target)
+        os.unlink(path)
+    return target
+
+class LogFile(object):
+    """An append-mode log file which holds writes in memory until flushed.
+
+    flush() hands everything written since the last flush to the operating
+    system in a single write, optionally followed by an fsync().  If the log
+    belongs to a LogPool its file may be closed while it's idle, and is
+    reopened when there's something to write.
+
+    If every is set, mark() is called with the time of each line before it's
+    written, and every that many lines where the line starts is recorded in
+    the log's line index (see lineindex).  The records are written after the
+    lines they point to.
+
+    lineIds is the timestamps.LineIds of a log whose lines have anchors, or
+    None.
+    """
+    def __init__(self, path, pool=None, every=0):
+        self.name = path
+        self.pool = pool
+        self.lineIds = None
+        self.fd = None
+        self.buffer = []
+        self.buffered = 0
+        self.every = every
+        self.marks = []
+        self.acquire()
+        if every:
+            self.size = os.path.getsize(path)
+            (self.lines, marked) = lineindex.resume(path, self.size)
+            if marked is None:
+                self.nextMark = self.lines
+            else:
+                self.nextMark = marked + every
+
+    def acquire(self):
+        if self.pool is not None:
+            self.pool.acquire(self)
+        elif self.fd is None:
+            self.reopen()
+
+    def reopen(self):
+        self.fd = open(self.name, 'a')
+
+    def release(self):
+        """Writes out the buffer and closes the file until it's needed.
+
+        It's called by the pool when evicting the log, so the buffer goes
+        straight to the file, which is still open: acquire() would put the
+        log back in the pool.
+        """
+        if self.fd is not None:
+            try:
+                self.writeOut()
+            finally:
+                self.fd.close()
+                self.fd = None
+
+    def mark(self, when):
+        if self.every and self.lines >= self.nextMark:
+            self.marks.append(lineindex.RECORD.pack(when, self.size,
+                                                    self.lines))
+            self.nextMark = self.lines + self.every
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.every:
+            self.size += len(s)
+            self.lines += s.count('\n')
+        if self.buffered >= BUFFER_SIZE:
+            self.writeBuffer()
+
+    def writeBuffer(self):
+        if self.buffer:
+            self.acquire()
+        self.writeOut()
+
+    def writeOut(self):
+        """Writes the buffer to the file, which must be open if there's
+        anything in it, then the line index records."""
+        if self.buffer:
+            self.fd.write(''.join(self.buffer))
+            del self.buffer[:]
+            self.buffered = 0
+        if self.marks:
+            if self.fd is not None:
+                self.fd.flush()
+            lineindex.append(self.name, self.marks)
+            del self.marks[:]
+
+    def flush(self, fsync=False):
+        self.writeBuffer()
+        if self.fd is None:
+            return
+        self.fd.flush()
+        if fsync:
+            os.fsync(self.fd.fileno())
+
+    def close(self):
+        try:
+            if self.buffer:
+                # The pool may have closed the file since it was written.
+                self.acquire()
+            self.release()
+        finally:
+            if self.pool is not None:
+                self.pool.discard(self)
+
+class LogPool(object):
+    """Limits how many LogFiles have their files open at once.
+
+    When a log needs its file and maxOpen are already open, the file of the
+    least recently used log is closed.  Logs are reopened in append mode, so
+    this only costs an open() when the log is next written.
+    """
+    def __init__(self, maxOpen):
+        self.maxOpen = maxOpen
+        self.logs = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.logs)
+
+    def acquire(self, log):
+        if self.logs.pop(log, None) is not None and log.fd is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            while len(self.logs) >= self.maxOpen:
+                (old, _) = self.logs.popitem(last=False)
+                old.release()
+                self.evictions += 1
+            if log.fd is None:
+                log.reopen()
+        self.logs[log] = True
+
+    def discard(self, log):
+        self.logs.pop(log, None)
+
+class DirectoryResolver(object):
+    """Works out which directory logs go in, and makes sure it exists.
+
+    resolve() is given the part of the path that doesn't depend on the time
+    and the strftime() format of the part that does (or None), and returns
+    the directory for now, creating it if needed.  Until the format's period
+    ends, the same directory is returned again without formatting the time
+    or touching the filesystem.  prepare() creates the next period's
+    directories of the logs still being written shortly before it starts, so
+    the logs opened at rollover find them already there.
+    """
+    def __init__(self):
+        self.periods = {}
+        self.prepared = set()
+
+    def resolve(self, base, format, now):
+        key = (base, format)
+        try:
+            (start, end, path) = self.periods[key]
+            if start <= now < end:
+                return path
+        except KeyError:
+            pass
+        if format:
+            path = os.path.join(base, time.strftime(format, time.gmtime(now)))
+            step = rotation.granularity(format)
+            start = int(now) // step * step
+            end = start + step
+        else:
+            path = base
+            (start, end) = (float('-inf'), float('inf'))
+        if path in self.prepared:
+            self.prepared.discard(path)
+        elif path != self.periods.get(key, (None, None, None))[2]:
+            makedirs(path)
+        self.periods[key] = (start, end, path)
+        return path
+
+    def prepare(self, now, ahead, keys):
+        """Creates the directories of the periods starting within ahead
+        seconds of now, for the (base, format) pairs in keys."""
+        for ((base, format), (start, end, path)) in self.periods.items():
+            if (base, format) not in keys:
+                continue
+            if format and now < end <= now + ahead:
+                next = os.path.join(base,
+                                    time.strftime(format, time.gmtime(end)))
+                if next != path and next not in self.prepared:
+                    makedirs(next)
+                    self.prepared.add(next)
+
+    def clear(self):
+        """Forgets every directory, so they're all checked again."""
+        self.periods.clear()
+        self.prepared.clear()
+
+def makedirs(path):
+    """Creates the directory path and its parents, if they don't exist."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+class GroupCommit(object):
+    """Flushes the pending writes of many LogFiles together.
+
+    Logs are added after they're written to; the group is due once more than
+    maxBytes are pending across all of them, or once the oldest pending write
+    is maxDelay seconds old, whichever comes first.
+    """
+    def __init__(self):
+        self.logs = {}
+        self.pending = 0
+        self.started = None
+
+    def add(self, log, now):
+        self.pending += max(0, log.buffered - self.logs.get(log, 0))
+        self.logs[log] = log.buffered
+        if self.started is None:
+            self.started = now
+
+    def discard(self, log):
+        self.logs.pop(log, None)
+
+    def due(self, now, maxBytes, maxDelay):
+        if self.pending >= maxBytes:
+            return True
+        return self.started is not None and now - self.started >= maxDelay
+
+    def commit(self, fsync=False):
+        logs = self.logs
+        self.logs = {}
+        self.pending = 0
+        self.started = None
+        for log in logs:
+            try:
+                log.flush(fsync)
+            except ValueError:
+                pass # It was closed (and so flushed) while waiting.
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,107 @@
+"""
+Which channels each nick is in, so quits and nick changes can be logged to
+the right channels without keeping a copy of the whole IRC state.
+"""
+
+import supybot.ircutils as ircutils
+
+# The prefixes NAMES replies put before the nicks of ops, voices and so on.
+PREFIXES = '@%+&~!'
+
+class Membership(object):
+    """A map from nick to the channels the nick is in, and back.
+
+    Nicks and channels are kept in lower case, and each channel name is
+    interned, so however many nicks share a channel it's only stored once.
+    addMsg() keeps it up to date from JOIN, PART, KICK, NICK, QUIT and NAMES
+    (353) messages; it should be called after the message has been logged, so
+    the handlers see who was in which channel when it arrived.
+    """
+    def __init__(self, nick):
+        self.nick = ircutils.toLower(nick)
+        self.channels = {}
+        self.nicks = {}
+
+    @classmethod
+    def fromState(cls, irc):
+        """Returns a Membership with the users of every channel irc is in.
+
+        This is only needed when the plugin is loaded while the bot is
+        already in channels; otherwise the NAMES replies fill it in."""
+        membership = cls(irc.nick)
+        for (channel, c) in irc.state.channels.iteritems():
+            for nick in c.users:
+                membership.join(nick, channel)
+        return membership
+
+    def channelsOf(self, nick):
+        """Returns the channels nick is in."""
+        return self.channels.get(ircutils.toLower(nick), ())
+
+    def join(self, nick, channel):
+        nick = ircutils.toLower(nick)
+        channel = intern(ircutils.toLower(channel))
+        self.channels.setdefault(nick, set()).add(channel)
+        self.nicks.setdefault(channel, set()).add(nick)
+
+    def part(self, nick, channel):
+        nick = ircutils.toLower(nick)
+        channel = ircutils.toLower(channel)
+        if nick == self.nick:
+            # We left, so we don't know who's there any more.
+            for other in self.nicks.pop(channel, ()):
+                self._leave(other, channel)
+        else:
+            self._leave(nick, channel)
+            nicks = self.nicks.get(channel)
+            if nicks is not None:
+                nicks.discard(nick)
+
+    def _leave(self, nick, channel):
+        channels = self.channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.channels[nick]
+
+    def quit(self, nick):
+        nick = ircutils.toLower(nick)
+        for channel in self.channels.pop(nick, ()):
+            self.nicks[channel].discard(nick)
+
+    def rename(self, oldNick, newNick):
+        oldNick = ircutils.toLower(oldNick)
+        newNick = ircutils.toLower(newNick)
+        if oldNick == self.nick:
+            self.nick = newNick
+        channels = self.channels.pop(oldNick, None)
+        if channels is None:
+            return
+        for channel in channels:
+            nicks = self.nicks[channel]
+            nicks.discard(oldNick)
+            nicks.add(newNick)
+        self.channels[newNick] = channels
+
+    def addMsg(self, msg):
+        command = msg.command
+        if command == 'JOIN':
+            for channel in msg.args[0].split(','):
+                self.join(msg.nick, channel)
+        elif command == 'PART':
+            for channel in msg.args[0].split(','):
+                self.part(msg.nick, channel)
+        elif command == 'KICK':
+            self.part(msg.args[1], msg.args[0])
+        elif command == 'NICK':
+            self.rename(msg.nick, msg.args[0])
+        elif command == 'QUIT':
+            self.quit(msg.nick)
+        elif command == '353':
+            channel = msg.args[2]
+            for name in msg.args[3].split():
+                nick = name.lstrip(PREFIXES)
+                if nick:
+                    self.join(nick, channel)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
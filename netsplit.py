@@ -0,0 +1,114 @@
+"""
+Coalesces the quits and rejoins of a netsplit into one line per channel.
+"""
+
+import re
+import collections
+
+import supybot.ircutils as ircutils
+
+import events
+
+# How long a nick that quit in a netsplit is remembered, so its join is
+# recognised as the split healing.
+REJOIN_TIMEOUT = 3600
+
+# Servers name the two servers that lost each other as the quit reason, as in
+# "irc.a.net irc.b.net".  Networks which hide their servers, like freenode
+# and Libera, mask them with wildcards: "*.net *.split".
+split_re = re.compile(r'^([\w*-]+(?:\.[\w*-]+)+) ([\w*-]+(?:\.[\w*-]+)+)$')
+
+def splitServers(reason):
+    """Returns the servers named by a netsplit quit reason, or None if reason
+    isn't one."""
+    if reason is None:
+        return None
+    m = split_re.match(reason)
+    if m is None or m.group(1) == m.group(2):
+        return None
+    return reason
+
+class Burst(object):
+    """The nicks that quit or rejoined in one netsplit, by channel."""
+    def __init__(self, started):
+        self.started = started
+        self.channels = collections.OrderedDict()
+
+    def add(self, nick, channel):
+        self.channels.setdefault(channel, []).append(nick)
+
+class Netsplits(object):
+    """Holds back the quits and rejoins of netsplits on one network.
+
+    quit() and join() take the events to be summarised; due() returns the
+    summaries of the bursts which started at least window seconds ago, as
+    (channel, LogEvent) pairs.  A summary is a 'netsplit' or 'netjoin' event
+    whose text is the servers and whose target is the nicks, separated by
+    spaces.  It has no time, so it's stamped when it's logged, after the
+    lines logged while it was held back.
+    """
+    def __init__(self):
+        self.bursts = collections.OrderedDict()
+        self.split = {}
+
+    def __len__(self):
+        return len(self.bursts)
+
+    def _burst(self, type, servers, now):
+        key = (type, servers)
+        try:
+            return self.bursts[key]
+        except KeyError:
+            burst = Burst(now)
+            self.bursts[key] = burst
+            return burst
+
+    def quit(self, nick, servers, channels, now):
+        self.split[ircutils.toLower(nick)] = (
+            servers, now, set([ircutils.toLower(c) for c in channels]))
+        burst = self._burst('netsplit', servers, now)
+        for channel in channels:
+            burst.add(nick, channel)
+
+    def join(self, nick, channel, now):
+        """Returns whether nick joining channel was held back as part of a
+        netsplit healing."""
+        key = ircutils.toLower(nick)
+        try:
+            (servers, when, channels) = self.split[key]
+        except KeyError:
+            return False
+        if now - when > REJOIN_TIMEOUT or \
+           ircutils.toLower(channel) not in channels:
+            return False
+        # Only rejoining a channel it quit is the split healing; once it's
+        # back, the nick parts and joins like anyone else.
+        channels.discard(ircutils.toLower(channel))
+        if not channels:
+            del self.split[key]
+        self._burst('netjoin', servers, now).add(nick, channel)
+        return True
+
+    def next(self):
+        """Returns when the oldest burst started, or None if there are
+        none."""
+        for burst in self.bursts.itervalues():
+            return burst.started
+        return None
+
+    def due(self, now, window):
+        summaries = []
+        for ((type, servers), burst) in self.bursts.items():
+            if now - burst.started < window:
+                break
+            del self.bursts[(type, servers)]
+            for (channel, nicks) in burst.channels.iteritems():
+                event = events.LogEvent(type, None, channel, servers,
+                                        target=' '.join(nicks))
+                summaries.append((channel, event))
+        for (nick, (servers, when, _)) in self.split.items():
+            if now - when > REJOIN_TIMEOUT:
+                del self.split[nick]
+        return summaries
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -31,6 +31,8 @@
 
 import os
 import time
+import socket
+import threading
 from cStringIO import StringIO
 
 import supybot.conf as conf
@@ -39,69 +41,290 @@ import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.registry as registry
+import supybot.schedule as schedule
 import supybot.callbacks as callbacks
 import supybot.commands as commands
-import cgi
-import re
+import urllib
+
+import archive
+import collector
+import events
+import export
+import handoff
+import lineindex
+import logfiles
+import membership
+import netsplit
+import retention
+import rotation
+import search
+import stats
+import timestamps
+import writer
 #from supybot.i18n import PluginInternationalization, internationalizeDocstring
 #_ = PluginInternationalization('MBChannelLogger')
 
-def replaceurls(text):
-    url = r"""
-        \b
-        (                           # Capture 1: entire matched URL
-          (?:
-            [a-z][\w-]+:                # URL protocol and colon
-            (?:
-              /{1,3}                        # 1-3 slashes
-              |                             #   or
-              [a-z0-9%]                     # Single letter or digit or '%'
-                                            # (Trying not to match e.g. "URI::Escape")
-            )
-            |                           #   or
-            www\d{0,3}[.]               # "www.", "www1.", "www2." ... "www999."
-            |                           #   or
-            [a-z0-9.\-]+[.][a-z]{2,4}/  # looks like domain name followed by a slash
-          )
-          (?:                           # One or more:
-            [^\s()<>]+                      # Run of non-space, non-()<>
-            |                               #   or
-            \(([^\s()<>]+|(\([^\s()<>]+\)))*\)  # balanced parens, up to 2 levels
-          )+
-          (?:                           # End with:
-            \(([^\s()<>]+|(\([^\s()<>]+\)))*\)  # balanced parens, up to 2 levels
-            |                                   #   or
-            [^\s`!()\[\]{};:'".,<>?«»“”‘’]        # not a space or one of these punct chars
-          )
-        )"""
-    url_re = re.compile(url, re.VERBOSE | re.MULTILINE)
-    return re.sub(url_re, '<a href="\g<0>">\g<0></a>', text)
+# How long before a new period of directories.timestamp.format starts its
+# directories are created.
+PREPARE_AHEAD = 60
+
+# How often to check whether the registry values in ChannelSettings changed,
+# which is how long a change to them can take to apply.
+SETTINGS_INTERVAL = 10
+
+# The most lines the last and around commands reply with.
+MAX_LINES = 50
+
+# How often, in seconds, rotated logs are checked against
+# directories.retention and directories.quota.
+RETENTION_INTERVAL = 60 * 60
+
+def getCallerChannel(irc, msg, args, state):
+    """Like the 'channel' converter, but the caller has to be in the channel
+    too, so its logs can't be read by anyone outside it."""
+    commands.getChannel(irc, msg, args, state)
+    channel = state.channel
+    if channel not in irc.state.channels:
+        state.error('I\'m not in %s.' % channel, Raise=True)
+    if msg.nick not in irc.state.channels[channel].users:
+        state.error('You must be in %s.' % channel, Raise=True)
+
+commands.addConverter('callerInChannel', getCallerChannel)
 
 class FakeLog(object):
-    def flush(self):
+    name = None
+    buffered = 0
+    lineIds = None
+    def flush(self, fsync=False):
         return
     def close(self):
         return
     def write(self, s):
         return
+    def mark(self, when):
+        return
+
+class ChannelSettings(dict):
+    """The registry values used when logging a channel, read all at once.
+
+    It's keyed by the same names registryValue() takes, plus the couple of
+    supybot values the plugin uses.  current() tells whether any of them has
+    changed since the snapshot was taken; the registry has no way to report
+    changes as they happen, so checkSettings() asks every SETTINGS_INTERVAL
+    seconds and lines logged in between use the old values.
+    """
+    channelValues = ('enable', 'formats', 'timestamp', 'stripFormatting',
+                     'noLogPrefix', 'rotateLogs', 'filenameTimestamp',
+                     'archive', 'search', 'search.maxResults',
+                     'search.urlBase', 'directories.retention')
+    globalValues = ('flushImmediately', 'groupCommit', 'groupCommit.maxBytes',
+                    'groupCommit.maxDelay', 'groupCommit.fsync', 'asyncWriter',
+                    'asyncWriter.queueSize', 'asyncWriter.backpressure',
+                    'collector',
+                    'maxOpenLogs', 'netsplit', 'netsplit.window',
+                    'compression', 'compression.formats', 'lineIndex',
+                    'lineIndex.every', 'lineIndex.formats', 'directories',
+                    'directories.network', 'directories.channel',
+                    'directories.timestamp', 'directories.timestamp.format',
+                    'directories.quota',
+                    'directories.quota.compress', 'directories.ledger',
+                    'cssLocation',
+                    'search.database', 'statsFile', 'statsFile.interval',
+                    'exports', 'exports.urlBase')
+    def __init__(self, plugin, channel):
+        self.nodes = []
+        self.loaded = registry._lastModified
+        group = conf.supybot.plugins.get(plugin.name())
+        for name in self.channelValues + self.globalValues:
+            node = group
+            for part in registry.split(name):
+                node = node.get(part)
+            self.track(node)
+            if channel is not None and name in self.channelValues:
+                node = node.get(channel)
+                self.track(node)
+            self[name] = node()
+        node = conf.supybot.log.timestampFormat
+        self.track(node)
+        self['supybot.log.timestampFormat'] = node()
+        node = conf.supybot.directories.log
+        self.track(node)
+        self['supybot.directories.log'] = node.dirize(plugin.name())
+
+    def track(self, node):
+        self.nodes.append((node, node._lastModified))
+
+    def current(self):
+        if registry._lastModified != self.loaded:
+            return False
+        for (node, lastModified) in self.nodes:
+            if node._lastModified != lastModified:
+                return False
+        return True
 
 class MBChannelLogger(callbacks.Plugin):
     noIgnore = True
+    settingsEvent = 'MBChannelLogger.checkSettings'
+    statsEvent = 'MBChannelLogger.writeStats'
+    retentionEvent = 'MBChannelLogger.checkRetention'
     def __init__(self, irc):
         self.__parent = super(MBChannelLogger, self)
         self.__parent.__init__(irc)
-        self.lastMsgs = {}
-        self.lastStates = {}
+        self.memberships = {}
+        self.netsplits = {}
+        self.netsplitEvent = None
         self.logs = {}
+        self.rotations = {}
+        self.archiveDates = {}
+        self.snapshots = {}
+        self.timestamps = timestamps.Timestamps()
+        self.index = None
+        self.reindexed = None
+        self.pool = logfiles.LogPool(self.settings()['maxOpenLogs'])
+        self.directories = logfiles.DirectoryResolver()
+        self.archive = archive.Archive()
+        self.commits = logfiles.GroupCommit()
+        self.commitEvent = None
+        self.lock = threading.RLock()
+        self.writer = None
+        self.compressor = None
+        self.pruner = None
+        self.ledger = None
+        self.client = None
+        self.clientFailed = False
+        self.metrics = stats.Stats()
+        self.metrics.gauges.update({
+            'logs': self.countLogs,
+            'openFiles': lambda: len(self.pool),
+            'queued': lambda: self.writer and len(self.writer.queue) or 0,
+            'dropped': lambda: self.writer and self.writer.dropped or 0,
+        })
         self.flusher = self.flush
         self.logging_disabled = {}
         world.flushers.append(self.flusher)
+        self.settingsEvent = schedule.addPeriodicEvent(self.checkSettings,
+                                                       SETTINGS_INTERVAL,
+                                                       name=self.settingsEvent,
+                                                       now=False)
+        self.retentionEvent = schedule.addPeriodicEvent(
+            self.checkRetention, RETENTION_INTERVAL, name=self.retentionEvent,
+            now=False)
+        self.scheduleStats()
+        state = handoff.take()
+        if state is not None:
+            self.adopt(state)
 
     def die(self):
-        for log in self._logs():
-            # Do we need to print out html_end() here?
-            log.close()
+        for name in (self.settingsEvent, self.statsEvent,
+                     self.retentionEvent):
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        if self.netsplitEvent is not None:
+            try:
+                schedule.removeEvent(self.netsplitEvent)
+            except KeyError:
+                pass
+            self.netsplitEvent = None
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        if self.compressor is not None:
+            self.compressor.stop()
+            self.compressor = None
+        if self.pruner is not None:
+            self.pruner.stop()
+            self.pruner = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.commitEvent is not None:
+            try:
+                schedule.removeEvent(self.commitEvent)
+            except KeyError:
+                pass
+            self.commitEvent = None
+        self.commitLogs()
+        if self.index is not None:
+            self.index.close()
+            self.index = None
         world.flushers = [x for x in world.flushers if x is not self.flusher]
+        if handoff.isExpected():
+            # The plugin is being reloaded, and the new instance takes over
+            # the open logs.
+            handoff.leave(self.handoffState(), self.closeLogs)
+        else:
+            self.closeLogs()
+
+    def closeLogs(self):
+        """Logs the netsplit summaries still waiting, updates the archive
+        pages and closes every log."""
+        self.logNetsplits(force=True)
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        self.saveArchive()
+        with self.lock:
+            for log in self._logs():
+                # Do we need to print out html_end() here?
+                log.close()
+
+    def handoffState(self):
+        """Returns what the next instance of the plugin takes over from this
+        one when it's reloaded."""
+        return {
+            'logs': self.logs,
+            'pool': self.pool,
+            'rotations': self.rotations,
+            'directories': self.directories,
+            'timestamps': self.timestamps,
+            'memberships': self.memberships,
+            'netsplits': self.netsplits,
+            'archive': self.archive,
+            'ledger': self.ledger,
+            'logging_disabled': self.logging_disabled,
+            'counters': self.metrics.counters,
+            'histograms': self.metrics.histograms,
+        }
+
+    def adopt(self, state):
+        """Takes over the open logs and state of the instance this one was
+        reloaded from, so they're carried on with rather than reopened."""
+        reclass = handoff.reclass
+        self.logs = state['logs']
+        self.pool = reclass(state['pool'], logfiles.LogPool)
+        for log in self._logs():
+            reclass(log, logfiles.LogFile)
+            if log.lineIds is not None:
+                reclass(log.lineIds, timestamps.LineIds)
+        self.rotations = state['rotations']
+        self.directories = reclass(state['directories'],
+                                   logfiles.DirectoryResolver)
+        self.timestamps = reclass(state['timestamps'], timestamps.Timestamps)
+        self.memberships = state['memberships']
+        for members in self.memberships.itervalues():
+            reclass(members, membership.Membership)
+        self.netsplits = state['netsplits']
+        for splits in self.netsplits.itervalues():
+            reclass(splits, netsplit.Netsplits)
+            for burst in splits.bursts.itervalues():
+                reclass(burst, netsplit.Burst)
+        self.archive = reclass(state['archive'], archive.Archive)
+        for days in self.archive.days.itervalues():
+            for day in days.itervalues():
+                reclass(day, archive.Day)
+        self.ledger = state['ledger']
+        if self.ledger is not None:
+            reclass(self.ledger, retention.Ledger)
+        self.logging_disabled = state['logging_disabled']
+        self.metrics.counters.update(state['counters'])
+        for histogram in state['histograms'].itervalues():
+            reclass(histogram, stats.Histogram)
+        self.metrics.histograms.update(state['histograms'])
+        self.metrics.count('handoffs')
+        # Schedules the summaries of the netsplits being collected.
+        self.logNetsplits()
 
     def logging(self, irc, msg, args, channel):
         """[<channel>]
@@ -144,27 +367,347 @@ class MBChannelLogger(callbacks.Plugin):
             irc.reply("I'm already logging %s." % channel)
     on = commands.wrap(on, ['channel'])
 
+    def search(self, irc, msg, args, channel, terms):
+        """[<channel>] <terms>
+
+        Searches the logs of <channel> for lines matching <terms>, most recent
+        first.  <terms> can use SQLite's full-text query syntax, e.g.
+        'foo OR bar' or 'foo*'.  You must be in <channel>, which is only
+        necessary if the message isn't sent in the channel itself.
+        """
+        settings = self.settings(channel)
+        try:
+            lines = self.searchIndex().search(terms,
+                                              ircutils.toLower(channel),
+                                              irc.network,
+                                              settings['search.maxResults'])
+        except search.sqlite3.Error, e:
+            irc.error(format('I couldn\'t search for that: %s', e))
+            return
+        if not lines:
+            irc.reply(format('I couldn\'t find anything matching %q in %s.',
+                             terms, channel))
+            return
+        urlBase = settings['search.urlBase']
+        logDir = settings['supybot.directories.log']
+        results = []
+        for (line, when, network, channel, path, anchor) in lines:
+            s = '[%s] %s' % (time.strftime('%Y-%m-%d %H:%M',
+                                           time.gmtime(when)), line)
+            if path is not None and urlBase:
+                # The log may have been compressed since it was indexed.
+                found = logfiles.findLog(os.path.join(logDir, path))
+                if found is not None:
+                    path = os.path.relpath(found, logDir)
+                url = urlBase + urllib.quote(path.replace(os.sep, '/'))
+                if anchor is not None:
+                    url += '#' + anchor
+                s = format('%s %u', s, url)
+            results.append(s)
+        irc.replies(results, joiner=' | ')
+    search = commands.wrap(search, ['callerInChannel', 'text'])
+
+    def last(self, irc, msg, args, channel, n):
+        """[<channel>] <n>
+
+        Replies with the last <n> lines logged in <channel> today.  This needs
+        supybot.plugins.MBChannelLogger.lineIndex on for the 'log' format.
+        You must be in <channel>, which is only necessary if the message
+        isn't sent in the channel itself.
+        """
+        lines = self.readIndexed(irc, channel, time.time(),
+                                 lineindex.lastLines, min(n, MAX_LINES))
+        self.replyLines(irc, channel, lines)
+    last = commands.wrap(last, ['callerInChannel', 'positiveInt'])
+
+    def around(self, irc, msg, args, channel, when, n):
+        """[<channel>] <time> [<n>]
+
+        Replies with <n> lines (10 by default) logged in <channel> around
+        <time>, which is in UTC, and is either HH:MM[:SS] today or
+        YYYY-MM-DDTHH:MM[:SS].  This needs
+        supybot.plugins.MBChannelLogger.lineIndex on for the 'log' format.
+        You must be in <channel>, which is only necessary if the message
+        isn't sent in the channel itself.
+        """
+        t = export.parseTime(when, time.time())
+        if t is None:
+            irc.errorInvalid('time', when)
+            return
+        lines = self.readIndexed(irc, channel, t, lineindex.linesAround, t,
+                                 min(n, MAX_LINES))
+        self.replyLines(irc, channel, lines)
+    around = commands.wrap(around, ['callerInChannel', 'something',
+                                    commands.optional('positiveInt', 10)])
+
+    def readIndexed(self, irc, channel, when, read, *args):
+        """Returns read(fd, index, *args) for channel's 'log' format log for
+        when, open as fd, and its line index, or None if it has no index."""
+        channel = self.normalizeChannel(irc, channel)
+        self.flushChannel(irc, channel)
+        path = self.logPath(irc, channel, 'log', when)
+        try:
+            index = lineindex.LineIndex(path)
+        except EnvironmentError:
+            return None
+        try:
+            with logfiles.openLog(path) as fd:
+                return read(fd, index, *args)
+        except EnvironmentError:
+            self.log.exception('Error reading log:')
+            return None
+        finally:
+            index.close()
+
+    def flushChannel(self, irc, channel):
+        """Writes out what's been logged to channel so far, so it can be read
+        back from its logs."""
+        with self.lock:
+            for log in self.logs.get(irc, {}).get(channel, {}).values():
+                log.flush()
+
+    def logPath(self, irc, channel, fmt, when):
+        """Returns the path of channel's log in fmt for the time when.
+
+        Unlike getLogDir(), this never creates the directory of a period
+        that may never have been logged.
+        """
+        (logDir, format) = self.getLogBase(irc, channel)
+        if format:
+            logDir = os.path.join(logDir,
+                                  time.strftime(format, time.gmtime(when)))
+        return os.path.join(logDir, self.getLogName(channel, fmt, when))
+
+    def export(self, irc, msg, args, channel, start, end, fmt):
+        """[<channel>] <from> <to> [<format>]
+
+        Writes what was logged in <channel> from <from> up to <to> to a file,
+        and replies with where it is.  <from> and <to> are in UTC, as
+        YYYY-MM-DD, YYYY-MM-DDTHH:MM or YYYY-MM-DDTHH:MM:SS.  <format> is
+        'log' (the default), 'html' or 'jsonl', and the channel must be logged
+        in it.  You need the #channel,op capability.  <channel> is only
+        necessary if the message isn't sent in the channel itself.
+        """
+        (t0, t1) = (export.parseTime(start), export.parseTime(end))
+        if t0 is None:
+            irc.errorInvalid('time', start)
+            return
+        if t1 is None:
+            irc.errorInvalid('time', end)
+            return
+        if fmt not in export.formats:
+            irc.errorInvalid('format', fmt)
+            return
+        channel = self.normalizeChannel(irc, channel)
+        settings = self.settings(channel)
+        self.flushChannel(irc, channel)
+        (_, dirFormat) = self.getLogBase(irc, channel)
+        step = rotation.granularity(dirFormat or '')
+        if settings['rotateLogs']:
+            step = min(step,
+                       rotation.granularity(settings['filenameTimestamp']))
+        def layout(t):
+            return self.logPath(irc, channel, fmt, t)
+        lines = export.export(layout, step, t0, t1, fmt,
+                              settings['supybot.log.timestampFormat'])
+        (header, footer) = ('', '')
+        if fmt == 'html':
+            header = events.htmlStart(channel, '%s to %s' % (start, end),
+                                      settings['cssLocation'])
+            footer = events.htmlEnd()
+        stamp = '%Y%m%dT%H%M%S'
+        name = '%s.%s-%s.%s' % (channel, time.strftime(stamp, time.gmtime(t0)),
+                                time.strftime(stamp, time.gmtime(t1)), fmt)
+        directory = conf.supybot.directories.data.dirize(settings['exports'])
+        path = os.path.join(directory, name)
+        try:
+            logfiles.makedirs(directory)
+            count = export.write(path, lines, header, footer)
+        except EnvironmentError, e:
+            self.log.exception('Error exporting %s:', channel)
+            irc.error(format('I couldn\'t export that: %s', e))
+            return
+        self.metrics.count('exportedLines', count)
+        # The file's name, not where the bot's data directory is.
+        where = format('%s in the exports directory', name)
+        if settings['exports.urlBase']:
+            where = format('%u', settings['exports.urlBase'] +
+                           urllib.quote(name))
+        irc.reply(format('I exported %n from %s to %s.',
+                         (count, 'line'), channel, where))
+    export = commands.thread(commands.wrap(export,
+        [('checkChannelCapability', 'op'), 'something', 'something',
+         commands.optional('something', 'log')]))
+
+    def replyLines(self, irc, channel, lines):
+        if lines is None:
+            irc.error(format('I don\'t have a line index for that log of %s.',
+                             channel))
+        elif not lines:
+            irc.reply(format('Nothing has been logged in %s then.', channel))
+        else:
+            irc.replies(lines, joiner=' | ')
+
+    def reindex(self, irc, msg, args):
+        """takes no arguments
+
+        Rebuilds the search index from the HTML logs on disk.
+        """
+        settings = self.settings()
+        network = None
+        if not (settings['directories'] and settings['directories.network']):
+            network = irc.network
+        index = self.searchIndex()
+        if self.writer is not None:
+            self.writer.drain()
+        with self.lock:
+            if self.reindexed is not None:
+                irc.error('I\'m already rebuilding the search index.')
+                return
+            # Everything indexed so far is on disk for rebuild() to read,
+            # and what's logged from now on is indexed as it's logged.
+            for log in self._logs():
+                log.flush()
+            index.clear(network)
+            self.reindexed = set()
+        try:
+            count = search.rebuild(index, settings['supybot.directories.log'],
+                                   settings['supybot.log.timestampFormat'],
+                                   network, self.isReindexed)
+        finally:
+            with self.lock:
+                self.reindexed = None
+        irc.replySuccess(format('%n indexed.', (count, 'line')))
+    reindex = commands.thread(commands.wrap(reindex, ['owner']))
+
+    def stats(self, irc, msg, args, prefix):
+        """[<prefix>]
+
+        Returns the plugin's counters, and how long it spends handling each
+        kind of message and in each stage of writing a line.  If <prefix> is
+        given, only the stats whose names start with it are returned.
+        """
+        dump = self.metrics.dump()
+        L = []
+        for kind in ('counters', 'gauges'):
+            for (name, value) in sorted(dump[kind].iteritems()):
+                if name.startswith(prefix or ''):
+                    L.append('%s: %s' % (name, value))
+        for (name, timing) in sorted(dump['timings'].iteritems()):
+            if name.startswith(prefix or ''):
+                L.append('%s: %s, p50 %.0fus, p99 %.0fus, max %.0fus' %
+                         (name, timing['count'], timing['p50'] * 1e6,
+                          timing['p99'] * 1e6, timing['max'] * 1e6))
+        if not L:
+            irc.reply('I have no stats like that yet.')
+        else:
+            irc.replies(L, joiner=' | ')
+    stats = commands.wrap(stats, ['owner', commands.optional('something')])
+
+    def files(self, irc, msg, args):
+        """takes no arguments
+
+        Returns how many logfiles are open and how well the pool of open
+        logfiles is doing.
+        """
+        with self.lock:
+            logs = self.countLogs()
+            pool = self.pool
+            irc.reply(format('I have %n open, %i of which have their file '
+                             'open (at most %i).  Reopened files: %i, '
+                             'reused: %i, closed to make room: %i.',
+                             (logs, 'log'), len(pool), pool.maxOpen,
+                             pool.misses, pool.hits, pool.evictions))
+    files = commands.wrap(files)
+
     def __call__(self, irc, msg):
+        start = time.time()
         try:
             # I don't know why I put this in, but it doesn't work, because it
             # doesn't call doNick or doQuit.
             # if msg.args and irc.isChannel(msg.args[0]):
             self.__parent.__call__(irc, msg)
-            if irc in self.lastMsgs:
-                if irc not in self.lastStates:
-                    self.lastStates[irc] = irc.state.copy()
-                self.lastStates[irc].addMsg(irc, self.lastMsgs[irc])
         finally:
-            # We must make sure this always gets updated.
-            self.lastMsgs[irc] = msg
+            # The handlers need to know who was in which channel before msg,
+            # so it's only applied now, but it must always be applied.
+            self.members(irc).addMsg(msg)
+            handler = 'do' + msg.command.capitalize()
+            if hasattr(self, handler):
+                self.metrics.time(handler, time.time() - start)
+
+    def members(self, irc):
+        """Returns the Membership of the channels irc is in."""
+        try:
+            return self.memberships[irc]
+        except KeyError:
+            members = membership.Membership.fromState(irc)
+            self.memberships[irc] = members
+            return members
 
     def reset(self):
-        for log in self._logs():
-            # Do We need to print out html_end() here?
-            log.close()
-        self.logs.clear()
-        self.lastMsgs.clear()
-        self.lastStates.clear()
+        self.logNetsplits(force=True)
+        if self.writer is not None:
+            self.writer.drain()
+        self.saveArchive()
+        with self.lock:
+            for log in self._logs():
+                # Do We need to print out html_end() here?
+                log.close()
+            self.logs.clear()
+            self.rotations.clear()
+            self.directories.clear()
+        self.memberships.clear()
+
+    def settings(self, channel=None):
+        """Returns the ChannelSettings for channel, or the global ones."""
+        if channel is not None:
+            if ircutils.isChannel(channel):
+                channel = ircutils.toLower(channel)
+            else:
+                channel = None
+        try:
+            return self.snapshots[channel]
+        except KeyError:
+            settings = ChannelSettings(self, channel)
+            self.snapshots[channel] = settings
+            return settings
+
+    def checkSettings(self):
+        """Forgets the ChannelSettings whose registry values have changed.
+
+        As it runs every few seconds, it also creates the log directories of
+        the next period when it's about to start.
+        """
+        with self.lock:
+            try:
+                self.directories.prepare(time.time(), PREPARE_AHEAD,
+                                         self.openLogBases())
+            except EnvironmentError:
+                self.log.exception('Error creating log directories:')
+        stale = [channel for (channel, settings) in self.snapshots.items()
+                 if not settings.current()]
+        if stale:
+            for channel in stale:
+                del self.snapshots[channel]
+            # Rotation deadlines depend on filenameTimestamp and rotateLogs.
+            self.rotations.clear()
+            self.archiveDates.clear()
+
+    def countLogs(self):
+        # The writer thread opens and closes logs in asyncWriter mode.
+        with self.lock:
+            return len(list(self._logs()))
+
+    def openLogBases(self):
+        """Returns the getLogBase() of each channel with a log open, so
+        channels which are idle, or have been left, don't get directories
+        they won't use."""
+        bases = set()
+        for (irc, logs) in self.logs.iteritems():
+            for (channel, formats) in logs.iteritems():
+                if formats:
+                    bases.add(self.getLogBase(irc, channel))
+        return bases
 
     def _logs(self):
         for logs in self.logs.itervalues():
@@ -172,54 +715,281 @@ class MBChannelLogger(callbacks.Plugin):
                 for log in channel.itervalues():
                     yield log
 
+    def scheduleStats(self):
+        interval = self.settings()['statsFile.interval']
+        try:
+            schedule.removeEvent(self.statsEvent)
+        except KeyError:
+            pass
+        schedule.addEvent(self.writeStats, time.time() + interval,
+                          name=self.statsEvent)
+
+    def writeStats(self):
+        """Writes the stats to statsFile, if it's set, and schedules the next
+        time to."""
+        try:
+            filename = self.settings()['statsFile']
+            if filename:
+                filename = conf.supybot.directories.data.dirize(filename)
+                try:
+                    self.metrics.write(filename)
+                except EnvironmentError, e:
+                    self.log.warning('Couldn\'t write stats to %s: %s',
+                                     filename, e)
+        finally:
+            self.scheduleStats()
+
     def flush(self):
-        self.checkLogNames()
-        for log in self._logs():
-            try:
-                log.flush()
-            except ValueError, e:
-                if e.args[0] != 'I/O operation on a closed file':
-                    self.log.exception('Odd exception:')
+        start = time.time()
+        with self.lock:
+            self.checkLogNames()
+            self.commitLogs()
+            for log in self._logs():
+                try:
+                    log.flush()
+                except ValueError, e:
+                    if e.args[0] != 'I/O operation on a closed file':
+                        self.log.exception('Odd exception:')
+        if self.index is not None:
+            self.index.commit()
+        self.metrics.time('flushAll', time.time() - start)
 
-    def logNameTimestamp(self, channel):
-        format = self.registryValue('filenameTimestamp', channel)
-        return time.strftime(format, time.gmtime())
+    def logNameTimestamp(self, channel, now=None):
+        format = self.settings(channel)['filenameTimestamp']
+        return time.strftime(format, time.gmtime(now))
 
-    def getLogName(self, channel, fmt):
-        if self.registryValue('rotateLogs', channel):
-            return '%s.%s.%s' % (channel, self.logNameTimestamp(channel), fmt)
+    def getLogName(self, channel, fmt, now=None):
+        if self.settings(channel)['rotateLogs']:
+            return '%s.%s.%s' % (channel, self.logNameTimestamp(channel, now),
+                                 fmt)
         else:
             return '%s.%s' % (channel, fmt)
 
-    def getLogDir(self, irc, channel):
-        logDir = conf.supybot.directories.log.dirize(self.name())
-        if self.registryValue('directories'):
-            if self.registryValue('directories.network'):
+    def getLogBase(self, irc, channel):
+        """Returns the directory channel's logs go in, without its timestamp
+        part, and the format of that part (or None if there isn't one)."""
+        settings = self.settings(channel)
+        logDir = settings['supybot.directories.log']
+        format = None
+        if settings['directories']:
+            if settings['directories.network']:
                 logDir = os.path.join(logDir,  irc.network)
-            if self.registryValue('directories.channel'):
+            if settings['directories.channel']:
                 logDir = os.path.join(logDir, channel)
-            if self.registryValue('directories.timestamp'):
-                format = self.registryValue('directories.timestamp.format')
-                timeDir =time.strftime(format, time.gmtime())
-                logDir = os.path.join(logDir, timeDir)
-        if not os.path.exists(logDir):
-            os.makedirs(logDir)
-        return logDir
+            if settings['directories.timestamp']:
+                format = settings['directories.timestamp.format']
+        return (logDir, format)
+
+    def getLogDir(self, irc, channel, now=None):
+        if now is None:
+            now = time.time()
+        (logDir, format) = self.getLogBase(irc, channel)
+        return self.directories.resolve(logDir, format, now)
 
     def checkLogNames(self):
+        now = time.time()
         for (irc, logs) in self.logs.items():
-            for (channel, formats) in logs.items():
-                for (fmt, log) in formats.items():
-                    if self.registryValue('rotateLogs', channel):
-                        name = self.getLogName(channel, fmt)
-                        if name != os.path.split(log.name)[-1]:
-                            if fmt == 'html':
-                                log.write(self.html_end())
-                            log.close()
-                            del logs[channel][fmt]
-
-    def getLog(self, irc, channel, fmt):
-        self.checkLogNames()
+            for channel in logs.keys():
+                self.checkRotation(irc, channel, now)
+
+    def checkRotation(self, irc, channel, now):
+        """Rotates the logs of channel on irc if its deadline has passed, and
+        returns the time its logs are named for.
+
+        The deadline is the next time the channel's filenameTimestamp can
+        change, so between deadlines this costs a single dict lookup.  An
+        event from before the current period, like a netsplit summary or one
+        still queued for the writer when the logs were rotated, goes in the
+        current period's logs, not back in those already rotated.
+        """
+        key = (irc, channel)
+        (start, deadline) = self.rotations.get(key, (0, 0))
+        if now < deadline:
+            return max(now, start)
+        settings = self.settings(channel)
+        logs = self.logs.get(irc, {})
+        if channel in logs and settings['rotateLogs']:
+            formats = logs[channel]
+            rotated = False
+            for (fmt, log) in formats.items():
+                name = self.getLogName(channel, fmt, now)
+                if name != os.path.split(log.name)[-1]:
+                    rotated = True
+                    if fmt == 'html':
+                        log.write(self.html_end())
+                    log.close()
+                    self.commits.discard(log)
+                    del formats[fmt]
+                    self.recordRotation(log.name, channel, now)
+                    if fmt in settings['compression.formats']:
+                        target = self.compressLog(log.name,
+                                                  settings['compression'])
+                        if target is not None:
+                            # The archive pages link to what it'll be.
+                            self.archive.rename(irc.network, channel,
+                                                log.name, target)
+            if rotated:
+                self.saveArchive(irc, channel)
+        format = settings['filenameTimestamp']
+        deadline = rotation.nextBoundary(format, now)
+        self.rotations[key] = (deadline - rotation.granularity(format),
+                               deadline)
+        return now
+
+    def countArchive(self, irc, channel, event, settings, paths):
+        """Counts a line logged to channel for its archive pages."""
+        if 'html' in paths:
+            path = paths['html']
+        else:
+            path = paths.values()[0]
+        (directory, _) = self.getLogBase(irc, channel)
+        if settings['directories'] and settings['directories.channel']:
+            prefix = ''
+        else:
+            prefix = channel + '.'
+        date = self.archiveDate(irc, channel, event.time)
+        self.archive.count(irc.network, channel, date, directory, prefix,
+                           path, event.time)
+
+    def archiveDate(self, irc, channel, now):
+        """Returns channel's filenameTimestamp for now, formatting it only
+        once a period, like the rotation deadlines in self.rotations."""
+        key = (irc, channel)
+        try:
+            (start, end, date) = self.archiveDates[key]
+            if start <= now < end:
+                return date
+        except KeyError:
+            pass
+        format = self.settings(channel)['filenameTimestamp']
+        step = rotation.granularity(format)
+        start = int(now) // step * step
+        date = time.strftime(format, time.gmtime(now))
+        self.archiveDates[key] = (start, start + step, date)
+        return date
+
+    def saveArchive(self, irc=None, channel=None):
+        """Updates the archive pages of channel on irc, or of every channel,
+        with what's been logged since they were last updated."""
+        css = self.settings(channel)['cssLocation']
+        try:
+            with self.lock:
+                if irc is None:
+                    self.archive.saveAll(css)
+                else:
+                    self.archive.save(irc.network, channel, css)
+        except EnvironmentError:
+            self.log.exception('Error updating archive pages:')
+
+    def compressLog(self, path, method):
+        """Queues the rotated log at path to be compressed in the background,
+        so rotating never waits on it.  Returns the name it will have, or
+        None if it isn't compressed."""
+        if method == 'none':
+            return None
+        if method == 'zstd' and logfiles.zstandard is None:
+            self.log.warning('The zstandard module isn\'t installed; '
+                             'compressing %s with gzip instead.', path)
+            method = 'gzip'
+        if self.compressor is None:
+            self.compressor = writer.AsyncWriter(self.compressRotated,
+                                                 self.log,
+                                                 'MBChannelLogger compressor')
+        # Rotations only come once a period, so the queue never grows large.
+        self.compressor.put((path, method), 0, writer.SPILL)
+        return path + logfiles.EXTENSIONS[method]
+
+    def compressRotated(self, path, method):
+        # The pruner may have compressed or deleted it already, in which
+        # case this does nothing.
+        logfiles.compress(path, method)
+        if self.ledger is not None:
+            self.ledger.resize(path)
+
+    def getLedger(self):
+        """Returns the ledger of rotated logs, or None if there isn't one."""
+        filename = self.settings()['directories.ledger']
+        if not filename:
+            return None
+        path = conf.supybot.directories.data.dirize(filename)
+        if self.ledger is None or self.ledger.path != path:
+            self.ledger = retention.Ledger(path)
+        return self.ledger
+
+    def recordRotation(self, path, channel, now):
+        """Records the log at path, just rotated, in the ledger."""
+        try:
+            ledger = self.getLedger()
+            if ledger is not None:
+                ledger.add(path, channel, now)
+        except (EnvironmentError, ValueError):
+            self.log.exception('Error recording %s in the ledger:', path)
+
+    def checkRetention(self):
+        """Queues the rotated logs to be checked against their channels'
+        retention and the quota, if either is set, in the background."""
+        settings = self.settings()
+        try:
+            ledger = self.getLedger()
+        except (EnvironmentError, ValueError):
+            self.log.exception('Error reading the ledger:')
+            return
+        if ledger is None:
+            return
+        channels = ledger.channels()
+        # The writer thread adds to self.logs in asyncWriter mode.
+        with self.lock:
+            for logs in self.logs.itervalues():
+                channels.update(logs)
+            current = set([log.name for log in self._logs()])
+        days = {}
+        filenameTimestamps = {}
+        for channel in channels:
+            channelSettings = self.settings(channel)
+            days[channel] = channelSettings['directories.retention']
+            filenameTimestamps[channel] = channelSettings['filenameTimestamp']
+        default = settings['directories.retention']
+        quota = settings['directories.quota'] * 1024 * 1024
+        if not quota and not default and not any(days.itervalues()):
+            return
+        method = None
+        if settings['directories.quota.compress']:
+            method = settings['compression']
+            if method == 'none' or (method == 'zstd' and
+                                    logfiles.zstandard is None):
+                method = 'gzip'
+        if self.pruner is None:
+            self.pruner = writer.AsyncWriter(self.enforceRetention, self.log,
+                                             'MBChannelLogger pruner')
+        # A check still queued is superseded by this one.
+        self.pruner.put((ledger, days, default, quota, method,
+                         settings['supybot.directories.log'], current,
+                         filenameTimestamps, settings['filenameTimestamp']),
+                        1, writer.DROP_OLDEST)
+
+    def enforceRetention(self, ledger, days, default, quota, method, root,
+                         current, filenameTimestamps, filenameTimestamp):
+        pruner = self.pruner
+        stop = lambda: pruner.stopping
+        if not ledger.scanned:
+            found = retention.scan(ledger, root, current, filenameTimestamps,
+                                   filenameTimestamp, stop)
+            self.log.info('Found %s rotated logs under %s for the ledger.',
+                          found, root)
+        start = time.time()
+        (deleted, compressed, freed) = retention.enforce(
+            ledger, days, default, quota, method, start, stop)
+        self.metrics.time('retention', time.time() - start)
+        if deleted or compressed:
+            self.metrics.count('retention.deleted', deleted)
+            self.metrics.count('retention.compressed', compressed)
+            self.log.info('Deleted %s and compressed %s rotated logs, '
+                          'freeing %s bytes.', deleted, compressed, freed)
+
+    def getLog(self, irc, channel, fmt, now=None):
+        if now is None:
+            now = time.time()
+        now = self.checkRotation(irc, channel, now)
         try:
             logs = self.logs[irc]
         except KeyError:
@@ -231,105 +1001,249 @@ class MBChannelLogger(callbacks.Plugin):
             if channel not in logs:
                 logs[channel] = {}
             try:
-                name = self.getLogName(channel, fmt)
-                logDir = self.getLogDir(irc, channel)
+                name = self.getLogName(channel, fmt, now)
+                logDir = self.getLogDir(irc, channel, now)
                 logPath = os.path.join(logDir, name)
                 writeHtml = False
                 if fmt == 'html':
                     try:
-                        with file(logPath, 'r') as log:
-                            # Only write start_html() if it's not already there.
-                            writeHtml = True
-                            for line in log.readlines():
-                                if re.search('<head>', line):
-                                    writeHtml = False
+                        # Only write start_html() if it's not already there.
+                        writeHtml = not logfiles.hasHtmlStart(logPath)
                     except IOError:
                         writeHtml = True
-                log = file(logPath, 'a')
-                if writeHtml: log.write(self.html_start(channel, time.gmtime()))
+                settings = self.settings()
+                self.pool.maxOpen = settings['maxOpenLogs']
+                every = 0
+                if settings['lineIndex'] and \
+                   fmt in settings['lineIndex.formats']:
+                    every = settings['lineIndex.every']
+                log = logfiles.LogFile(logPath, self.pool, every)
+                if fmt == 'html':
+                    log.lineIds = timestamps.LineIds(logPath)
+                if writeHtml:
+                    log.write(self.html_start(channel, time.gmtime(now)))
                 logs[channel][fmt] = log
                 return log
-            except IOError:
+            except EnvironmentError:
                 self.log.exception('Error opening log:')
+                # In case its directory was removed behind our back.
+                self.directories.clear()
+                self.metrics.count('fakeLog')
                 return FakeLog()
 
-    def timestamp(self, log, fmt):
-        curtime = time.gmtime()
-        lineid = time.strftime('%H-%M-%S-', curtime) + repr(time.time()).split('.')[-1]
-        format = conf.supybot.log.timestampFormat()
-        if fmt == 'log':
-            stringfmt = '%s  ';
-        elif fmt == 'html':
-            stringfmt = '<a id="%s" href="#%s" class="timestamp" title="%s">%s</a> ' % (lineid, lineid, '%s', time.strftime('%H:%M:%S', curtime))
-        if format:
-            log.write(stringfmt % time.strftime(format, curtime))
-
     def normalizeChannel(self, irc, channel):
         return ircutils.toLower(channel)
 
-    def doPreface(self, log, irc, channel, fmt, **kwargs):
-        if fmt == 'html':
-            if kwargs.get('cls', False):
-                log.write('<p class="%s">' % kwargs.get('cls'))
-            else:
-                log.write('<p>')
-
-    def doEpilogue(self, log, irc, channel, fmt, **kwargs):
-        if fmt == 'html':
-            log.write('</p>')
-        log.write('\n')
-
     def html_start(self, channel, date):
         """HTML to write at the start of individual log files."""
-        dateformat = self.registryValue('filenameTimestamp', channel)
-        title = 'IRC log of {channel} on {date}'.format(**{
-            'channel': channel,
-            'date': time.strftime(dateformat, date),
-        })
-        css = self.registryValue('cssLocation')
-        html = """<!DOCTYPE html>
-        <html>
-        <head>
-         <title>{title}</title>
-         <!-- TODO: Fix the path to the stylesheet (in case the below doesn't work. -->
-         <link rel="stylesheet" href="{css}" type="text/css" />
-         <meta http-equiv="content-type" content="text/html; charset=utf-8" />
-        </head>
-        <body>
-        <h1>{title}</h1>
-        <p>Timestamps are in UTC.</p>
-        """.format(title = title, css=css)
-        return '\n'.join([line.strip() for line in html.split('\n')])
+        settings = self.settings(channel)
+        date = time.strftime(settings['filenameTimestamp'], date)
+        return events.htmlStart(channel, date, settings['cssLocation'])
 
     def html_end(self):
         """HTML to write at the end of individual log files."""
-        html = """
-        </body>
-        </html>
-        """
-        return '\n'.join([line.strip() for line in html.split('\n')])
+        return events.htmlEnd()
 
-    def doLog(self, irc, channel, fmt, s, *args, **kwargs):
-        if not self.registryValue('enable', channel):
-            return
-        s = format(s, *args)
+    def logEvent(self, irc, channel, event):
+        if event.time is None:
+            event.time = time.time()
+        if event.network is None:
+            event.network = irc.network
+        settings = self.settings()
+        if settings['asyncWriter']:
+            if self.writer is None:
+                self.writer = writer.AsyncWriter(self.writeEvent, self.log,
+                                                 name=self.name(),
+                                                 timeout=self.commitLogs)
+            self.writer.put((irc, channel, event),
+                            settings['asyncWriter.queueSize'],
+                            settings['asyncWriter.backpressure'])
+        else:
+            self.writeEvent(irc, channel, event)
+
+    def writeEvent(self, irc, channel, event):
+        metrics = self.metrics
+        start = time.time()
         channel = self.normalizeChannel(irc, channel)
-        log = self.getLog(irc, channel, fmt)
-        self.doPreface(log, irc, channel, fmt, **kwargs)
-        if self.registryValue('timestamp', channel):
-            self.timestamp(log, fmt)
-        if self.registryValue('stripFormatting', channel):
-            s = ircutils.stripFormatting(s)
-        log.write(s)
-        self.doEpilogue(log, irc, channel, fmt, **kwargs)
-        if self.registryValue('flushImmediately'):
-            log.flush()
+        settings = self.settings(channel)
+        now = time.time()
+        metrics.time('settings', now - start)
+        if not settings['enable']:
+            return
+        if settings['collector'] and self.sendEvent(irc, channel, event,
+                                                    settings):
+            return
+        format = settings['supybot.log.timestampFormat']
+        formats = settings['formats']
+        with self.lock:
+            stamp = None
+            if settings['timestamp'] and format:
+                stamp = self.timestamps
+                stamp.update(event.time, format)
+            paths = {}
+            for formatter in events.formatters:
+                if formatter.fmt not in formats:
+                    continue
+                now = time.time()
+                log = self.getLog(irc, channel, formatter.fmt, event.time)
+                if stamp is not None and log.lineIds is not None:
+                    stamp.nextLine(log.lineIds)
+                then = time.time()
+                metrics.time('getLog', then - now)
+                line = formatter.render(event, channel, stamp, settings)
+                now = time.time()
+                metrics.time('render.' + formatter.fmt, now - then)
+                log.mark(event.time)
+                log.write(line)
+                then = time.time()
+                metrics.time('write', then - now)
+                metrics.count('bytes.' + formatter.fmt, len(line))
+                if settings['groupCommit']:
+                    self.groupCommit(log)
+                elif settings['flushImmediately']:
+                    log.flush()
+                metrics.time('flush', time.time() - then)
+                if log.name is not None:
+                    paths[formatter.fmt] = log.name
+            if settings['archive'] and settings['rotateLogs'] and paths:
+                self.countArchive(irc, channel, event, settings, paths)
+            if settings['search']:
+                now = time.time()
+                self.indexEvent(irc, channel, event, stamp, settings, paths)
+                metrics.time('index', time.time() - now)
+
+    def sendEvent(self, irc, channel, event, settings):
+        """Sends event to the collector, and returns whether it was sent.
+
+        If it wasn't, the collector isn't running or can't keep up, and the
+        event should be logged here instead.
+        """
+        path = settings['collector']
+        if self.client is None or self.client.path != path:
+            if self.client is not None:
+                self.client.close()
+            self.client = collector.Client(path)
+        # Tells this bot's events from those of other bots in the channel.
+        bot = '%s/%s' % (os.getpid(), irc.network)
+        try:
+            self.client.send(collector.encode(bot, channel, event, settings))
+        except socket.error, e:
+            self.metrics.count('collector.fallback')
+            if not self.clientFailed:
+                self.log.warning('Couldn\'t send to the collector at %s, so '
+                                 'logging here instead: %s', path, e)
+                self.clientFailed = True
+            return False
+        if self.clientFailed:
+            self.log.info('Sending to the collector at %s again.', path)
+            self.clientFailed = False
+        self.metrics.count('collector.sent')
+        return True
+
+    def searchIndex(self):
+        if self.index is None:
+            filename = self.settings()['search.database']
+            filename = conf.supybot.directories.data.dirize(filename)
+            self.index = search.SearchIndex(filename)
+        return self.index
+
+    def indexEvent(self, irc, channel, event, stamp, settings, paths):
+        line = events.text.render(event, channel, None, settings)
+        anchor = None
+        if 'html' in paths:
+            path = paths['html']
+            if stamp is not None:
+                anchor = stamp.lineid
+        elif paths:
+            path = paths.values()[0]
+        else:
+            path = None
+        if path is not None:
+            path = os.path.relpath(path, settings['supybot.directories.log'])
+            if self.reindexed is not None and anchor is not None:
+                self.reindexed.add((path, anchor))
+        try:
+            self.searchIndex().add(line.rstrip('\n'), event.time, irc.network,
+                                   channel, path, anchor)
+        except search.sqlite3.Error:
+            self.log.exception('Error indexing line:')
+
+    def isReindexed(self, path, anchor):
+        """Returns whether the line at anchor in the log at path was indexed
+        as it was logged while the index was being rebuilt.
+
+        Lines are indexed holding the lock, so once one can be read from
+        its log, it's either been indexed or it never will be.
+        """
+        with self.lock:
+            return (path, anchor) in self.reindexed
+
+    def groupCommit(self, log):
+        now = time.time()
+        self.commits.add(log, now)
+        settings = self.settings()
+        maxBytes = settings['groupCommit.maxBytes']
+        maxDelay = settings['groupCommit.maxDelay'] / 1000.0
+        if self.commits.due(now, maxBytes, maxDelay):
+            self.commitLogs()
+        elif (self.writer is not None and
+              threading.currentThread() is self.writer.thread):
+            # schedule isn't thread-safe, so the writer keeps its own timer.
+            self.writer.setTimer(now + maxDelay)
+        elif self.commitEvent is None:
+            # Make sure the batch is written even if nothing else is said.
+            self.commitEvent = schedule.addEvent(self._commitEvent,
+                                                 now + maxDelay)
+
+    def _commitEvent(self):
+        self.commitEvent = None
+        self.commitLogs()
+
+    def commitLogs(self):
+        with self.lock:
+            self.commits.commit(self.settings()['groupCommit.fsync'])
+
+    def holdNetsplit(self, irc):
+        """Returns the Netsplits of irc, and makes sure its summaries will be
+        logged once they're due."""
+        try:
+            splits = self.netsplits[irc]
+        except KeyError:
+            splits = netsplit.Netsplits()
+            self.netsplits[irc] = splits
+        if self.netsplitEvent is None:
+            window = self.settings()['netsplit.window']
+            self.netsplitEvent = schedule.addEvent(self._netsplitEvent,
+                                                   time.time() + window)
+        return splits
+
+    def _netsplitEvent(self):
+        self.netsplitEvent = None
+        self.logNetsplits()
+
+    def logNetsplits(self, force=False):
+        """Logs the netsplit summaries which are due, or all of them if
+        force is True."""
+        window = self.settings()['netsplit.window']
+        now = time.time()
+        if force:
+            now += window
+        pending = None
+        for (irc, splits) in self.netsplits.items():
+            for (channel, event) in splits.due(now, window):
+                self.logEvent(irc, channel, event)
+            started = splits.next()
+            if started is not None and (pending is None or started < pending):
+                pending = started
+        if pending is not None and not force and self.netsplitEvent is None:
+            self.netsplitEvent = schedule.addEvent(self._netsplitEvent,
+                                                   pending + window)
 
     def doPrivmsg(self, irc, msg):
         (recipients, text) = msg.args
         for channel in recipients.split(','):
             if irc.isChannel(channel) and not self.logging_disabled.get(channel):
-                noLogPrefix = self.registryValue('noLogPrefix', channel)
+                noLogPrefix = self.settings(channel)['noLogPrefix']
                 if ((noLogPrefix and text.startswith(noLogPrefix)) or
                    (text.startswith('@on')) or
                    (text.startswith('mb-chat-logger: on')) or
@@ -337,54 +1251,39 @@ class MBChannelLogger(callbacks.Plugin):
                     return
                 nick = msg.nick or irc.nick
                 if ircmsgs.isAction(msg):
-                    self.doLog(irc, channel, 'log',
-                               '* %s %s', nick, ircmsgs.unAction(msg))
-                    self.doLog(irc, channel, 'html',
-                               '<span>&bull; <span class="nick">%s</span> %s</span>', 
-                               cgi.escape(nick),
-                               replaceurls(cgi.escape(ircmsgs.unAction(msg))),
-                               cls="action privmsg")
+                    event = events.LogEvent('action', nick, channel,
+                                            ircmsgs.unAction(msg))
                 else:
-                    self.doLog(irc, channel, 'log', '<%s> %s', nick, text)
-                    self.doLog(irc, channel, 'html', 
-                               '<span><span class="nick">&lt;%s&gt;</span> %s</span>', 
-                               cgi.escape(nick), 
-                               replaceurls(cgi.escape(text)),
-                               cls="privmsg")
+                    event = events.LogEvent('privmsg', nick, channel, text)
+                self.logEvent(irc, channel, event)
 
     def doNotice(self, irc, msg):
         (recipients, text) = msg.args
         for channel in recipients.split(','):
             if irc.isChannel(channel):
-                self.doLog(irc, channel, 'log', '-%s- %s', msg.nick, text)
-                self.doLog(irc, channel, 'html', 
-                    '<span><span class="nick">-%s-</span> %s</span>', 
-                    cgi.escape(msg.nick), 
-                    replaceurls(cgi.escape(text)),
-                    cls="notice")
+                event = events.LogEvent('notice', msg.nick, channel, text)
+                self.logEvent(irc, channel, event)
 
     def doNick(self, irc, msg):
         oldNick = msg.nick
         newNick = msg.args[0]
-        for (channel, c) in irc.state.channels.iteritems():
-            if newNick in c.users:
-                self.doLog(irc, channel, 'log',
-                           '*** %s is now known as %s', oldNick, newNick)
-                self.doLog(irc, channel, 'html',
-                           '<span>&bull;&bull;&bull; <span class="nick">%s</span> is now known as <span class="nick">%s</span></span>', 
-                           cgi.escape(oldNick), cgi.escape(newNick),
-                           cls="nickchange")
+        if not isinstance(irc, irclib.Irc):
+            irc = irc.getRealIrc()
+        event = events.LogEvent('nick', oldNick, target=newNick)
+        for channel in self.members(irc).channelsOf(oldNick):
+            self.logEvent(irc, channel, event)
 
     def doJoin(self, irc, msg):
+        splits = None
+        if self.settings()['netsplit']:
+            splits = self.netsplits.get(irc)
         for channel in msg.args[0].split(','):
-            self.doLog(irc, channel, 'log',
-                       '*** %s has joined %s',
-                       msg.nick, channel)
-            self.doLog(irc, channel, 'html',
-                       '<span>&rarr; <span class="nick">%s</span> has joined <span class="channel">%s</span></span>',
-                       cgi.escape(msg.nick),
-                       cgi.escape(channel),
-                       cls="join")
+            if splits is not None and splits.join(msg.nick, channel,
+                                                  time.time()):
+                self.holdNetsplit(irc)
+                continue
+            event = events.LogEvent('join', msg.nick, channel)
+            self.logEvent(irc, channel, event)
 
     def doKick(self, irc, msg):
         if len(msg.args) == 3:
@@ -392,86 +1291,55 @@ class MBChannelLogger(callbacks.Plugin):
         else:
             (channel, target) = msg.args
             kickmsg = ''
-        if kickmsg:
-            self.doLog(irc, channel, 'log',
-                       '*** %s was kicked by %s (%s)',
-                       target, msg.nick, kickmsg)
-            self.doLog(irc, channel, 'html',
-                       '<span>&larr; <span class="nick">%s</span> was kicked by <span class="nick">%s</span> <span class="kickmessage">(%s)</span></span>',
-                       cgi.escape(target), cgi.escape(msg.nick), 
-                       replaceurls(cgi.escape(kickmsg)),
-                       cls="kick")
-        else:
-            self.doLog(irc, channel, 'log',
-                       '*** %s was kicked by %s', target, msg.nick)
-            self.doLog(irc, channel, 'html',
-                       '<span>&larr; <span class="nick">%s</span> was kicked by <span class="nick">%s</span></span>',
-                       cgi.escape(target), cgi.escape(msg.nick),
-                       cls="kick")
+        event = events.LogEvent('kick', msg.nick, channel, kickmsg or None,
+                                target=target)
+        self.logEvent(irc, channel, event)
 
     def doPart(self, irc, msg):
         if len(msg.args) > 1:
-            reason = " (%s)" % msg.args[1]
+            reason = msg.args[1]
         else:
-            reason = ""
+            reason = None
         for channel in msg.args[0].split(','):
-            self.doLog(irc, channel, 'log', 
-                       '*** %s has left %s%s',
-                       msg.nick, channel, reason)
-            self.doLog(irc, channel, 'html', 
-                       '<span>&larr; <span class="nick">%s</span> has left <span class="channel">%s</span><span class="reason">%s</span></span>',
-                       cgi.escape(msg.nick),
-                       cgi.escape(channel), 
-                       replaceurls(cgi.escape(reason)),
-                       cls="part")
+            event = events.LogEvent('part', msg.nick, channel, reason)
+            self.logEvent(irc, channel, event)
 
     def doMode(self, irc, msg):
         channel = msg.args[0]
         if irc.isChannel(channel) and msg.args[1:]:
-            self.doLog(irc, channel, 'log',
-                       '*** %s sets mode: %s %s',
-                       msg.nick or msg.prefix, msg.args[1],
-                        ' '.join(msg.args[2:]))
-            self.doLog(irc, channel, 'html',
-                       '<span>&bull;&bull;&bull; <span class="nick">%s</span> sets mode: <span class="channel">%s</span> <span class="modes">%s</span></span>',
-                       cgi.escape(msg.nick or msg.prefix),
-                       cgi.escape(msg.args[1]),
-                       cgi.escape(' '.join(msg.args[2:])),
-                       cls="modechange")
+            event = events.LogEvent('mode', msg.nick or msg.prefix, channel,
+                                    ' '.join(msg.args[2:]),
+                                    target=msg.args[1])
+            self.logEvent(irc, channel, event)
 
     def doTopic(self, irc, msg):
         if len(msg.args) == 1:
             return # It's an empty TOPIC just to get the current topic.
         channel = msg.args[0]
-        self.doLog(irc, channel, 'log',
-                   '*** %s changes topic to "%s"', msg.nick, msg.args[1])
-        self.doLog(irc, channel, 'html',
-                   '<span>&bull;&bull;&bull; <span class="nick">%s</span> changes topic to <span class="topic">"%s"</span></span>', 
-                   cgi.escape(msg.nick), 
-                   replaceurls(cgi.escape(msg.args[1])),
-                   cls="topicchange")
+        event = events.LogEvent('topic', msg.nick, channel, msg.args[1])
+        self.logEvent(irc, channel, event)
 
     def doQuit(self, irc, msg):
         if len(msg.args) == 1:
-            reason = " (%s)" % msg.args[0]
+            reason = msg.args[0]
         else:
-            reason = ""
+            reason = None
         if not isinstance(irc, irclib.Irc):
             irc = irc.getRealIrc()
-        for (channel, chan) in self.lastStates[irc].channels.iteritems():
-            if msg.nick in chan.users:
-                self.doLog(irc, channel, 'log',
-                           '*** %s has quit IRC%s',
-                           msg.nick, reason)
-                self.doLog(irc, channel, 'html',
-                           '<span>&larr; <span class="nick">%s</span> has quit IRC<span class="reason">%s</span></span>',
-                           cgi.escape(msg.nick),
-                           replaceurls(cgi.escape(reason)),
-                           cls="quit")
+        channels = self.members(irc).channelsOf(msg.nick)
+        if self.settings()['netsplit']:
+            servers = netsplit.splitServers(reason)
+            if servers is not None:
+                self.holdNetsplit(irc).quit(msg.nick, servers, channels,
+                                            time.time())
+                return
+        event = events.LogEvent('quit', msg.nick, text=reason)
+        for channel in channels:
+            self.logEvent(irc, channel, event)
 
     def outFilter(self, irc, msg):
         # First, process the message if it was sent with [off]
-        noLogPrefix = self.registryValue('noLogPrefix', msg.args[0])
+        noLogPrefix = self.settings(msg.args[0])['noLogPrefix']
         newarg = False
         if 'inReplyTo' in msg.tags:
             msgreply = msg.tags['inReplyTo']
@@ -496,4 +1364,10 @@ class MBChannelLogger(callbacks.Plugin):
 
 
 Class = MBChannelLogger
+
+def reload():
+    """Called by Owner's reload command before this module is reloaded;
+    what it returns is passed to the reloaded package's reload()."""
+    return handoff.Handoff()
+
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
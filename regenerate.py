@@ -0,0 +1,157 @@
+"""
+Rebuilds HTML logs from the plain text .log files next to them, with the
+plugin's current templates.
+
+Every .log file under LOGDIR (the plugin's log directory, in whatever layout
+the directories.* settings gave it) is rendered to the .html file beside it.
+Compressed logs are read as well, and if the HTML was compressed, so is the
+new version.  Logs whose HTML is newer than the text are skipped, as is the
+log for the current period, which the bot is still writing.  Lines get the
+anchor ids the plugin gave them, so links to them, and those in the search
+index, still work.  Days are rendered in parallel, one process per CPU by
+default:
+
+    python regenerate.py --timestamp-format FORMAT \\
+                         [--filename-timestamp FORMAT] [--css URL] \\
+                         [--jobs N] [--force] LOGDIR
+"""
+
+import os
+import sys
+import cgi
+import time
+import optparse
+import multiprocessing
+
+import events
+import logfiles
+import timestamps
+
+# The text logs have already been through stripFormatting, if it was on.
+settings = {'stripFormatting': True}
+
+def htmlName(path):
+    """Returns the name of the HTML log written alongside the text log at
+    path."""
+    (name, _) = logfiles.splitCompressed(path)
+    return name[:-len('.log')] + '.html'
+
+def render(path, channel, date, options):
+    """Writes the HTML version of the text log at path.  Returns the number
+    of lines written."""
+    formatter = events.HtmlFormatter()
+    stamp = timestamps.Timestamps()
+    ids = timestamps.LineIds()
+    htmlPath = htmlName(path)
+    tmpPath = htmlPath + '.tmp'
+    old = logfiles.findLog(htmlPath)
+    count = 0
+    with logfiles.openLog(path) as fd:
+        with open(tmpPath, 'w') as out:
+            started = False
+            for line in fd:
+                line = line.rstrip('\r\n')
+                (when, rest) = logfiles.splitLine(line,
+                                                  options.timestamp_format)
+                if not started:
+                    if date is None:
+                        date = time.strftime(options.filename_timestamp,
+                            time.gmtime(when or os.path.getmtime(path)))
+                    out.write(events.htmlStart(channel, date, options.css))
+                    started = True
+                event = None
+                if when is not None:
+                    event = events.text.parse(rest, when)
+                if event is None:
+                    # Something we don't know how to read back; keep it as
+                    # it is.
+                    out.write('<p>%s</p>\n' % cgi.escape(line))
+                else:
+                    event.channel = event.channel or channel
+                    stamp.update(when, options.timestamp_format)
+                    stamp.nextLine(ids)
+                    out.write(formatter.render(event, channel, stamp,
+                                               settings))
+                count += 1
+            if not started:
+                out.write(events.htmlStart(channel, date or '', options.css))
+            out.write(events.htmlEnd())
+    os.rename(tmpPath, htmlPath)
+    if old is not None:
+        (_, method) = logfiles.splitCompressed(old)
+        if method is not None:
+            logfiles.compress(htmlPath, method)
+    return count
+
+def work(args):
+    (path, channel, date, options) = args
+    try:
+        return (path, render(path, channel, date, options), None)
+    except (IOError, OSError), e:
+        return (path, 0, e)
+
+def findLogs(root, options):
+    """Yields the arguments to work() for each log under root that needs its
+    HTML rebuilt."""
+    current = time.strftime(options.filename_timestamp, time.gmtime())
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            (name, _) = logfiles.splitCompressed(filename)
+            if not name.endswith('.log'):
+                continue
+            path = os.path.join(dirpath, filename)
+            (channel, date) = logfiles.splitName(name,
+                                                 options.filename_timestamp)
+            if not options.force:
+                # Logs that aren't rotated are always the current one.
+                if date is None or date == current:
+                    continue
+                htmlPath = logfiles.findLog(htmlName(path))
+                if htmlPath is not None and (os.path.getmtime(htmlPath) >=
+                                             os.path.getmtime(path)):
+                    continue
+            yield (path, channel, date, options)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] LOGDIR')
+    parser.add_option('--timestamp-format',
+                      help='supybot.log.timestampFormat of the logs, which '
+                      'is %Y-%m-%dT%H:%M:%S unless it\'s been changed '
+                      '(required)')
+    parser.add_option('--filename-timestamp', default='%Y-%m-%d',
+                      help='filenameTimestamp of the logs (default: %default)')
+    parser.add_option('--css',
+                      default='../../../../../plugins/MBChannelLogger/misc/'
+                      'style.css',
+                      help='cssLocation for the HTML (default: %default)')
+    parser.add_option('--jobs', type='int', default=None,
+                      help='number of processes (default: one per CPU)')
+    parser.add_option('--force', action='store_true', default=False,
+                      help='rebuild every log, even the current ones and '
+                      'those whose HTML is up to date')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('wrong number of arguments')
+    if options.timestamp_format is None:
+        parser.error('--timestamp-format is required')
+    pool = multiprocessing.Pool(options.jobs)
+    (files, lines, errors) = (0, 0, 0)
+    for (path, count, e) in pool.imap_unordered(work,
+                                                findLogs(args[0], options)):
+        if e is not None:
+            print >>sys.stderr, '%s: %s' % (path, e)
+            errors += 1
+        else:
+            files += 1
+            lines += count
+    pool.close()
+    pool.join()
+    print 'Rebuilt %s files (%s lines).' % (files, lines)
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
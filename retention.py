@@ -0,0 +1,283 @@
+"""
+Enforces how long rotated logs are kept and how much space they take up.
+
+Every log the plugin rotates is recorded in a Ledger, with its size and when
+it was rotated, so enforcing directories.retention and directories.quota
+never walks the log directory: the ledger already knows which logs are the
+oldest and how much they all take up.  It's kept in the data directory as a
+journal of JSON lines, each adding, resizing or removing a log, which is
+appended to as logs rotate, compress and are deleted, and only rewritten
+once it's grown to several times what it records.
+
+Logs rotated before there was a ledger are found by a single scan of the
+log directory, the first time there's anything to enforce.  Both scan() and
+enforce() run on a thread of their own and pause every so many files, so
+the disk is never kept busy for long.
+"""
+
+import os
+import json
+import time
+import errno
+import threading
+
+import events
+import logfiles
+import lineindex
+
+DAY = 24 * 60 * 60
+
+# How many files are deleted, compressed or scanned between pauses, and how
+# long the pauses are, in seconds.
+BATCH = 20
+PAUSE = 0.1
+
+# The journal is rewritten when it has more than this many times as many
+# lines as there are logs in the ledger (plus COMPACT_SLACK).
+COMPACT_RATIO = 4
+COMPACT_SLACK = 1000
+
+def measure(path):
+    """Returns how many bytes the log written as path, compressed or not,
+    and its line index take up."""
+    size = 0
+    for name in (logfiles.findLog(path), lineindex.indexPath(path)):
+        if name is not None:
+            try:
+                size += os.path.getsize(name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+    return size
+
+def delete(path):
+    """Deletes the log written as path, whether or not it's been compressed,
+    and its line index."""
+    names = [path, lineindex.indexPath(path)]
+    names.extend([path + ext for ext in logfiles.EXTENSIONS.itervalues()])
+    # Not while the compressor's working on it.
+    with logfiles.rotatedLock:
+        for name in names:
+            try:
+                os.remove(name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+def toStr(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+class Ledger(object):
+    """The size, rotation time and channel of every rotated log, by the
+    path it was written as, journalled to the file at path.
+
+    It's used from the threads writing, compressing and pruning logs, so
+    every change is made holding its lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logs = {}
+        self.total = 0
+        self.scanned = False
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            fd = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with fd:
+            for line in fd:
+                try:
+                    entry = [toStr(x) for x in json.loads(line)]
+                except ValueError:
+                    # A line cut short when the bot died writing it.
+                    continue
+                self.apply(entry)
+                self.lines += 1
+
+    def apply(self, entry):
+        op = entry[0]
+        if op == 'add':
+            (path, size, when, channel) = entry[1:]
+            self.discard(path)
+            self.logs[path] = [size, when, channel]
+            self.total += size
+        elif op == 'size':
+            (path, size) = entry[1:]
+            if path in self.logs:
+                self.total += size - self.logs[path][0]
+                self.logs[path][0] = size
+        elif op == 'remove':
+            self.discard(entry[1])
+        elif op == 'scanned':
+            self.scanned = True
+
+    def discard(self, path):
+        if path in self.logs:
+            self.total -= self.logs.pop(path)[0]
+
+    def record(self, *entries):
+        """Applies entries to the ledger and appends them to its journal."""
+        lines = [json.dumps(entry) + '\n' for entry in entries]
+        with self.lock:
+            for entry in entries:
+                self.apply(entry)
+            if (self.lines + len(lines) >
+                COMPACT_RATIO * len(self.logs) + COMPACT_SLACK):
+                self.compact()
+            else:
+                with open(self.path, 'ab') as fd:
+                    fd.writelines(lines)
+                self.lines += len(lines)
+
+    def compact(self):
+        """Rewrites the journal with a line for each log.  Called with the
+        lock held."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fd:
+            if self.scanned:
+                fd.write(json.dumps(['scanned']) + '\n')
+            for (path, (size, when, channel)) in self.logs.iteritems():
+                fd.write(json.dumps(['add', path, size, when, channel]) + '\n')
+        os.rename(tmp, self.path)
+        self.lines = len(self.logs) + int(self.scanned)
+
+    def add(self, path, channel, now):
+        """Records the log at path, of channel, as rotated at now."""
+        self.record(['add', path, measure(path), now, channel])
+
+    def resize(self, path):
+        """Records the size of the log at path, e.g. once it's compressed."""
+        if path in self.logs:
+            self.record(['size', path, measure(path)])
+
+    def remove(self, path):
+        self.record(['remove', path])
+
+    def channels(self):
+        with self.lock:
+            return set([channel for (_, _, channel)
+                        in self.logs.itervalues()])
+
+    def oldest(self):
+        """Returns the paths of the logs, the earliest rotated first."""
+        with self.lock:
+            logs = sorted(self.logs.iteritems(), key=lambda (_, e): e[1])
+        return [path for (path, _) in logs]
+
+class Throttle(object):
+    """Pauses for PAUSE seconds every BATCH calls."""
+    def __init__(self, batch=BATCH, pause=PAUSE):
+        self.batch = batch
+        self.pause = pause
+        self.n = 0
+
+    def __call__(self):
+        self.n += 1
+        if self.n % self.batch == 0:
+            time.sleep(self.pause)
+
+def scan(ledger, root, current, filenameTimestamps, default,
+         stop=lambda: False, throttle=None):
+    """Adds the rotated logs under root which aren't in ledger yet, as
+    rotated when they were last modified, skipping the open ones in
+    current.  Returns how many it added.
+
+    filenameTimestamps maps channels to their filenameTimestamp, and default
+    is that of any other channel.  Only files named like a rotated log of
+    their channel are added, so archive pages and the like never are.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    fmts = set(['.' + formatter.fmt for formatter in events.formatters])
+    formats = set(filenameTimestamps.itervalues())
+    formats.add(default)
+    found = []
+    for (directory, _, filenames) in os.walk(root):
+        for filename in filenames:
+            (name, _) = logfiles.splitCompressed(filename)
+            if os.path.splitext(name)[1] not in fmts:
+                continue
+            for format in formats:
+                (channel, date) = logfiles.splitName(name, format)
+                if date is not None and \
+                   filenameTimestamps.get(channel, default) == format:
+                    break
+            else:
+                continue
+            path = os.path.join(directory, name)
+            if path in current or path in ledger.logs:
+                continue
+            try:
+                when = os.path.getmtime(os.path.join(directory, filename))
+                found.append(['add', path, measure(path), when, channel])
+            except OSError:
+                continue
+            if stop():
+                return 0
+            throttle()
+    found.append(['scanned'])
+    ledger.record(*found)
+    return len(found) - 1
+
+def enforce(ledger, days, default, quota, method, now, stop=lambda: False,
+            throttle=None):
+    """Deletes the logs in ledger kept longer than their channel's
+    retention, then, while they take up more than quota bytes, compresses
+    the oldest with method and deletes the oldest.
+
+    days maps channels to their retention in days, and default is that of
+    any other channel; 0 keeps logs forever.  A quota of 0 is no quota, and
+    a method of None compresses nothing.  Stops early if stop() is true.
+    Returns (deleted, compressed, bytes freed).
+    """
+    if throttle is None:
+        throttle = Throttle()
+    before = ledger.total
+    deleted = compressed = 0
+    oldest = ledger.oldest()
+    for path in oldest:
+        if stop():
+            return (deleted, compressed, before - ledger.total)
+        try:
+            (_, when, channel) = ledger.logs[path]
+        except KeyError:
+            continue
+        keep = days.get(channel, default)
+        if keep and when < now - keep * DAY:
+            delete(path)
+            ledger.remove(path)
+            deleted += 1
+            throttle()
+    if quota and method is not None:
+        for path in oldest:
+            if ledger.total <= quota or stop():
+                break
+            found = logfiles.findLog(path)
+            if found is None:
+                ledger.remove(path)
+            elif found == path and path in ledger.logs:
+                # The compressor may have got to it first.
+                if logfiles.compress(path, method) is not None:
+                    compressed += 1
+                ledger.resize(path)
+                throttle()
+    if quota:
+        for path in oldest:
+            if ledger.total <= quota or stop():
+                break
+            if path in ledger.logs:
+                delete(path)
+                ledger.remove(path)
+                deleted += 1
+                throttle()
+    return (deleted, compressed, before - ledger.total)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
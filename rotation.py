@@ -0,0 +1,43 @@
+"""
+Works out when a strftime()-formatted log name can next change.
+
+Log names only change when one of the time fields used in their format does,
+so instead of formatting the name on every write the plugin asks for the next
+boundary of the smallest field in the format and only looks again once that
+time has passed.
+"""
+
+import re
+
+SECOND = 1
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# The smallest unit each strftime directive depends on.  Anything not listed
+# (days, weeks, months, years and locale-dependent dates) is checked daily,
+# which is always safe because names are compared before rotating.
+directives = {
+    'S': SECOND, 's': SECOND, 'c': SECOND, 'X': SECOND, 'T': SECOND,
+    'r': SECOND, 'f': SECOND,
+    'M': MINUTE, 'R': MINUTE,
+    'H': HOUR, 'I': HOUR, 'k': HOUR, 'l': HOUR, 'p': HOUR, 'P': HOUR,
+}
+
+directive_re = re.compile(r'%[-_0^#]?(.)')
+
+def granularity(format):
+    """Returns the number of seconds between possible changes of format."""
+    smallest = DAY
+    for d in directive_re.findall(format):
+        if d == '%':
+            continue
+        smallest = min(smallest, directives.get(d, DAY))
+    return smallest
+
+def nextBoundary(format, now):
+    """Returns the first UTC time after now at which format may change."""
+    step = granularity(format)
+    return (int(now) // step + 1) * step
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
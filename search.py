@@ -0,0 +1,227 @@
+"""
+A full-text index of logged lines, kept in a single SQLite database.
+
+The plugin adds each line to the index as it's logged.  The index can also
+be rebuilt from the HTML logs already on disk, from the plugin or by running
+this module:
+
+    python search.py [--network NETWORK] --timestamp-format FORMAT \\
+                     DATABASE LOGDIR
+"""
+
+import os
+import re
+import time
+import sqlite3
+import calendar
+import optparse
+import threading
+import htmlentitydefs
+
+import supybot.ircutils as ircutils
+
+import logfiles
+
+SCHEMA = ('CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5('
+          'line, time UNINDEXED, network UNINDEXED, channel UNINDEXED, '
+          'path UNINDEXED, anchor UNINDEXED)')
+# For SQLite libraries built without FTS5.
+SCHEMA_FTS4 = ('CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts4('
+               'line, time, network, channel, path, anchor, '
+               'notindexed=time, notindexed=network, notindexed=channel, '
+               'notindexed=path, notindexed=anchor)')
+
+class SearchIndex(object):
+    """The index of logged lines in the SQLite database at filename.
+
+    Lines are committed in batches, after commitLines have been added or
+    commitDelay seconds, whichever comes first, and whenever the index is
+    searched or commit() is called.  It's safe to use from several threads.
+    """
+    commitLines = 500
+    commitDelay = 5
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self.db.execute(SCHEMA)
+        except sqlite3.OperationalError:
+            self.db.execute(SCHEMA_FTS4)
+        self.db.commit()
+        self.pending = 0
+        self.committed = time.time()
+
+    def add(self, line, when, network, channel, path, anchor):
+        with self.lock:
+            self.db.execute('INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)',
+                            (line, when, network, channel, path, anchor))
+            self.pending += 1
+            if (self.pending >= self.commitLines or
+                time.time() - self.committed >= self.commitDelay):
+                self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.pending = 0
+        self.committed = time.time()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def search(self, terms, channel=None, network=None, limit=5):
+        """Returns the most recent lines matching terms, newest first.
+
+        Each line is a (line, time, network, channel, path, anchor) tuple.
+        terms uses SQLite's full-text query syntax; words that aren't valid
+        in it are quoted so they're searched for literally.
+        """
+        sql = 'SELECT * FROM lines WHERE lines MATCH ?'
+        params = [query(terms)]
+        if channel is not None:
+            sql += ' AND channel = ?'
+            params.append(channel)
+        if network is not None:
+            sql += ' AND network = ?'
+            params.append(network)
+        sql += ' ORDER BY time DESC LIMIT ?'
+        params.append(limit)
+        with self.lock:
+            self._commit()
+            return self.db.execute(sql, params).fetchall()
+
+    def clear(self, network=None):
+        with self.lock:
+            if network is None:
+                self.db.execute('DELETE FROM lines')
+            else:
+                self.db.execute('DELETE FROM lines WHERE network = ?',
+                                (network,))
+            self._commit()
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.db.close()
+
+word_re = re.compile(r'^[\w*]+$', re.UNICODE)
+
+def query(terms):
+    """Quotes the words of terms that aren't plain words or operators."""
+    words = []
+    for word in terms.split():
+        if word in ('AND', 'OR', 'NOT') or word_re.match(word):
+            words.append(word)
+        else:
+            words.append('"%s"' % word.replace('"', '""'))
+    return ' '.join(words)
+
+title_re = re.compile(r'<title>IRC log of (\S+) on ')
+line_re = re.compile(r'^<p class="[^"]*"><a id="([^"]*)" href="[^"]*" '
+                     r'class="timestamp" title="([^"]*)">[^<]*</a> (.*)</p>$')
+tag_re = re.compile(r'<[^>]*>')
+entity_re = re.compile(r'&(#?\w+);')
+# How the HTML templates' markers read in the text logs.
+markers = [('&bull;&bull;&bull; ', '*** '), ('&rarr; ', '*** '),
+           ('&larr; ', '*** '), ('&bull; ', '* ')]
+
+def unescape(s):
+    def entity(m):
+        name = m.group(1)
+        if name.startswith('#'):
+            return unichr(int(name[1:])).encode('utf-8')
+        if name in htmlentitydefs.name2codepoint:
+            return unichr(htmlentitydefs.name2codepoint[name]).encode('utf-8')
+        return m.group(0)
+    return entity_re.sub(entity, s)
+
+def htmlText(s):
+    """Returns the text log version of the body of an HTML log line."""
+    for (marker, text) in markers:
+        if s.startswith('<span>' + marker):
+            s = '<span>' + text + s[len('<span>' + marker):]
+            break
+    return unescape(tag_re.sub('', s))
+
+def parseHtmlLog(fd, timestampFormat):
+    """Yields (channel, line, time, anchor) for each line of an HTML log."""
+    channel = None
+    for line in fd:
+        line = line.rstrip('\r\n')
+        if channel is None:
+            m = title_re.search(line)
+            if m:
+                channel = unescape(m.group(1))
+            continue
+        m = line_re.match(line)
+        if m is None:
+            continue
+        (anchor, stamp, body) = m.groups()
+        try:
+            when = calendar.timegm(time.strptime(unescape(stamp),
+                                                 timestampFormat))
+        except ValueError:
+            continue
+        yield (channel, htmlText(body), when, anchor)
+
+def rebuild(index, root, timestampFormat, network=None, skip=None):
+    """Indexes every HTML log under root, the plugin's log directory.
+
+    If network is None, each log is taken to be from the network named by
+    the first directory under root, as with directories.network; otherwise
+    all of them are from network.  Compressed logs are read too, and indexed
+    under the name they were written as.  skip, if given, is called with the
+    path and anchor of each line, and returns whether it's been indexed
+    already.  Returns how many lines were indexed.
+    """
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            (name, _) = logfiles.splitCompressed(path)
+            if not name.endswith('.html'):
+                continue
+            relpath = os.path.relpath(name, root)
+            logNetwork = network
+            if logNetwork is None:
+                logNetwork = relpath.split(os.sep)[0]
+            with logfiles.openLog(path) as fd:
+                for (channel, line, when, anchor) in parseHtmlLog(fd,
+                        timestampFormat):
+                    if skip is not None and skip(relpath, anchor):
+                        continue
+                    index.add(line, when, logNetwork,
+                              ircutils.toLower(channel), relpath, anchor)
+                    count += 1
+    index.commit()
+    return count
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] DATABASE LOGDIR')
+    parser.add_option('--network', help='network all the logs are from '
+                      '(default: the first directory under LOGDIR)')
+    parser.add_option('--timestamp-format',
+                      help='supybot.log.timestampFormat of the logs, which '
+                      'is %Y-%m-%dT%H:%M:%S unless it\'s been changed '
+                      '(required)')
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error('wrong number of arguments')
+    if options.timestamp_format is None:
+        parser.error('--timestamp-format is required')
+    (database, root) = args
+    index = SearchIndex(database)
+    index.clear(options.network)
+    count = rebuild(index, root, options.timestamp_format, options.network)
+    index.close()
+    print 'Indexed %s lines.' % count
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,109 @@
+"""
+Counters and timing histograms for the plugin's hot paths.
+
+Recording a value is a dict lookup and an addition or two, so they can be
+left on on a busy bot.
+"""
+
+import os
+import json
+import time
+
+# Histogram buckets are powers of two of microseconds, from under 1us up;
+# there are enough of them that no duration needs checking against the last.
+BUCKETS = 64
+
+class Histogram(object):
+    """The distribution of how long something took."""
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[int(seconds * 1000000).bit_length()] += 1
+
+    def percentile(self, p):
+        """Returns an upper bound of the pth percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        wanted = self.count * p
+        seen = 0
+        for (bucket, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        mean = 0.0
+        if self.count:
+            mean = self.total / self.count
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': mean,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+class Stats(object):
+    """Named counters and histograms.
+
+    count() adds to a counter; time() adds a duration, in seconds, to a
+    histogram.  Both create the name the first time it's used.  gauges maps
+    names to functions returning values that are only read when the stats
+    are, like the number of open files.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name, n=1):
+        try:
+            self.counters[name] += n
+        except KeyError:
+            self.counters[name] = n
+
+    def time(self, name, seconds):
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        # Histogram.add(), inlined, as this is called several times a line.
+        histogram.count += 1
+        histogram.total += seconds
+        if seconds > histogram.max:
+            histogram.max = seconds
+        histogram.buckets[int(seconds * 1000000).bit_length()] += 1
+
+    def dump(self):
+        """Returns everything as a dict which can be turned into JSON."""
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'counters': dict(self.counters),
+            'gauges': dict([(name, f()) for (name, f)
+                            in self.gauges.iteritems()]),
+            'timings': dict([(name, h.summary()) for (name, h)
+                             in self.histograms.iteritems()]),
+        }
+
+    def write(self, path):
+        """Writes dump() to path as JSON, replacing it all at once."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self.dump(), fd, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
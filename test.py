@@ -27,10 +27,1067 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
+import re
+import time
+import shutil
+import optparse
+import tempfile
+
 from supybot.test import *
 
+import events
+import logfiles
+import collector
+import netsplit
+import retention
+import writer
+import timestamps
+import regenerate
+import archive
+import search
+import membership
+import lineindex
+import ircformat
+import handoff
+import export
+
+def removeLogs():
+    """Removes what the plugin has logged, which is otherwise kept from one
+    test, and one run, to the next."""
+    shutil.rmtree(conf.supybot.directories.log.dirize('MBChannelLogger'),
+                  True)
+
 class ChannelLoggerTestCase(PluginTestCase):
-    plugins = ('ChannelLogger',)
+    plugins = ('MBChannelLogger',)
+
+class LineIndexCommandsTestCase(ChannelPluginTestCase):
+    plugins = ('MBChannelLogger',)
+    config = {'plugins.MBChannelLogger.lineIndex': True,
+              'plugins.MBChannelLogger.lineIndex.every': 2}
+
+    def setUp(self):
+        removeLogs()
+        ChannelPluginTestCase.setUp(self)
+        # The settings were read as the plugin loaded, before self.config
+        # was set, and the channel's logs opened with them as it joined.
+        cb = self.irc.getCallback('MBChannelLogger')
+        cb.checkSettings()
+        cb.reset()
+
+    def testLastAndAround(self):
+        start = time.strftime('%H:%M:%S', time.gmtime())
+        for i in range(5):
+            self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'line %d' % i,
+                                             prefix='foo!u@h'))
+        # Misc has a last command too.
+        self.assertRegexp('mbchannellogger last 3',
+                          r'^\S+  <foo> line 2 \| \S+  <foo> line 3 \| '
+                          r'\S+  <foo> line 4$')
+        self.assertRegexp('around %s 10' % start,
+                          r'<foo> line 0 \| .*<foo> line 4 \| ')
+        self.assertError('around 25:00')
+
+class HandoffTestCase(SupyTestCase):
+    def tearDown(self):
+        handoff.expected = None
+        SupyTestCase.tearDown(self)
+
+    def testTake(self):
+        self.assertEqual(handoff.take(), None)
+        self.failIf(handoff.isExpected())
+        h = handoff.Handoff()
+        handoff.expect(h)
+        self.failUnless(handoff.isExpected())
+        handoff.leave({'logs': {}}, None)
+        self.failIf(handoff.isExpected())
+        self.assertEqual(handoff.take(), {'logs': {}})
+        self.assertEqual(handoff.take(), None)
+
+    def testOtherVersion(self):
+        closed = []
+        h = handoff.Handoff()
+        h.version = handoff.VERSION - 1
+        handoff.expect(h)
+        handoff.leave({'logs': {}}, lambda: closed.append(True))
+        self.assertEqual(handoff.take(), None)
+        self.assertEqual(closed, [True])
+
+class ReloadTestCase(ChannelPluginTestCase):
+    plugins = ('MBChannelLogger',)
+    config = {'plugins.MBChannelLogger.flushImmediately': False}
+
+    def setUp(self):
+        removeLogs()
+        ChannelPluginTestCase.setUp(self)
+        self.irc.getCallback('MBChannelLogger').checkSettings()
+
+    def say(self, text):
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, text,
+                                         prefix='foo!u@h'))
+
+    def reload(self, expected):
+        cb = self.irc.getCallback('MBChannelLogger')
+        if expected:
+            handoff.expect(handoff.Handoff())
+        self.irc.removeCallback('MBChannelLogger')
+        cb.die()
+        new = cb.__class__(self.irc)
+        self.irc.addCallback(new)
+        return (cb, new)
+
+    def read(self, cb, fmt):
+        cb.flushChannel(self.irc, self.channel)
+        return open(cb.logPath(self.irc, self.channel, fmt,
+                               time.time())).read()
+
+    def testReload(self):
+        self.say('before')
+        (old, new) = self.reload(True)
+        self.failUnless(handoff.expected is None)
+        logs = list(old._logs())
+        self.assertEqual(len(logs), 2)
+        self.assertEqual(sorted(new._logs()), sorted(logs))
+        for log in logs:
+            # Still open, with what was written before still buffered.
+            self.failIf(log.fd is None)
+            self.failUnless(log.buffer)
+        self.failUnless(new.memberships is old.memberships)
+        self.say('after')
+        text = self.read(new, 'log')
+        self.failUnless(text.index('<foo> before') < text.index('<foo> after'))
+        html = self.read(new, 'html')
+        self.assertEqual(html.count('<title>'), 1)
+        self.assertEqual(len(timestamps.id_re.findall(html)),
+                         len(text.splitlines()))
+
+    def testUnload(self):
+        self.say('before')
+        (old, new) = self.reload(False)
+        for log in old._logs():
+            self.assertEqual(log.fd, None)
+        self.assertEqual(list(new._logs()), [])
+        self.say('after')
+        self.failUnless('<foo> before' in self.read(new, 'log'))
+
+class ExportCommandTestCase(ChannelPluginTestCase):
+    plugins = ('MBChannelLogger',)
+
+    def setUp(self):
+        removeLogs()
+        ChannelPluginTestCase.setUp(self)
+
+    def testExport(self):
+        for text in ('one', 'two'):
+            self.irc.feedMsg(ircmsgs.privmsg(self.channel, text,
+                                             prefix='foo!u@h'))
+        # Config has an export command too.
+        day = time.strftime('%Y-%m-%d', time.gmtime())
+        tomorrow = time.strftime('%Y-%m-%d', time.gmtime(time.time() + 86400))
+        command = 'mbchannellogger export %s %s' % (day, tomorrow)
+        m = self.assertRegexp(command, r'I exported \d+ lines from #test to '
+                                       r'\S+\.log in the exports directory\.')
+        name = re.search(r' to (\S+) in', m.args[1]).group(1)
+        directory = conf.supybot.directories.data.dirize(
+            'MBChannelLogger.exports')
+        lines = open(os.path.join(directory, name)).readlines()
+        self.assertEqual([line.split('  ', 1)[1] for line in lines
+                          if '<foo>' in line],
+                         ['<foo> one\n', '<foo> two\n'])
+        self.assertError('mbchannellogger export yesterday %s' % tomorrow)
+        self.assertError(command + ' txt')
+
+class LogPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def read(self, name):
+        return open(os.path.join(self.dir, name)).read()
+
+    def testEvictBuffered(self):
+        pool = logfiles.LogPool(2)
+        logs = dict([(name, logfiles.LogFile(os.path.join(self.dir, name),
+                                             pool))
+                     for name in 'abc'])
+        for name in 'abc':
+            logs[name].write('%s1\n' % name)
+        # Writing out a evicts b, whose buffer is written as it's closed.
+        logs['a'].flush()
+        self.assertEqual(self.read('b'), 'b1\n')
+        self.failIf(logs['b'] in pool.logs)
+        self.assertEqual(logs['b'].fd, None)
+        for log in pool.logs:
+            self.failIf(log.fd is None)
+        for name in 'bc':
+            logs[name].write('%s2\n' % name)
+        for name in 'cba':
+            logs[name].flush()
+        self.assertEqual(self.read('a'), 'a1\n')
+        self.assertEqual(self.read('b'), 'b1\nb2\n')
+        self.assertEqual(self.read('c'), 'c1\nc2\n')
+        self.failUnless(len(pool) <= 2)
+        for log in logs.itervalues():
+            log.close()
+        self.assertEqual(len(pool), 0)
+
+    def testSplitName(self):
+        for (filename, format, expected) in [
+            ('#a.2020-08-01.log', '%Y-%m-%d', ('#a', '2020-08-01')),
+            ('#a.b.2020-08-01.html', '%Y-%m-%d', ('#a.b', '2020-08-01')),
+            ('#a.b.2020.08.01.log', '%Y.%m.%d', ('#a.b', '2020.08.01')),
+            ('#a.2020.08.log', '%Y.%m', ('#a', '2020.08')),
+            ('#a.log', '%Y.%m', ('#a', None)),
+            ('#a.index.html', '%Y-%m-%d', ('#a.index', None)),
+            ('#a.index-2020-08.html', '%Y-%m', ('#a.index-2020-08', None))]:
+            self.assertEqual(logfiles.splitName(filename, format), expected)
+
+    def testCompressOnce(self):
+        path = os.path.join(self.dir, '#a.2020-08-01.log')
+        data = ''.join(['line %s\n' % i for i in xrange(100000)])
+        open(path, 'w').write(data)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       logfiles.compress(path, 'gzip')))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [None] * 3 + [path + '.gz'])
+        self.assertEqual(os.listdir(self.dir), ['#a.2020-08-01.log.gz'])
+        with logfiles.openLog(path) as fd:
+            self.assertEqual(fd.read(), data)
+
+    def testPrepareDirectories(self):
+        resolver = logfiles.DirectoryResolver()
+        now = 1598918390 # 2020-08-31T23:59:50Z
+        (busy, idle) = [os.path.join(self.dir, name)
+                        for name in ('#busy', '#idle')]
+        for base in (busy, idle):
+            self.assertEqual(resolver.resolve(base, '%Y-%m', now),
+                             os.path.join(base, '2020-08'))
+        resolver.prepare(now - 120, 60, set([(busy, '%Y-%m')]))
+        self.failIf(os.path.exists(os.path.join(busy, '2020-09')))
+        resolver.prepare(now, 60, set([(busy, '%Y-%m')]))
+        self.failUnless(os.path.exists(os.path.join(busy, '2020-09')))
+        self.failIf(os.path.exists(os.path.join(idle, '2020-09')))
+        self.assertEqual(resolver.resolve(busy, '%Y-%m', now + 10),
+                         os.path.join(busy, '2020-09'))
+
+    def testCloseEvicted(self):
+        pool = logfiles.LogPool(1)
+        a = logfiles.LogFile(os.path.join(self.dir, 'a'), pool)
+        a.write('a1\n')
+        b = logfiles.LogFile(os.path.join(self.dir, 'b'), pool)
+        self.assertEqual(a.fd, None)
+        a.write('</html>\n')
+        a.close()
+        b.close()
+        self.assertEqual(self.read('a'), 'a1\n</html>\n')
+        self.assertEqual(len(pool), 0)
+
+class LineIndexTestCase(SupyTestCase):
+    when = 1600000000
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, '#a.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def write(self, first, last):
+        log = logfiles.LogFile(self.path, every=4)
+        for i in range(first, last):
+            log.mark(self.when + i * 10)
+            log.write('line %d\n' % i)
+        log.close()
+
+    def lines(self, first, last):
+        return ['line %d' % i for i in range(first, last)]
+
+    def testLastAndAround(self):
+        self.write(0, 18)
+        index = lineindex.LineIndex(self.path)
+        try:
+            self.assertEqual(len(index), 5)
+            self.assertEqual(index[1], (self.when + 40, len('line 0\n') * 4,
+                                        4))
+            with open(self.path) as fd:
+                self.assertEqual(lineindex.lastLines(fd, index, 3),
+                                 self.lines(15, 18))
+            with open(self.path) as fd:
+                self.assertEqual(lineindex.lastLines(fd, index, 50),
+                                 self.lines(0, 18))
+            # The record before 105 seconds in is line 8's.
+            with open(self.path) as fd:
+                self.assertEqual(lineindex.linesAround(fd, index,
+                                                       self.when + 105, 4),
+                                 self.lines(6, 10))
+            with open(self.path) as fd:
+                self.assertEqual(lineindex.readLines(fd, index, 10, 3),
+                                 self.lines(10, 13))
+        finally:
+            index.close()
+        # Compressed logs are read from the start up to the record.
+        path = logfiles.compress(self.path, 'gzip')
+        index = lineindex.LineIndex(self.path)
+        try:
+            with logfiles.openLog(path) as fd:
+                self.assertEqual(lineindex.lastLines(fd, index, 2),
+                                 self.lines(16, 18))
+        finally:
+            index.close()
+
+    def testResume(self):
+        self.write(0, 6)
+        # A record only half written when the bot stopped.
+        open(lineindex.indexPath(self.path), 'ab').write('x' * 5)
+        self.write(6, 10)
+        index = lineindex.LineIndex(self.path)
+        try:
+            self.assertEqual([record[lineindex.LINE] for record in index],
+                             [0, 4, 8])
+        finally:
+            index.close()
+        # The log was replaced, so its index no longer fits it.
+        open(self.path, 'w').write('line 0\n')
+        self.assertEqual(lineindex.resume(self.path, 7), (1, None))
+        self.failIf(os.path.exists(lineindex.indexPath(self.path)))
+
+class TimestampsTestCase(SupyTestCase):
+    def ids(self, times, ids, format='%H:%M:%S'):
+        stamp = timestamps.Timestamps()
+        lineids = []
+        for when in times:
+            stamp.update(when, format)
+            stamp.nextLine(ids)
+            lineids.append(stamp.lineid)
+        return lineids
+
+    def testNonMonotonic(self):
+        self.assertEqual(self.ids([100.1, 100.2, 90, 100.5, 101],
+                                  timestamps.LineIds()),
+                         ['00-01-40-0', '00-01-40-1', '00-01-30-2',
+                          '00-01-40-3', '00-01-41-0'])
+
+    def testResume(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, '<p><a id="00-01-39-0"></a></p>\n'
+                         '<p><a id="00-01-40-0"></a></p>\n'
+                         '<p><a id="00-01-40-1"></a></p>\n')
+            os.close(fd)
+            self.assertEqual(self.ids([100, 101],
+                                      timestamps.LineIds(path)),
+                             ['00-01-40-2', '00-01-41-0'])
+            self.assertEqual(self.ids([102], timestamps.LineIds(path)),
+                             ['00-01-42-0'])
+        finally:
+            os.remove(path)
+        self.assertEqual(self.ids([100], timestamps.LineIds(path)),
+                         ['00-01-40-0'])
+
+class AsyncWriterTestCase(SupyTestCase):
+    def testTimer(self):
+        written = []
+        fired = threading.Event()
+        def callback(n):
+            written.append(n)
+            if n == 1:
+                w.setTimer(time.time() + 0.2)
+        def timeout():
+            written.append('timeout')
+            fired.set()
+        w = writer.AsyncWriter(callback, log, timeout=timeout)
+        try:
+            w.put((1,), 10)
+            w.put((2,), 10)
+            w.drain()
+            self.assertEqual(written, [1, 2])
+            fired.wait(5)
+            self.assertEqual(written, [1, 2, 'timeout'])
+        finally:
+            w.stop()
+        self.failIf(w.thread.isAlive())
+
+class NetsplitTestCase(SupyTestCase):
+    def testSplitServers(self):
+        self.assertEqual(netsplit.splitServers('irc.a.net irc.b.net'),
+                         'irc.a.net irc.b.net')
+        self.assertEqual(netsplit.splitServers('*.net *.split'),
+                         '*.net *.split')
+        for reason in (None, 'Quit: bye', 'irc.a.net irc.a.net',
+                       'Ping timeout: 240 seconds'):
+            self.assertEqual(netsplit.splitServers(reason), None)
+
+    def testSummaries(self):
+        splits = netsplit.Netsplits()
+        splits.quit('foo', '*.net *.split', ['#a', '#b'], 100)
+        splits.quit('bar', '*.net *.split', ['#a'], 101)
+        self.assertEqual(splits.due(104, 5), [])
+        summaries = splits.due(105, 5)
+        self.assertEqual([(channel, event.target, event.time)
+                          for (channel, event) in summaries],
+                         [('#a', 'foo bar', None), ('#b', 'foo', None)])
+        text = events.TextFormatter()
+        settings = {'stripFormatting': False}
+        self.assertEqual([text.render(event, channel, None, settings)
+                          for (channel, event) in summaries],
+                         ['*** 2 users quit (netsplit: *.net *.split)\n',
+                          '*** 1 user quit (netsplit: *.net *.split)\n'])
+        self.failUnless(splits.join('foo', '#b', 200))
+        [(_, event)] = splits.due(300, 5)
+        self.assertEqual(text.render(event, '#b', None, settings),
+                         '*** 1 user rejoined (netjoin: *.net *.split)\n')
+
+    def testRejoins(self):
+        splits = netsplit.Netsplits()
+        splits.quit('foo', '*.net *.split', ['#a', '#b'], 100)
+        self.failIf(splits.join('foo', '#c', 110))
+        self.failUnless(splits.join('foo', '#A', 110))
+        # Parting and joining again isn't part of the netjoin.
+        self.failIf(splits.join('foo', '#a', 120))
+        self.failUnless(splits.join('foo', '#b', 120))
+        self.failIf(splits.join('foo', '#b', 130))
+        self.assertEqual(splits.split, {})
+
+    def testParse(self):
+        text = events.TextFormatter()
+        html = events.HtmlFormatter()
+        settings = {'stripFormatting': False}
+        for (type, line) in [
+            ('netsplit', '*** 2 users quit (netsplit: *.net *.split)'),
+            ('netsplit', '*** 1 user quit (netsplit: a.net b.net)'),
+            ('netjoin', '*** 3 users rejoined (netjoin: a.net b.net)')]:
+            event = text.parse(line, 100)
+            self.assertEqual(event.type, type)
+            self.assertEqual(text.render(event, '#a', None, settings),
+                             line + '\n')
+            self.failUnless(html.render(event, '#a', None, settings)
+                            .startswith('<p class="%s">'
+                                        % html.classes[type]))
+
+class MembershipTestCase(SupyTestCase):
+    def msg(self, nick, command, *args):
+        return ircmsgs.IrcMsg(prefix='%s!u@h' % nick, command=command,
+                              args=args)
+
+    def testMessages(self):
+        m = membership.Membership('Bot')
+        m.addMsg(ircmsgs.IrcMsg(prefix='server', command='353',
+                                args=('Bot', '=', '#Chan', '@Bot +Alice bob')))
+        m.addMsg(self.msg('Alice', 'JOIN', '#other,#third'))
+        self.assertEqual(m.channelsOf('ALICE'),
+                         set(['#chan', '#other', '#third']))
+        self.assertEqual(m.channelsOf('bob'), set(['#chan']))
+        m.addMsg(self.msg('Alice', 'NICK', 'Carol'))
+        self.assertEqual(m.channelsOf('alice'), ())
+        self.assertEqual(m.channelsOf('carol'),
+                         set(['#chan', '#other', '#third']))
+        m.addMsg(self.msg('Carol', 'PART', '#other,#third', 'bye'))
+        self.assertEqual(m.channelsOf('carol'), set(['#chan']))
+        m.addMsg(self.msg('Bot', 'KICK', '#chan', 'bob', 'out'))
+        self.assertEqual(m.channelsOf('bob'), ())
+        m.addMsg(self.msg('Carol', 'QUIT', 'gone'))
+        self.assertEqual(m.channelsOf('carol'), ())
+        self.assertEqual(m.nicks['#chan'], set(['bot']))
+
+    def testBotLeaves(self):
+        m = membership.Membership('Bot')
+        m.addMsg(self.msg('Bot', 'NICK', 'Bot2'))
+        for nick in ('bot2', 'alice', 'bob'):
+            m.join(nick, '#a')
+        m.join('alice', '#b')
+        # Once we've left, we can't tell who's still there.
+        m.addMsg(self.msg('Bot2', 'PART', '#a'))
+        self.assertEqual(m.channelsOf('bob'), ())
+        self.assertEqual(m.channelsOf('alice'), set(['#b']))
+        self.failIf('#a' in m.nicks)
+
+class ExportTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def layout(self, t):
+        when = time.gmtime(t)
+        return os.path.join(self.dir, time.strftime('%Y-%m', when),
+                            time.strftime('#a.%Y-%m-%d.log', when))
+
+    def write(self, date, lines):
+        path = self.layout(export.parseTime(date))
+        logfiles.makedirs(os.path.dirname(path))
+        open(path, 'w').write(''.join(['%s  %s\n' % line for line in lines]))
+        return path
+
+    def testParseTime(self):
+        parseTime = export.parseTime
+        self.assertEqual(parseTime('2020-09-13'), 1599955200)
+        self.assertEqual(parseTime('2020-09-13T12:26'), 1600000000 - 40)
+        self.assertEqual(parseTime(' 2020-09-13 12:26:40'), 1600000000)
+        self.assertEqual(parseTime('12:26:40', now=1599955200),
+                         1600000000)
+        self.assertEqual(parseTime('12:26:40'), None)
+        self.assertEqual(parseTime('2020-09-13T25:00'), None)
+
+    def testExport(self):
+        # Across months, and a compressed log.
+        path = self.write('2020-08-31', [('2020-08-31T23:00:00', 'early'),
+                                         ('2020-08-31T23:59:59', 'one')])
+        logfiles.compress(path, 'gzip')
+        self.write('2020-09-01', [('2020-09-01T00:00:00', 'two'),
+                                  ('not a line', 'skipped'),
+                                  ('2020-09-01T12:00:00', 'three'),
+                                  ('2020-09-01T12:00:01', 'late')])
+        # 2020-09-02 was never logged.
+        self.write('2020-09-03', [('2020-09-03T00:00:00', 'later')])
+        (start, end) = (export.parseTime('2020-08-31T23:30'),
+                        export.parseTime('2020-09-01T12:00:01'))
+        lines = export.export(self.layout, 86400, start, end, 'log',
+                              '%Y-%m-%dT%H:%M:%S')
+        out = os.path.join(self.dir, 'out')
+        self.assertEqual(export.write(out, lines, 'header\n', 'footer\n'),
+                         3)
+        self.assertEqual(open(out).read(),
+                         'header\n'
+                         '2020-08-31T23:59:59  one\n'
+                         '2020-09-01T00:00:00  two\n'
+                         '2020-09-01T12:00:00  three\n'
+                         'footer\n')
+        end = export.parseTime('2020-09-04')
+        self.assertEqual(list(export.findLogs(self.layout, start, end,
+                                              86400)),
+                         [path + '.gz', self.layout(end - 86400 * 3),
+                          self.layout(end - 86400)])
+
+    def testTimes(self):
+        when = 1600000000
+        timeOf = export.jsonTimes('%H:%M:%S')
+        self.assertEqual(timeOf('{"time":"2020-09-13T12:26:40Z"}\n'), when)
+        self.assertEqual(timeOf('{"type":"privmsg"}\n'), None)
+        stamp = timestamps.Timestamps()
+        stamp.update(when, '%Y-%m-%d %H:%M:%S')
+        stamp.nextLine(timestamps.LineIds())
+        event = events.LogEvent('privmsg', 'foo', '#a', 'hi', time=when)
+        line = events.HtmlFormatter().render(event, '#a', stamp, {})
+        timeOf = export.htmlTimes('%Y-%m-%d %H:%M:%S')
+        self.assertEqual(timeOf(line), when)
+        self.assertEqual(timeOf(events.htmlStart('#a', '2020-09-13',
+                                                 'style.css')), None)
+
+class IrcFormatTestCase(SupyTestCase):
+    def testPlain(self):
+        s = 'nothing to do here'
+        self.failUnless(ircformat.toHtml(s) is s)
+        self.assertEqual(ircformat.toHtml('<a & b>'), '&lt;a &amp; b&gt;')
+
+    def testStyles(self):
+        toHtml = ircformat.toHtml
+        self.assertEqual(toHtml('\x02bold\x02 plain'),
+                         '<span class="bold">bold</span> plain')
+        self.assertEqual(toHtml('\x02a\x1fb'),
+                         '<span class="bold">a</span>'
+                         '<span class="bold underline">b</span>')
+        # Classes are in the same order however the codes were.
+        self.assertEqual(toHtml('\x1d\x02both\x0f off'),
+                         '<span class="bold italic">both</span> off')
+        self.assertEqual(toHtml('\x02\x02'), '')
+        self.assertEqual(toHtml('\x11<tt>'),
+                         '<span class="mono">&lt;tt&gt;</span>')
+
+    def testColors(self):
+        toHtml = ircformat.toHtml
+        self.assertEqual(toHtml('\x034,12red on blue\x03 plain'),
+                         '<span class="fg4 bg12">red on blue</span> plain')
+        self.assertEqual(toHtml('\x0312blue\x034 red'),
+                         '<span class="fg12">blue</span>'
+                         '<span class="fg4"> red</span>')
+        # 99 is the default colour, and the others past 15 have no classes.
+        self.assertEqual(toHtml('\x0399,2x\x0350,99y'),
+                         '<span class="bg2">x</span>y')
+        # A comma with no foreground colour before it is just a comma.
+        self.assertEqual(toHtml('\x0312blue\x03,5 plain'),
+                         '<span class="fg12">blue</span>,5 plain')
+        self.assertEqual(toHtml('\x04ff0000,00ff00hex'), 'hex')
+
+    def testLinks(self):
+        s = '\x02see\x02 http://example.com/?a=1&b=<2>'
+        self.assertEqual(ircformat.toHtml(s),
+                         '<span class="bold">see</span> '
+                         '<a href="http://example.com/?a=1&amp;b=">'
+                         'http://example.com/?a=1&amp;b=</a>&lt;2&gt;')
+        self.assertEqual(ircformat.toHtml(s, links=False),
+                         '<span class="bold">see</span> '
+                         'http://example.com/?a=1&amp;b=&lt;2&gt;')
+
+class CollectorTestCase(SupyTestCase):
+    settings = {'formats': ['log'], 'timestamp': True,
+                'stripFormatting': True}
+    when = 1600000000
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'collector.sock')
+        self.sock = collector.listen(self.path)
+        self.collector = collector.Collector(os.path.join(self.dir, 'logs'),
+                                             '%H:%M:%S', '%Y-%m-%d', None,
+                                             'style.css', maxOpen=2)
+        self.clients = [collector.Client(self.path) for _ in range(2)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.sock.close()
+        self.collector.close()
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def send(self, client, bot, channel, text, when=None):
+        if when is None:
+            when = self.when
+        event = events.LogEvent('privmsg', 'foo', channel, text,
+                                time=when, network='net')
+        client.send(collector.encode(bot, channel, event, self.settings))
+
+    def read(self, channel, date='2020-09-13'):
+        path = os.path.join(self.dir, 'logs', 'net', channel,
+                            '%s.%s.log' % (channel, date))
+        return [line.split('  ', 1)[1] for line in open(path)]
+
+    def testDedup(self):
+        (a, b) = self.clients
+        self.send(a, 'a', '#one', 'hello')
+        self.send(b, 'b', '#one', 'hello')
+        self.send(a, 'a', '#one', 'again')
+        self.send(a, 'a', '#one', 'again')
+        self.send(b, 'b', '#one', 'again')
+        self.send(b, 'b', '#one', 'only b')
+        self.assertEqual(self.collector.poll(self.sock), 6)
+        self.assertEqual(self.read('#one'), ['<foo> hello\n',
+                                             '<foo> again\n',
+                                             '<foo> again\n',
+                                             '<foo> only b\n'])
+        self.assertEqual(self.collector.duplicates, 2)
+
+    def testMoreChannelsThanOpen(self):
+        (a, _) = self.clients
+        for channel in ('#one', '#two', '#three', '#two'):
+            self.send(a, 'a', channel, 'in %s' % channel)
+        self.collector.poll(self.sock)
+        self.send(a, 'a', '#two', 'later')
+        self.collector.poll(self.sock)
+        self.assertEqual(self.collector.failures, 0)
+        self.assertEqual(self.read('#two'), ['<foo> in #two\n'] * 2 +
+                                            ['<foo> later\n'])
+        self.assertEqual(self.read('#three'), ['<foo> in #three\n'])
+
+    def testLateEvent(self):
+        (a, _) = self.clients
+        midnight = 1600041600 # 2020-09-14T00:00:00Z
+        self.send(a, 'a', '#one', 'before', midnight - 5)
+        self.collector.poll(self.sock)
+        self.send(a, 'a', '#one', 'after', midnight + 1)
+        self.collector.poll(self.sock)
+        # Stamped before midnight, but it arrived after the rotation.
+        self.send(a, 'a', '#one', 'late', midnight - 3)
+        self.send(a, 'a', '#one', 'later', midnight + 30)
+        self.collector.poll(self.sock)
+        self.assertEqual(self.read('#one'), ['<foo> before\n'])
+        self.assertEqual(self.read('#one', '2020-09-14'),
+                         ['<foo> after\n', '<foo> late\n',
+                          '<foo> later\n'])
+
+    def testRegenerate(self):
+        (a, _) = self.clients
+        self.settings = dict(self.settings, formats=['log', 'html'])
+        for (text, when) in [('one', 0), ('two', 0), ('back', -10),
+                             ('three', 0), ('four', 1)]:
+            self.send(a, 'a', '#one', text, self.when + when)
+        self.send(a, 'a', '#one', '\x02bold\x02', self.when + 1)
+        self.collector.poll(self.sock)
+        self.collector.close()
+        path = os.path.join(self.dir, 'logs', 'net', '#one',
+                            '#one.2020-09-13.log')
+        html = path[:-len('.log')] + '.html'
+        live = open(html).read()
+        os.remove(html)
+        options = optparse.Values({'timestamp_format': '%H:%M:%S',
+                                   'css': 'style.css'})
+        self.assertEqual(regenerate.render(path, '#one', '2020-09-13',
+                                           options), 6)
+        regenerated = open(html).read()
+        ids = timestamps.id_re.findall(live)
+        self.assertEqual(len(ids), 6)
+        self.assertEqual(timestamps.id_re.findall(regenerated), ids)
+        # The text log has lost the formatting the HTML kept.
+        self.failUnless('<span class="bold">' in live)
+        self.failIf('<span class="bold">' in regenerated)
+        self.failUnless('class="privmsg"' in regenerated)
+
+    def testErrorsAreSurvived(self):
+        (a, _) = self.clients
+        os.makedirs(os.path.join(self.dir, 'logs', 'net'))
+        # A file where #bad's directory should be.
+        open(os.path.join(self.dir, 'logs', 'net', '#bad'), 'w').close()
+        self.send(a, 'a', '#bad', 'lost')
+        self.send(a, 'a', '#one', 'kept')
+        self.collector.poll(self.sock)
+        self.assertEqual(self.collector.failures, 1)
+        self.assertEqual(self.read('#one'), ['<foo> kept\n'])
+
+class RegenerateTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.options = optparse.Values({
+            'timestamp_format': '%Y-%m-%dT%H:%M:%S',
+            'filename_timestamp': '%Y-%m-%d', 'css': 'style.css',
+            'force': False})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def write(self, name, s='', mtime=None):
+        path = os.path.join(self.dir, name)
+        open(path, 'w').write(s)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def found(self):
+        return [(os.path.basename(path), channel, date) for
+                (path, channel, date, _) in regenerate.findLogs(self.dir,
+                                                                self.options)]
+
+    def testFindLogs(self):
+        # Up to date.
+        self.write('#a.2020-09-10.log', mtime=100)
+        self.write('#a.2020-09-10.html', mtime=200)
+        # Older than its text log.
+        self.write('#a.2020-09-11.log', mtime=300)
+        self.write('#a.2020-09-11.html', mtime=200)
+        logfiles.compress(self.write('#a.2020-09-12.log'), 'gzip')
+        # Still being written.
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        self.write('#a.%s.log' % today)
+        self.write('#a.log')
+        self.write('notes.txt')
+        self.assertEqual(self.found(),
+                         [('#a.2020-09-11.log', '#a', '2020-09-11'),
+                          ('#a.2020-09-12.log.gz', '#a', '2020-09-12')])
+        self.options.force = True
+        self.assertEqual([name for (name, _, _) in self.found()],
+                         ['#a.2020-09-10.log', '#a.2020-09-11.log',
+                          '#a.2020-09-12.log.gz', '#a.%s.log' % today,
+                          '#a.log'])
+
+    def testRender(self):
+        path = self.write('#a.2020-09-13.log',
+                          '2020-09-13T12:26:40  <foo> hi <there>\n'
+                          '2020-09-13T12:26:40  * foo waves\n'
+                          'garbage & such\n')
+        path = logfiles.compress(path, 'gzip')
+        logfiles.compress(self.write('#a.2020-09-13.html', 'old'), 'gzip')
+        self.assertEqual(regenerate.render(path, '#a', None, self.options), 3)
+        # It's compressed again, as the old version was.
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['#a.2020-09-13.html.gz', '#a.2020-09-13.log.gz'])
+        with logfiles.openLog(os.path.join(self.dir,
+                                           '#a.2020-09-13.html.gz')) as fd:
+            html = fd.read()
+        self.failUnless('<title>IRC log of #a on 2020-09-13</title>' in html)
+        self.failUnless('<p class="privmsg"><a id="12-26-40-0"' in html)
+        self.failUnless('&lt;there&gt;' in html)
+        self.failUnless('<p class="action privmsg"><a id="12-26-40-1"'
+                        in html)
+        self.failUnless('<p>garbage &amp; such</p>' in html)
+
+class SearchTestCase(SupyTestCase):
+    when = 1600000000 # 2020-09-13T12:26:40Z
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.index = search.SearchIndex(os.path.join(self.dir, 'index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def anchors(self, *args, **kwargs):
+        return [row[5] for row in self.index.search(*args, **kwargs)]
+
+    def writeLog(self, channel, texts):
+        directory = os.path.join(self.dir, 'logs', 'net', channel)
+        os.makedirs(directory)
+        path = os.path.join(directory, '%s.2020-09-13.html' % channel)
+        formatter = events.HtmlFormatter()
+        stamp = timestamps.Timestamps()
+        ids = timestamps.LineIds()
+        fd = open(path, 'w')
+        fd.write(events.htmlStart(channel, '2020-09-13', 'style.css'))
+        for (i, text) in enumerate(texts):
+            stamp.update(self.when + i, '%Y-%m-%dT%H:%M:%S')
+            stamp.nextLine(ids)
+            event = events.LogEvent('privmsg', 'foo', channel, text,
+                                    time=self.when + i, network='net')
+            fd.write(formatter.render(event, channel, stamp, {}))
+        fd.write(events.htmlEnd())
+        fd.close()
+
+    def testSearch(self):
+        self.index.add('<foo> hello world', self.when, 'net', '#a', 'a', '1')
+        self.index.add('<bar> hello again', self.when + 1, 'net', '#b', 'b',
+                       '2')
+        self.index.add('<foo> c++ says hello', self.when + 2, 'other', '#a',
+                       'c', '3')
+        self.assertEqual(self.anchors('hello'), ['3', '2', '1'])
+        self.assertEqual(self.anchors('hello', limit=1), ['3'])
+        self.assertEqual(self.anchors('hello', channel='#a'), ['3', '1'])
+        self.assertEqual(self.anchors('hello', channel='#a', network='net'),
+                         ['1'])
+        self.assertEqual(self.anchors('hello world'), ['1'])
+        # Not valid query syntax, so it's searched for as it is.
+        self.assertEqual(self.anchors('c++'), ['3'])
+        self.assertEqual(self.anchors('goodbye'), [])
+        self.index.clear('other')
+        self.assertEqual(self.anchors('hello'), ['2', '1'])
+
+    def testRebuild(self):
+        self.writeLog('#Foo', ['hello & world', 'hello again'])
+        root = os.path.join(self.dir, 'logs')
+        self.assertEqual(search.rebuild(self.index, root,
+                                        '%Y-%m-%dT%H:%M:%S'), 2)
+        path = os.path.join('net', '#Foo', '#Foo.2020-09-13.html')
+        # Channels are indexed in lower case, as the plugin adds them.
+        self.assertEqual(self.index.search('hello', channel='#foo'),
+                         [('<foo> hello again', self.when + 1, 'net', '#foo',
+                           path, '12-26-41-0'),
+                          ('<foo> hello & world', self.when, 'net', '#foo',
+                           path, '12-26-40-0')])
+        # Lines the plugin indexed while rebuilding are skipped.
+        self.index.clear()
+        skipped = []
+        def skip(relpath, anchor):
+            skipped.append((relpath, anchor))
+            return anchor == '12-26-40-0'
+        self.assertEqual(search.rebuild(self.index, root,
+                                        '%Y-%m-%dT%H:%M:%S', skip=skip), 1)
+        self.assertEqual(skipped, [(path, '12-26-40-0'),
+                                   (path, '12-26-41-0')])
+        self.assertEqual(self.anchors('hello'), ['12-26-41-0'])
+
+class ArchiveTestCase(SupyTestCase):
+    now = 1597000000 # 2020-08-09T19:06:40Z
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def testPages(self):
+        # directories.channel off, with a log per month.
+        log = os.path.join(self.dir, '#a.2020-08.html')
+        open(log, 'w').write('the log')
+        a = archive.Archive()
+        for i in range(3):
+            a.count('net', '#a', '2020-08', self.dir, '#a.', log,
+                    self.now + i)
+        a.save('net', '#a', 'style.css')
+        self.assertEqual(open(log).read(), 'the log')
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['#a.2020-08.html', '#a.archive.json',
+                          '#a.index-2020-08.html', '#a.index.html'])
+        for name in ('#a.index-2020-08.html', '#a.index.html'):
+            self.assertEqual(logfiles.splitName(name, '%Y-%m'),
+                             (name[:-len('.html')], None))
+        index = open(os.path.join(self.dir, '#a.index.html')).read()
+        self.failUnless('href="%23a.index-2020-08.html"' in index)
+        month = open(os.path.join(self.dir, '#a.index-2020-08.html')).read()
+        self.failUnless('<a href="%23a.2020-08.html">2020-08</a></td>'
+                        '<td>3</td><td>19:06:40</td><td>19:06:42</td>'
+                        in month)
+        # Counts carry on from what was saved.
+        a.count('net', '#a', '2020-08', self.dir, '#a.', log, self.now + 9)
+        a.save('net', '#a', 'style.css')
+        month = open(os.path.join(self.dir, '#a.index-2020-08.html')).read()
+        self.failUnless('<td>4</td><td>19:06:40</td><td>19:06:49</td>'
+                        in month)
+
+    def testMonths(self):
+        # directories.channel and directories.timestamp on, with a log per
+        # day in a directory per month.
+        noon = 1598788800 # 2020-08-30T12:00:00Z
+        logs = {}
+        a = archive.Archive()
+        for (i, date) in enumerate(['2020-08-30', '2020-08-31',
+                                    '2020-09-01']):
+            logs[date] = os.path.join(self.dir, date[:7],
+                                      '#a.%s.html' % date)
+            for j in range(i + 1):
+                a.count('net', '#a', date, self.dir, '', logs[date],
+                        noon + i * 86400 + j)
+        gz = logs['2020-09-01'] + '.gz'
+        a.rename('net', '#a', logs['2020-09-01'], gz)
+        a.saveAll('style.css')
+        self.assertEqual(a.days, {})
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['archive.json', 'index-2020-08.html',
+                          'index-2020-09.html', 'index.html'])
+        index = open(os.path.join(self.dir, 'index.html')).read()
+        # Newest month first.
+        self.failUnless('<a href="index-2020-09.html">2020-09</a></td>'
+                        '<td>1</td><td>3</td></tr>\n'
+                        '<tr><td><a href="index-2020-08.html">2020-08</a>'
+                        '</td><td>2</td><td>3</td></tr>' in index)
+        august = open(os.path.join(self.dir, 'index-2020-08.html')).read()
+        self.failUnless('<a href="2020-08/%23a.2020-08-30.html">2020-08-30'
+                        '</a></td><td>1</td>' in august)
+        self.failUnless('<a href="2020-08/%23a.2020-08-31.html">2020-08-31'
+                        '</a></td><td>2</td>' in august)
+        self.failIf('2020-09-01' in august)
+        september = open(os.path.join(self.dir,
+                                      'index-2020-09.html')).read()
+        self.failUnless('<a href="2020-09/%23a.2020-09-01.html.gz">'
+                        '2020-09-01</a></td><td>3</td>' in september)
+
+class RetentionTestCase(SupyTestCase):
+    now = 1600000000
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.ledger = retention.Ledger(os.path.join(self.dir, 'ledger'))
+        self.throttle = retention.Throttle(pause=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def makeLog(self, name, age, size=1000):
+        """Makes a rotated log and its line index, rotated age days ago,
+        and records it in the ledger."""
+        path = os.path.join(self.dir, name)
+        open(path, 'w').write('x' * size)
+        open(path + '.idx', 'w').write('y' * 24)
+        self.ledger.add(path, name.split('.')[0],
+                        self.now - age * retention.DAY)
+        return path
+
+    def enforce(self, days, default, quota, method=None):
+        return retention.enforce(self.ledger, days, default, quota, method,
+                                 self.now, throttle=self.throttle)
+
+    def testRetention(self):
+        old = self.makeLog('#a.2020-08-01.log', 40)
+        new = self.makeLog('#a.2020-09-01.log', 10)
+        other = self.makeLog('#b.2020-08-01.log', 40)
+        self.assertEqual(self.ledger.total, 3 * 1024)
+        self.assertEqual(self.enforce({'#a': 30}, 0, 0), (1, 0, 1024))
+        self.failIf(os.path.exists(old))
+        self.failIf(os.path.exists(old + '.idx'))
+        self.failUnless(os.path.exists(new))
+        self.failUnless(os.path.exists(other))
+        self.assertEqual(sorted(self.ledger.logs), [new, other])
+        # Channels without a retention of their own get the default.
+        self.assertEqual(self.enforce({'#a': 30}, 20, 0), (1, 0, 1024))
+        self.failIf(os.path.exists(other))
+
+    def testQuota(self):
+        paths = [self.makeLog('#a.2020-09-0%s.log' % i, 10 - i)
+                 for i in range(1, 6)]
+        (deleted, compressed, freed) = self.enforce({}, 0, 2048, 'gzip')
+        self.failUnless(self.ledger.total <= 2048)
+        # Compressing the oldest four is enough.
+        self.assertEqual((deleted, compressed), (0, 4))
+        self.failUnless(os.path.exists(paths[0] + '.gz'))
+        self.failUnless(os.path.exists(paths[-1]))
+        (deleted, _, _) = self.enforce({}, 0, 200)
+        self.failUnless(self.ledger.total <= 200)
+        self.failUnless(deleted)
+        # The oldest go first.
+        left = [path for path in paths if logfiles.findLog(path)]
+        self.assertEqual(left, paths[deleted:])
+        self.assertEqual(sorted(self.ledger.logs), left)
+
+    def testDeleteWaitsForCompressor(self):
+        path = self.makeLog('#a.2020-09-01.log', 40)
+        thread = threading.Thread(target=self.enforce, args=({}, 30, 0))
+        with logfiles.rotatedLock:
+            thread.start()
+            thread.join(0.2)
+            self.failUnless(os.path.exists(path))
+        thread.join()
+        self.failIf(os.path.exists(path))
+        self.assertEqual(self.ledger.logs, {})
+
+    def testLedgerReloads(self):
+        path = self.makeLog('#a.2020-09-01.log', 10)
+        self.makeLog('#a.2020-09-02.log', 9)
+        self.ledger.remove(path)
+        for _ in range(retention.COMPACT_SLACK + 10):
+            self.ledger.resize(path)
+        ledger = retention.Ledger(self.ledger.path)
+        self.assertEqual(ledger.logs, self.ledger.logs)
+        self.assertEqual(ledger.total, 1024)
+        # Resizing a log that isn't in the ledger records nothing.
+        self.failUnless(ledger.lines < 10)
+
+    def testScanSkipsArchivePages(self):
+        # directories.channel off: archive pages sit next to the logs.
+        for name in ('#a.2020-08-01.log', '#a.2020-08-02.html.gz',
+                     '#a.2020-08-03.log', '#a.index.html',
+                     '#a.index-2020-08.html', '#a.log', '#a.archive.json'):
+            open(os.path.join(self.dir, name), 'w').write('x')
+        os.utime(os.path.join(self.dir, '#a.index-2020-08.html'),
+                 (self.now - 60 * retention.DAY,) * 2)
+        current = set([os.path.join(self.dir, '#a.2020-08-03.log')])
+        found = retention.scan(self.ledger, self.dir, current, {},
+                               '%Y-%m-%d', throttle=self.throttle)
+        self.assertEqual(found, 2)
+        self.assertEqual(sorted(self.ledger.logs),
+                         [os.path.join(self.dir, '#a.2020-08-01.log'),
+                          os.path.join(self.dir, '#a.2020-08-02.html')])
+        self.failUnless(retention.Ledger(self.ledger.path).scanned)
+        self.enforce({}, 30, 0)
+        self.failUnless(os.path.exists(os.path.join(self.dir,
+                                                    '#a.index.html')))
+        self.failUnless(os.path.exists(os.path.join(self.dir,
+                                                    '#a.index-2020-08.html')))
+
+    def testScanDottedTimestamps(self):
+        names = ['#a.b.2020.08.01.log', '#a.b.2020-08-01.log',
+                 '#c.2020-08-01.log', '#c.2020.08.01.log']
+        for name in names:
+            open(os.path.join(self.dir, name), 'w').write('x')
+        found = retention.scan(self.ledger, self.dir, set(),
+                               {'#a.b': '%Y.%m.%d'}, '%Y-%m-%d',
+                               throttle=self.throttle)
+        self.assertEqual(found, 2)
+        self.assertEqual(sorted(self.ledger.logs),
+                         [os.path.join(self.dir, names[0]),
+                          os.path.join(self.dir, names[2])])
+        self.assertEqual(sorted(channel for (_, _, channel)
+                                in self.ledger.logs.itervalues()),
+                         ['#a.b', '#c'])
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
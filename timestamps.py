@@ -0,0 +1,86 @@
+"""
+Formats log line timestamps once per second rather than once per line.
+"""
+
+import re
+import time
+
+# How much of the end of an HTML log is read for the ids of its last lines
+# when it's reopened.
+TAIL_BYTES = 4096
+
+id_re = re.compile(r'id="(\d\d-\d\d-\d\d-)(\d+)"')
+
+class Timestamps(object):
+    """The timestamp strings for the current second, and line anchor ids.
+
+    update() only calls strftime() when the second (or the format) changes;
+    in between, every line and channel shares the same strings.  nextLine()
+    sets lineid, the anchor id of the next line of a log, from the log's
+    LineIds.
+    """
+    def __init__(self):
+        self.second = None
+        self.format = None
+        self.text = ''
+        self.clock = ''
+        self.idPrefix = ''
+        self.lineid = None
+
+    def update(self, now, format):
+        second = int(now)
+        if second == self.second and format == self.format:
+            return
+        curtime = time.gmtime(second)
+        self.text = time.strftime(format, curtime)
+        self.clock = time.strftime('%H:%M:%S', curtime)
+        self.idPrefix = time.strftime('%H-%M-%S-', curtime)
+        self.second = second
+        self.format = format
+
+    def nextLine(self, ids):
+        self.lineid = ids.next(self.second, self.idPrefix)
+
+class LineIds(object):
+    """The anchor ids of the lines of one log.
+
+    An id is the time of the line followed by a sequence number, which
+    counts the lines written in that second.  The count only restarts when
+    the time passes the latest second seen, so ids stay unique if the clock
+    goes backwards.  If path is given, it's the log being appended to, and
+    the count carries on from the ids at its end, so a log reopened in the
+    same second as its last line doesn't repeat its id.
+    """
+    def __init__(self, path=None):
+        self.high = None
+        self.seq = 0
+        self.resumed = {}
+        if path is not None:
+            self.resumed = lastIds(path)
+
+    def next(self, second, prefix):
+        if self.high is None or second > self.high:
+            self.seq = self.resumed.get(prefix, 0)
+            self.resumed = {}
+            self.high = second
+        lineid = '%s%d' % (prefix, self.seq)
+        self.seq += 1
+        return lineid
+
+def lastIds(path):
+    """Returns the next sequence number for each second in the ids at the
+    end of the HTML log at path, which may not exist yet."""
+    try:
+        fd = open(path, 'rb')
+    except IOError:
+        return {}
+    with fd:
+        fd.seek(0, 2)
+        fd.seek(max(0, fd.tell() - TAIL_BYTES))
+        tail = fd.read()
+    seqs = {}
+    for (prefix, seq) in id_re.findall(tail):
+        seqs[prefix] = max(seqs.get(prefix, 0), int(seq) + 1)
+    return seqs
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,116 @@
+"""
+A dedicated thread for writing logs, so the thread dispatching IRC messages
+never waits on the disk.
+"""
+
+import time
+import threading
+import collections
+
+BLOCK = 'block'
+DROP_OLDEST = 'dropOldest'
+SPILL = 'spill'
+
+class AsyncWriter(object):
+    """Hands queued records to callback, in order, on a thread of its own.
+
+    The queue holds up to maxsize records.  What put() does when it's full
+    depends on policy: BLOCK waits for the writer to catch up, DROP_OLDEST
+    throws away the oldest queued record, and SPILL queues the record anyway
+    so the queue grows in memory until the writer catches up.
+
+    The callback can ask for timeout to be called on the writer's thread,
+    once it's idle, at some time with setTimer(); supybot's schedule can't
+    be used from any other thread.
+    """
+    def __init__(self, callback, log, name='AsyncWriter', timeout=None):
+        self.callback = callback
+        self.timeout = timeout
+        self.log = log
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.stopping = False
+        self.timer = None
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, record, maxsize, policy=BLOCK):
+        with self.cond:
+            while len(self.queue) >= maxsize and not self.stopping:
+                if policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif policy == SPILL:
+                    break
+                else:
+                    self.cond.wait()
+            self.queue.append(record)
+            self.cond.notifyAll()
+
+    def setTimer(self, when):
+        """Calls timeout() at when, unless it's already to be called
+        sooner."""
+        with self.cond:
+            if self.timer is None or when < self.timer:
+                self.timer = when
+                self.cond.notifyAll()
+
+    def due(self):
+        """Returns whether the timer has gone off.  Called holding the
+        condition."""
+        if self.timer is None:
+            self.cond.wait()
+            return False
+        remaining = self.timer - time.time()
+        if remaining > 0:
+            self.cond.wait(remaining)
+            return False
+        self.timer = None
+        return True
+
+    def run(self):
+        while True:
+            records = []
+            timeout = False
+            with self.cond:
+                while not self.queue and not self.stopping and not timeout:
+                    timeout = self.due()
+                if not self.queue and not timeout:
+                    return
+                records = list(self.queue)
+                self.queue.clear()
+                self.busy = True
+                self.cond.notifyAll()
+            try:
+                for record in records:
+                    try:
+                        self.callback(*record)
+                    except Exception:
+                        self.log.exception('Uncaught exception writing log:')
+                if timeout and self.timeout is not None:
+                    try:
+                        self.timeout()
+                    except Exception:
+                        self.log.exception('Uncaught exception writing log:')
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notifyAll()
+
+    def drain(self):
+        """Waits until everything queued so far has been written."""
+        with self.cond:
+            while (self.queue or self.busy) and self.thread.isAlive():
+                self.cond.wait()
+
+    def stop(self):
+        """Writes everything still queued, then stops the thread."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notifyAll()
+        self.thread.join()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: